@@ -19,6 +19,7 @@ Command options:
 	finalize_assignments	finalize the assignemnt of V(D)J genes
 	dereplicate_sequences	Remove duplicate sequences 
 	calculate_id-div	Calculate somatic hypermutation level and sesquence divergence to target antibodies
+	calculate_id-div_native	Same as calculate_id-div, aligning reads in-process and in parallel instead of with MUSCLE
 	get_island	\tExtract sequences within an interested island on 2D plot.
 	intradonor_analysis	Find lineage related sequences of known antibodies on phylogenetic tree
 	cluster_into_groups	Cluster sequences into clones or lineages
@@ -48,6 +49,7 @@ my %scripts=(
 							'finalize_assignments','1.3-finalize_assignments.py',
 							'dereplicate_sequences','1.4-dereplicate_sequences.pl',
 							'calculate_id-div','2.1-calculate_id-div.pl',
+							'calculate_id-div_native','2.1-calculate_id-div.py',
 							'get_island','2.2-get_island.py',
 							'intradonor_analysis','2.3-intradonor_analysis.py',
 							'cluster_into_groups','2.4-cluster_into_groups.py',
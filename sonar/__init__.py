@@ -11,11 +11,6 @@ Copyright (c) 2011-2016 Columbia University and Vaccine Research Center, Nationa
                          Institutes of Health, USA. All rights reserved.
 """
 
-from Bio import SeqIO
-from Bio import Seq
-from Bio import AlignIO
-from Bio.SeqRecord import SeqRecord
-from Bio.Align.Applications import ClustalwCommandline
 from math import log
 
 import glob
@@ -23,10 +18,28 @@ import re
 import subprocess
 import atexit
 
+from commonVars import *
+from lazyImport import LazyModule, LazyObject
+from seqReader import read_sequences
+from scheduler import TaskGraph, get_cluster_backend
 
-from numpy import mean, array, zeros, ones, nan, std, isnan
 
-from commonVars import *
+#Biopython and NumPy take most of the start-up time of a script, but many
+#    scripts only use a few of these (or none), so they are only imported
+#    when first used
+SeqIO               = LazyModule("Bio.SeqIO")
+Seq                 = LazyModule("Bio.Seq")
+AlignIO             = LazyModule("Bio.AlignIO")
+SeqRecord           = LazyObject("Bio.SeqRecord", "SeqRecord")
+ClustalwCommandline = LazyObject("Bio.Align.Applications", "ClustalwCommandline")
+
+mean, array, zeros, ones, std, isnan = [ LazyObject("numpy", f) for f in ["mean", "array", "zeros", "ones", "std", "isnan"] ]
+nan = float("nan")
+
+FastaIndex = LazyObject("sonar.fastaIndex", "FastaIndex")
+translate, translate_batch, translate_fasta = [ LazyObject("sonar.translation", f) for f in ["translate", "translate_batch", "translate_fasta"] ]
+AnnotationStore, AnnotationStoreWriter = [ LazyObject("sonar.annotationStore", c) for c in ["AnnotationStore", "AnnotationStoreWriter"] ]
+dereplicate = LazyObject("sonar.derep", "dereplicate")
 
 
 ########## COMMAND LOGGING ############
@@ -69,10 +82,13 @@ def logCmdLine( command ):
             if re.search("\s", arg):
                 command[idx] = '"'+arg+'"'
 
-        p = subprocess.Popen(['git', '-C', os.path.dirname(command[0]), 
-                              'describe', '--always','--dirty','--tags'],
-                             stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        VERSION = p.communicate()[0].strip()
+        #setup.sh saves the version in paths.py; only ask git on older installs
+        VERSION = globals().get("SONAR_VERSION")
+        if VERSION is None:
+            p = subprocess.Popen(['git', '-C', os.path.dirname(command[0]), 
+                                  'describe', '--always','--dirty','--tags'],
+                                 stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            VERSION = p.communicate()[0].strip()
         
         with open("%s/output/logs/command_history.log"%os.getcwd(), "a") as handle:
             handle.write( "\n%s -- SONAR %s run with command:\n\t%s\n" % (time.strftime("%c"), VERSION, " ".join(command)) )
@@ -114,7 +130,27 @@ class MyNode:
 		self.children.append(child)
 
 
-class MySeq:
+class CompactRecord(object):
+	"""
+	base for the per-read classes below: attributes live in __slots__ instead of
+	   a per-object dict, which roughly halves their memory footprint when
+	   there are hundreds of thousands of them at once. Only the attributes
+	   listed in __slots__ can be set.
+	"""
+	__slots__ = ()
+
+	#objects without a __dict__ need these to be pickled with the older protocols
+	def __getstate__(self):
+		return dict( (k, getattr(self, k)) for k in self.__slots__ if hasattr(self, k) )
+
+	def __setstate__(self, state):
+		for k, v in state.items():
+			setattr(self, k, v)
+
+
+class MySeq(CompactRecord):
+	__slots__ = ("seq_id", "seq", "seq_len", "desc")
+
 	def __init__(self, seq_id, seq):
 		self.seq_id 	= seq_id					# sequence ID
 		try:
@@ -128,13 +164,18 @@ class MySeq:
 	def set_desc(self, desc):
 		self.desc = desc
 		
-class MyQual:
+class MyQual(CompactRecord):
+	__slots__ = ("qual_id", "qual_list", "qual_len")
+
 	def __init__(self, qual_id, qual_list):
 		self.qual_id 	= qual_id
 		self.qual_list 	= qual_list
 		self.qual_len	= len(qual_list)
 		
-class MyAlignment:
+class MyAlignment(CompactRecord):
+	__slots__ = ("qid", "sid", "identity", "alignment", "mismatches", "gaps", "qstart", "qend",
+		     "sstart", "send", "evalue", "score", "strand", "qlen", "slen", "real_id", "divergence")
+
 	def __init__(self, row):
 		self.qid	= row[0].strip()		# query id
 		self.sid	= row[1].strip()		# subject id
@@ -165,7 +206,11 @@ class MyAlignment:
 	def set_diversity(self, divergence):
 		self.divergence = divergence
 		
-class MyAlignmentVerbose:
+class MyAlignmentVerbose(CompactRecord):
+	__slots__ = ("query_id", "sbjct_id", "strand", "evalue", "score", "identities", "gaps", "aln_len",
+		     "query_start", "query_end", "query_len", "sbjct_start", "sbjct_end", "sbjct_len",
+		     "aln_query", "aln_sbjct")
+
 	def __init__(self, row):
 		self.query_id		= row[0]
 		self.sbjct_id		= row[1]
@@ -296,11 +341,24 @@ def fullpath2last_folder(s):
 	return s[s.rindex("/") + 1 :]
 
 
-def create_folders(folder, force=False):
+def create_folders(folder, force=False, update=False):
+
+	"""
+	set up the project folders; existing ones are removed with force, or kept
+	   as they are with update (to reuse intermediate files, see
+	   annotate/checkpoint.py)
+	"""
 
 	old_wd = os.getcwd()
 	os.chdir(folder)
 
+	if update:
+		for subfolder in ["work", "output"] + ALL_FOLDERS:
+			if not os.path.isdir(subfolder):
+				os.mkdir(subfolder)
+		os.chdir(old_wd)
+		return ProjectFolders(folder)
+
 	if (os.path.isdir("work")):
 		if not force:
 			sys.exit("Working directory already exists. Please use the -f(orce) option to re-intiate an analysis from scratch.\n")
@@ -455,10 +513,9 @@ def load_seqs_in_dict(f, ids):
 	"""
 	load all sequences in file f is their id is in ids (list or set or dictionary)
 	"""
-	result = dict()
-	for entry in SeqIO.parse(open(f, "rU"), "fasta"):
-		if entry.id in ids:
-			result[entry.id] = entry
+	index  = FastaIndex(f)
+	result = dict( (entry.id, entry) for entry in index.fetch_many(ids) )
+	index.close()
 			
 	return result
 	
@@ -466,19 +523,10 @@ def load_seqs_in_dict(f, ids):
 def load_fastas_in_list(f, l):
 	
 	print "loading reads from %s as in given list..." %f
-	reader, result, good = SeqIO.parse(open(f, "rU"), "fasta"), dict(), 0
 
-	for entry in reader:
-		if entry.id in l:
-
-			#changed to match load from set CAS 20121004
-			result[entry.id] = entry
-			good += 1
-			if good == len(l): break
-
-			#myseq = MySeq(entry.id, entry.seq)
-			#myseq.desc = entry.description
-			#result[entry.id] = myseq
+	#changed to match load from set CAS 20121004
+	#records are pulled straight out of the file using its offset index
+	result = load_seqs_in_dict(f, l)
 
 	print "%d loaded...." %len(result)
 	return result
@@ -486,10 +534,9 @@ def load_fastas_in_list(f, l):
 
 def load_fastas_with_Vgene(f, v):
 	print "loading reads from %s assigned to %s..." %(f,v)
-	reader, dict_reads = SeqIO.parse(open(f, "rU"), "fasta"), dict()
-	for entry in reader:
-		if re.search(v, entry.description):
-			dict_reads[entry.id] = entry
+	index = FastaIndex(f)
+	dict_reads = dict( (entry.id, entry) for entry in index.with_vgene(v) )
+	index.close()
 
 	print "%d loaded..." %len(dict_reads)
 	return dict_reads
@@ -517,17 +564,18 @@ def generate_read_fasta(f):
 		yield entry
 
 
-def generate_read_fasta_folder(fastas, type=1):
+def generate_reads_folder(fastas, background=False):
+	"""yield (id, sequence, file name) for every read in a list of (possibly gzipped) FASTA/FASTQ files"""
 
 	for fasta_file in fastas:
+		for seq_id, seq in read_sequences(fasta_file, background):
+			yield seq_id, seq, fasta_file
 
-		filetype = "fasta"
-		if re.search("\.(fq|fastq)$", fasta_file) is not None:
-			filetype = "fastq"
 
-		for entry in SeqIO.parse(open(fasta_file, "rU"), filetype):
+def generate_read_fasta_folder(fastas, type=1):
 
-			yield MySeq(entry.id, entry.seq), None, fasta_file
+	for seq_id, seq, fasta_file in generate_reads_folder(fastas):
+		yield MySeq(seq_id, seq), None, fasta_file
 
 			#if we reimplement qual handling uncomment next section
 			#if filetype == "fastq":
@@ -542,11 +590,9 @@ def check_fasta_qual_pair(fa_name, qu_name):
 def translate_a_sequence(s):
 	"""translate nucleotide to protein"""  # this method is redundant, but we wannt deal with "N"
 	s = s.upper()
-	if s.find("N") > 0:
+	if s.find("N") >= 0:
 		return None
-	codons = ["".join(x) for x in zip(s[ :: 3], s[1 :: 3], s[2 :: 3])]
-
-	return "".join([dict_codon2aa[x][0] for x in codons])
+	return translate(s[ : len(s) - len(s) % 3 ])
 	
 #
 # -- END -- FASTA file and sequence methods 
@@ -0,0 +1,470 @@
+#!/usr/bin/env python
+
+"""
+align.py
+
+Vectorized pairwise alignment kernels used by the native (in-process) engines
+      in SONAR. Sequences are encoded as uint8 arrays (A=0, C=1, G=2, T=3,
+      anything else=4) and whole batches of pairs are aligned together, one
+      DP row at a time, with NumPy doing the work across the batch and across
+      a fixed band around a seed diagonal.
+
+Scoring defaults mirror the BLAST parameters used elsewhere in the pipeline
+      (reward 1, penalty -1, gap open 5, gap extend 2, so a gap of length L
+      costs 5 + 2L). Ambiguous bases always score as a mismatch.
+
+Copyright (c) 2011-2017 Columbia University and Vaccine Research Center, National
+                         Institutes of Health, USA. All rights reserved.
+
+"""
+
+from math import log, exp
+import numpy
+
+
+# nucleotide encoding
+_ENCODE = numpy.empty(256, dtype=numpy.uint8)
+_ENCODE.fill(4)
+for _i, _b in enumerate("ACGT"):
+	_ENCODE[ord(_b)] = _i
+	_ENCODE[ord(_b.lower())] = _i
+_COMPLEMENT = numpy.array([3, 2, 1, 0, 4], dtype=numpy.uint8)
+
+# Karlin-Altschul parameters for blastn 1/-1; NCBI falls back on the ungapped
+#    values when the gap costs (5/2) exceed those in its gapped tables
+BLASTN_LAMBDA = log(3.0)
+BLASTN_K      = 0.333
+
+NEG = -(1 << 14)
+
+
+def encode_seq(s):
+	"""convert a nucleotide string into a uint8 code array"""
+	return _ENCODE[ numpy.frombuffer(str(s), dtype=numpy.uint8) ]
+
+
+def revcomp_codes(codes):
+	"""reverse complement an encoded sequence"""
+	return _COMPLEMENT[ codes[::-1] ]
+
+
+def bit_score(raw):
+	return (BLASTN_LAMBDA * raw - log(BLASTN_K)) / log(2)
+
+
+def evalue(raw, qlen, dblen):
+	return BLASTN_K * qlen * dblen * exp(-BLASTN_LAMBDA * raw)
+
+
+class LocalHit(object):
+	"""summary of one local alignment, in 1-based inclusive coordinates"""
+
+	__slots__ = ("score", "qstart", "qend", "sstart", "send", "length", "matches", "mismatches", "gaps")
+
+	def __init__(self, score, qstart, qend, sstart, send, length, matches, mismatches, gaps):
+		self.score      = score
+		self.qstart     = qstart
+		self.qend       = qend
+		self.sstart     = sstart
+		self.send       = send
+		self.length     = length
+		self.matches    = matches
+		self.mismatches = mismatches
+		self.gaps       = gaps
+
+
+def banded_local_align(queries, subjects, diagonals, band=16, reward=1, penalty=-1, gapopen=5, gapextend=2):
+	"""
+	Smith-Waterman (Gotoh) local alignment of a batch of encoded query/subject
+	   pairs, restricted to a band of +/- band positions around the diagonal
+	   query_pos - subject_pos = diagonals[n] given by the seed for each pair.
+	Returns a list with a LocalHit (or None if nothing scored) for each pair.
+	"""
+
+	nPairs = len(queries)
+	if nPairs == 0:
+		return []
+
+	W     = 2 * band + 1
+	offs  = numpy.arange(-band, band + 1)
+	kgrid = numpy.arange(W, dtype=numpy.int16)
+	maxS  = max(len(s) for s in subjects)
+	maxQ  = max(len(q) for q in queries)
+
+	# padded code matrices; query sentinel (5) and subject sentinel (6) mark cells outside the matrix
+	pad  = band + max(0, -min(diagonals)) + 1
+	Q    = numpy.empty((nPairs, pad + maxQ + maxS + pad), dtype=numpy.uint8)
+	Q.fill(5)
+	S    = numpy.empty((nPairs, maxS), dtype=numpy.uint8)
+	S.fill(6)
+	for n in range(nPairs):
+		Q[n, pad : pad + len(queries[n])] = queries[n]
+		S[n, :len(subjects[n])] = subjects[n]
+	diag = numpy.asarray(diagonals, dtype=numpy.int64)
+
+	# gather the query bases under the band for every row at once: band cell (i, d)
+	#    holds query position j = i + diag + d - band
+	cols  = (pad + diag - band)[:, None, None] + numpy.arange(maxS)[None, :, None] + kgrid[None, None, :]
+	cols  = numpy.clip(cols, 0, Q.shape[1] - 1)
+	Qband = Q[ numpy.arange(nPairs)[:, None, None], cols ]
+	Sband = S[:, :, None]
+	valid = ((Qband < 5) & (Sband < 6)).transpose(1, 0, 2).copy()
+	subst = numpy.where((Qband == Sband) & (Sband < 4), reward, penalty).astype(numpy.int16).transpose(1, 0, 2).copy()
+	del Qband, cols
+
+	# traceback storage
+	dirH  = numpy.zeros((maxS, nPairs, W), dtype=numpy.uint8)  # 0 = start, 1 = diagonal, 2 = vertical gap
+	extE  = numpy.zeros((maxS, nPairs, W), dtype=numpy.bool_)
+	fromF = numpy.zeros((maxS, nPairs, W), dtype=numpy.bool_)
+	srcF  = numpy.zeros((maxS, nPairs, W), dtype=numpy.int16)
+	rowMax = numpy.zeros((maxS, nPairs), dtype=numpy.int16)
+	rowArg = numpy.zeros((maxS, nPairs), dtype=numpy.int16)
+
+	Hprev = numpy.zeros((nPairs, W + 1), dtype=numpy.int16)
+	Eprev = numpy.empty((nPairs, W + 1), dtype=numpy.int16)
+	Eprev.fill(NEG)
+	Hprev[:, W] = NEG
+	F    = numpy.empty((nPairs, W), dtype=numpy.int16)
+	F[:, 0] = NEG
+	srcK = numpy.zeros((nPairs, W), dtype=numpy.int16)
+	openCost = gapopen + gapextend * kgrid[1:]
+	allPairs = numpy.arange(nPairs)
+
+	for i in range(maxS):
+		ok = valid[i]
+
+		# vertical gap: (i-1, j) sits at band index d+1 of the previous row
+		openE = Hprev[:, 1:] - (gapopen + gapextend)
+		extdE = Eprev[:, 1:] - gapextend
+		E     = numpy.maximum(openE, extdE)
+		diagH = Hprev[:, :W] + subst[i]
+
+		best  = numpy.maximum(diagH, E)
+		Hp    = numpy.where(ok, numpy.maximum(best, 0), NEG)
+		E     = numpy.where(ok, E, NEG)
+
+		# horizontal gap via a running max: F[d] = max_{k<d}(H'[k] + ge*k) - go - ge*d
+		val    = Hp + gapextend * kgrid
+		acc    = numpy.maximum.accumulate(val, axis=1)
+		argacc = numpy.maximum.accumulate(numpy.where(val >= acc, kgrid, 0), axis=1)
+		F[:, 1:]    = acc[:, :-1] - openCost
+		srcK[:, 1:] = argacc[:, :-1]
+		useF   = ok & (F > Hp)
+		H      = numpy.where(useF, F, Hp)
+
+		dirH[i]  = numpy.where(best <= 0, 0, numpy.where(diagH >= E, 1, 2))
+		extE[i]  = extdE >= openE
+		fromF[i] = useF
+		srcF[i]  = srcK
+
+		rowArg[i] = H.argmax(axis=1)
+		rowMax[i] = H[allPairs, rowArg[i]]
+
+		Hprev[:, :W] = H
+		Eprev[:, :W] = E
+
+	bestRow   = rowMax.argmax(axis=0)
+	bestScore = rowMax[bestRow, allPairs]
+	bestCol   = rowArg[bestRow, allPairs]
+
+	# trace back from the best cell of each pair (item() is much cheaper than numpy scalar indexing)
+	results = []
+	for n in range(nPairs):
+		if bestScore[n] <= 0:
+			results.append(None)
+			continue
+
+		i, d   = int(bestRow[n]), int(bestCol[n])
+		offset = int(diag[n]) - band
+		steps, exts, fFlags, fSrc = dirH[:, n], extE[:, n], fromF[:, n], srcF[:, n]
+		qs, ss = Q[n], S[n]
+
+		endS, endQ = i, i + offset + d
+		startS, startQ = endS, endQ
+		matches = mismatches = gaps = length = 0
+		skipF = False
+		while i >= 0:
+			if not skipF and fFlags.item(i, d):
+				k = fSrc.item(i, d)
+				gaps   += d - k
+				length += d - k
+				d = k
+				skipF = True
+				continue
+			skipF = False
+			step = steps.item(i, d)
+			if step == 1:
+				qpos = i + offset + d
+				sBase = ss.item(i)
+				if qs.item(pad + qpos) == sBase and sBase < 4:
+					matches += 1
+				else:
+					mismatches += 1
+				length += 1
+				startS, startQ = i, qpos
+				i -= 1
+			elif step == 2:
+				while True:
+					ext = exts.item(i, d)
+					gaps   += 1
+					length += 1
+					i -= 1
+					d += 1
+					if not ext:
+						break
+			else:
+				break
+
+		results.append( LocalHit(int(bestScore[n]), startQ + 1, endQ + 1, startS + 1, endS + 1,
+					 length, matches, mismatches, gaps) )
+
+	return results
+
+
+# amino acid encoding, for kernels that take nReal=20
+AMINO_ACIDS = "ACDEFGHIKLMNPQRSTVWY"
+_ENCODE_AA  = numpy.empty(256, dtype=numpy.uint8)
+_ENCODE_AA.fill(len(AMINO_ACIDS))
+for _i, _b in enumerate(AMINO_ACIDS):
+	_ENCODE_AA[ord(_b)] = _i
+	_ENCODE_AA[ord(_b.lower())] = _i
+
+Q_PAD = 255
+S_PAD = 254
+
+
+def encode_protein(s):
+	"""convert an amino acid string into a uint8 code array (anything non-standard = 20)"""
+	return _ENCODE_AA[ numpy.frombuffer(str(s), dtype=numpy.uint8) ]
+
+
+def seed_diagonals(queries, subject, k=8, nReal=4):
+	"""
+	most common diagonal (query_pos - subject_pos) of the k-mers that each
+	   encoded query shares with one encoded subject (0 if there are none)
+	"""
+
+	nPairs = len(queries)
+	base   = nReal + 1
+	maxQ   = max(len(q) for q in queries)
+	if maxQ < k or len(subject) < k:
+		return numpy.zeros(nPairs, dtype=numpy.int64)
+
+	# subject position of each k-mer (the last one, for repeats)
+	lookup = numpy.empty(base ** k, dtype=numpy.int64)
+	lookup.fill(-1)
+	s      = subject.astype(numpy.int64)
+	sCodes = numpy.zeros(len(s) - k + 1, dtype=numpy.int64)
+	for p in range(k):
+		sCodes = sCodes * base + s[p : p + len(sCodes)]
+	lookup[sCodes] = numpy.arange(len(sCodes))
+
+	Q = numpy.zeros((nPairs, maxQ), dtype=numpy.int64)
+	for n in range(nPairs):
+		Q[n, :len(queries[n])] = queries[n]
+	nK     = maxQ - k + 1
+	qCodes = numpy.zeros((nPairs, nK), dtype=numpy.int64)
+	for p in range(k):
+		qCodes = qCodes * base + Q[:, p : p + nK]
+	lengths = numpy.array([ len(q) for q in queries ])
+	inside  = numpy.arange(nK)[None, :] <= (lengths - k)[:, None]
+
+	sPos = lookup[qCodes]
+	hit  = (sPos >= 0) & inside
+	rows, qPos = numpy.nonzero(hit)
+	width = len(subject) + maxQ
+	diags = qPos - sPos[rows, qPos] + len(subject)
+	votes = numpy.bincount(rows * width + diags, minlength=nPairs * width).reshape(nPairs, width)
+	return numpy.where( votes.max(axis=1) > 0, votes.argmax(axis=1) - len(subject), 0 )
+
+
+class GlobalHit:
+	"""
+	summary of one alignment with free end gaps: the core (from the first to
+	   the last column where both sequences are present; 0-based inclusive
+	   coordinates) as a list of ungapped blocks (subject_start,
+	   query_start, length), plus the number of gap columns inside it
+	"""
+
+	__slots__ = ("score", "qstart", "qend", "sstart", "send", "blocks", "gaps")
+
+	def __init__(self, score, qstart, qend, sstart, send, blocks, gaps):
+		self.score  = score
+		self.qstart = qstart
+		self.qend   = qend
+		self.sstart = sstart
+		self.send   = send
+		self.blocks = blocks
+		self.gaps   = gaps
+
+
+def banded_semiglobal_align(queries, subjects, diagonals, band=16, reward=1, penalty=-1, gapopen=5, gapextend=2, nReal=4):
+	"""
+	Global (Gotoh) alignment of a batch of encoded query/subject pairs in which
+	   gaps at either end of either sequence are free, restricted to a band
+	   of +/- band positions around the diagonal query_pos - subject_pos =
+	   diagonals[n] given for each pair. Codes below nReal are real residues;
+	   anything else always scores as a mismatch.
+	Returns a list with a GlobalHit (or None if the band never reaches the
+	   end of either sequence) for each pair.
+	"""
+
+	nPairs = len(queries)
+	if nPairs == 0:
+		return []
+
+	W     = 2 * band + 1
+	kgrid = numpy.arange(W, dtype=numpy.int16)
+	maxS  = max(len(s) for s in subjects)
+	maxQ  = max(len(q) for q in queries)
+
+	# padded code matrices; the query pad always leaves room for position -1
+	pad  = band + max(0, -min(diagonals)) + 1
+	Q    = numpy.empty((nPairs, pad + maxQ + maxS + pad), dtype=numpy.uint8)
+	Q.fill(Q_PAD)
+	S    = numpy.empty((nPairs, maxS), dtype=numpy.uint8)
+	S.fill(S_PAD)
+	for n in range(nPairs):
+		Q[n, pad : pad + len(queries[n])] = queries[n]
+		S[n, :len(subjects[n])] = subjects[n]
+	diag  = numpy.asarray(diagonals, dtype=numpy.int64)
+	qLens = numpy.array([ len(q) for q in queries ], dtype=numpy.int64)
+	sLens = numpy.array([ len(s) for s in subjects ], dtype=numpy.int64)
+
+	# band cell (i, d) holds query position j = i + diag + d - band
+	cols  = (pad + diag - band)[:, None, None] + numpy.arange(maxS)[None, :, None] + kgrid[None, None, :]
+	cols  = numpy.clip(cols, 0, Q.shape[1] - 1)
+	Qband = Q[ numpy.arange(nPairs)[:, None, None], cols ]
+	Sband = S[:, :, None]
+	valid = ((Qband != Q_PAD) & (Sband != S_PAD)).transpose(1, 0, 2).copy()
+	subst = numpy.where((Qband == Sband) & (Sband < nReal), reward, penalty).astype(numpy.int16).transpose(1, 0, 2).copy()
+	del Qband, cols
+	jBase = (diag - band)[:, None] + kgrid[None, :]
+
+	# traceback storage
+	diagStep = numpy.zeros((maxS, nPairs, W), dtype=numpy.bool_)	# True = diagonal, False = vertical gap
+	extE  = numpy.zeros((maxS, nPairs, W), dtype=numpy.bool_)
+	fromF = numpy.zeros((maxS, nPairs, W), dtype=numpy.bool_)
+	srcF  = numpy.zeros((maxS, nPairs, W), dtype=numpy.int16)
+
+	# the row before the first one is free (the subject starts with an end gap)
+	Hprev = numpy.zeros((nPairs, W + 1), dtype=numpy.int16)
+	Eprev = numpy.empty((nPairs, W + 1), dtype=numpy.int16)
+	Eprev.fill(NEG)
+	Hprev[:, W] = NEG
+	F    = numpy.empty((nPairs, W), dtype=numpy.int16)
+	F[:, 0] = NEG
+	srcK = numpy.zeros((nPairs, W), dtype=numpy.int16)
+	openCost = gapopen + gapextend * kgrid[1:]
+	allPairs = numpy.arange(nPairs)
+
+	# best cell in the last row or last query column
+	bestScore = numpy.empty(nPairs, dtype=numpy.int64)
+	bestScore.fill(NEG)
+	bestRow = numpy.zeros(nPairs, dtype=numpy.int64)
+	bestCol = numpy.zeros(nPairs, dtype=numpy.int64)
+	lastCol = (qLens - 1 - diag + band)
+
+	for i in range(maxS):
+		ok = valid[i]
+
+		# vertical gap: (i-1, j) sits at band index d+1 of the previous row
+		openE = Hprev[:, 1:] - (gapopen + gapextend)
+		extdE = Eprev[:, 1:] - gapextend
+		E     = numpy.maximum(openE, extdE)
+		#the first query position can follow any number of free subject positions
+		diagH = numpy.where(jBase + i == 0, 0, Hprev[:, :W]) + subst[i]
+
+		best  = numpy.maximum(diagH, E)
+		Hp    = numpy.where(ok, best, NEG)
+		E     = numpy.where(ok, E, NEG)
+
+		# horizontal gap via a running max: F[d] = max_{k<d}(H'[k] + ge*k) - go - ge*d
+		val    = Hp + gapextend * kgrid
+		acc    = numpy.maximum.accumulate(val, axis=1)
+		argacc = numpy.maximum.accumulate(numpy.where(val >= acc, kgrid, 0), axis=1)
+		F[:, 1:]    = acc[:, :-1] - openCost
+		srcK[:, 1:] = argacc[:, :-1]
+		useF   = ok & (F > Hp)
+		H      = numpy.where(useF, F, Hp)
+
+		diagStep[i] = diagH >= E
+		extE[i]  = extdE >= openE
+		fromF[i] = useF
+		srcF[i]  = srcK
+
+		# ends: the last query position, wherever it falls in this row...
+		d    = lastCol - i
+		inB  = (d >= 0) & (d < W)
+		endV = numpy.where(inB, H[allPairs, numpy.clip(d, 0, W - 1)], NEG)
+		better = endV > bestScore
+		bestScore = numpy.where(better, endV, bestScore)
+		bestRow   = numpy.where(better, i, bestRow)
+		bestCol   = numpy.where(better, d, bestCol)
+		# ...and anywhere in the last row of the subject
+		rowArg = H.argmax(axis=1)
+		rowV   = numpy.where(sLens - 1 == i, H[allPairs, rowArg], NEG)
+		better = rowV > bestScore
+		bestScore = numpy.where(better, rowV, bestScore)
+		bestRow   = numpy.where(better, i, bestRow)
+		bestCol   = numpy.where(better, rowArg, bestCol)
+
+		Hprev[:, :W] = H
+		Eprev[:, :W] = E
+
+	# trace back from the best end of each pair (item() is much cheaper than numpy scalar indexing)
+	stayDiag = diagStep & ~fromF
+	results  = []
+	for n in range(nPairs):
+		if bestScore[n] <= NEG // 2:
+			results.append(None)
+			continue
+
+		i, d   = int(bestRow[n]), int(bestCol[n])
+		offset = int(diag[n]) - band
+		steps, exts, fFlags, fSrc, runs = diagStep[:, n], extE[:, n], fromF[:, n], srcF[:, n], stayDiag[:, n]
+
+		blocks = []
+		run    = 0
+		skipF  = False
+		while i >= 0 and i + offset + d >= 0:
+			if not skipF and fFlags.item(i, d):
+				if run:
+					blocks.append( (i + 1, i + 1 + offset + d, run) )
+					run = 0
+				d = fSrc.item(i, d)
+				skipF = True
+				continue
+			skipF = False
+			if steps.item(i, d):
+				# follow the diagonal down to the first cell that leaves it
+				limit = min(i, i + offset + d)
+				leave = numpy.flatnonzero(~runs[i - limit : i, d][::-1])
+				step  = 1 + (leave[0] if len(leave) else limit)
+				run  += step
+				i    -= step
+			else:
+				if run:
+					blocks.append( (i + 1, i + 1 + offset + d, run) )
+					run = 0
+				while True:
+					ext = exts.item(i, d)
+					i -= 1
+					d += 1
+					if not ext:
+						break
+		if run:
+			blocks.append( (i + 1, i + 1 + offset + d, run) )
+		blocks.reverse()
+		if len(blocks) == 0:
+			results.append(None)
+			continue
+
+		# gaps before the first or after the last aligned position are end gaps
+		startS, startQ = blocks[0][0], blocks[0][1]
+		endS, endQ     = blocks[-1][0] + blocks[-1][2] - 1, blocks[-1][1] + blocks[-1][2] - 1
+		aligned = sum( b[2] for b in blocks )
+		gaps    = (endS - startS + 1 - aligned) + (endQ - startQ + 1 - aligned)
+		results.append( GlobalHit(int(bestScore[n]), startQ, endQ, startS, endS, blocks, gaps) )
+
+	return results
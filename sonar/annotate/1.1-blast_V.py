@@ -15,8 +15,10 @@ This script looks for raw NGS data files in the current folder and parses them
 
 Usage: 1.1-blast-V.py -minl min_len -maxl max_len -locus <H|K|L|KL|HKL|C>
                       [-qual <0|1>] -fasta file1.fa [ -fasta file2.fa ... ]
-		       -lib path/to/library.fa -h -f
+		       -lib path/to/library.fa -h -f -update
 		      [-threads 1 -npf 50000 -cluster -callJ
+		       -engine <blast|native> -noCollapse -pipeline
+		       -cache path/to/cache.db -cacheSize 1024
 		       -jArgs "-lib path/to/custom/j-library.fa]
 
     All options are optional, see below for defaults.
@@ -31,20 +33,58 @@ Usage: 1.1-blast-V.py -minl min_len -maxl max_len -locus <H|K|L|KL|HKL|C>
                 0: noquals/use fasta only / 1: use qual information 
                    Default = 0.
     fasta       File(s) containing the input reads to process. May be specified
-                   multiple times. Default = use all FASTA/FASTQ files (those
-		   with extensions of .fa, .fas, .fst, .fasta, .fna, .fq, or
-		   .fastq) in the root project directory.
+                   multiple times. Files may be gzip (or bgzip) compressed.
+		   Default = use all FASTA/FASTQ files (those with extensions
+		   of .fa, .fas, .fst, .fasta, .fna, .fq, or .fastq, with or
+		   without .gz) in the root project directory.
     lib  	Location of file containing custom library (e.g. for use with
                    non-human genes).
     f 	 	Forcing flag to overwrite existing working directories.
+    update      Flag to re-run in an existing project, keeping the intermediate
+                   files of the earlier run (see 1.3-finalize_assignments.py
+		   -clean). The reads are only split again if the input files
+		   or the splitting settings changed, and only split files
+		   whose reads, germline library or search settings changed
+		   are searched again; the same goes for the J/D/C searches
+		   in 1.2-blast_J.py. Default = False.
     threads     Number of threads to use when running locally. Ignored if 
-                   -cluster is specified. Default = 1.
+                   -cluster is specified. If more than 1, compressed input
+		   files are also decompressed in a background thread while
+		   the reads are split. Default = 1.
     npf         Number of sequences in each split file. Resource requests for 
                    the cluster are calibrated to groups of 50K sequences, and 
 		   cannot be changed. For local usage, Default = 10,000.
     cluster     Flag to indicate that blast jobs should be submitted to the
-                   SGE cluster. Throws an error if presence of a cluster was
-		   not indicated during setup. Default = run locally.
+                   cluster (SGE or Slurm, as set up by setup.sh). The script
+		   keeps running to resubmit jobs that fail and to start 1.2
+		   as soon as all of them are done, so run it with nohup or
+		   in a screen session. Throws an error if presence of a
+		   cluster was not indicated during setup. Default = run
+		   locally.
+    engine      Germline assignment engine to use when running locally. "blast"
+                   runs blastn on each split file; "native" uses SONAR's
+		   built-in k-mer seeded aligner, which avoids starting a
+		   BLAST process per file. Cannot be combined with -cluster.
+		   Passed along to 1.2-blast_J.py. Default = blast.
+    noCollapse  Flag to send every read for germline assignment, instead of
+                   only one copy of each distinct sequence. By default, exact
+		   duplicates are assigned once and 1.3 copies the results
+		   back to every read, which does not change any output.
+    cache       SQLite file holding a persistent cache of germline assignments,
+                   which can be shared between runs and projects. Reads whose
+		   sequence was already assigned against the same library
+		   with the same settings are taken from the cache instead of
+		   being aligned again. Created if it does not exist. Cannot
+		   be combined with -cluster. Passed along to 1.2-blast_J.py.
+		   Default = no cache.
+    cacheSize   Maximum size of the cache in MB; least recently used entries
+                   are dropped beyond this. Default = 1024.
+    pipeline    Flag to hand each split file on to J/D/C assignment as soon
+                   as its V assignment finishes, rather than waiting for all
+		   of them, so that workers do not sit idle between stages.
+		   Implies -callJ (the V assignments are run by 1.2-blast_J.py
+		   in this mode). Cannot be combined with -cluster.
+		   Default = False.
     callJ 	Flag to call 1.2-blast_J.py when done. Default = False.
     jArgs       Optional arguments to be provided to 1.2-blast_j.py. If provided,
                    forces callJ flag to True.
@@ -63,6 +103,7 @@ Copyright (c) 2011-2016 Columbia University and Vaccine Research Center, Nationa
 import sys
 import os
 import time
+import hashlib
 from multiprocessing import Pool
 from functools import partial
 
@@ -76,12 +117,12 @@ except ImportError:
 
 
 # global variables
-total, total_good, f_ind = 0, 0, 1
+total, total_good, total_unique, f_ind = 0, 0, 0, 1
 
 
-def main():
+def split_reads():
 
-	global total, total_good, f_ind, fastaFiles
+	global total, total_good, total_unique, f_ind
 		
 	# open initial output files
 	fasta 	  = open("%s/%s_%03d.fasta"  % (folder_tree.vgene,  prj_name, f_ind), 'w')
@@ -97,17 +138,29 @@ def main():
 	'''
 
 
-	#iterate through sequences in all raw data files
-	if len(fastaFiles)==0: fastaFiles = glob.glob("*.fa") + glob.glob("*.fas") + glob.glob("*.fst") + glob.glob("*.fasta") + glob.glob("*.fna") + glob.glob("*.fq") + glob.glob("*.fastq")
+	#exact duplicates are only assigned once; the last column of the id table
+	#    points each read to the first copy of its sequence (1.3 copies the
+	#    assignment back out to all of them)
+	seen = dict()
 
-	for myseq, myqual, file_name in generate_read_fasta_folder(fastaFiles, use_qual):
+	for seq_id, seq, file_name in generate_reads_folder(fastaFiles, background=numThreads>1):
 
 		total += 1
-		id_map.writerow([ "%08d"%total, file_name, myseq.seq_id, myseq.seq_len])
+		seq_len = len(seq)
+
+		if not min_len <= seq_len <= max_len:
+			id_map.writerow([ "%08d"%total, file_name, seq_id, seq_len, "NA"])
+			continue
 
-		if min_len <= myseq.seq_len <= max_len:
-			total_good += 1
-			fasta.write(">%08d\n%s\n" % (total, myseq.seq))
+		total_good += 1
+		rep = "%08d" % total
+		if collapse:
+			rep = seen.setdefault( hashlib.md5(seq).digest(), rep )
+		id_map.writerow([ "%08d"%total, file_name, seq_id, seq_len, rep])
+
+		if rep == "%08d" % total:
+			total_unique += 1
+			fasta.write(">%08d\n%s\n" % (total, seq))
 
 			#uncomment to re-implement quals
 			'''
@@ -117,12 +170,12 @@ def main():
 				qual.write(">%08d\n%s\n" % (total, " ".join(map(str, myqual.qual_list))))
 			'''
 
-			if total_good % npf == 0: 
+			if total_unique % npf == 0: 
 				#close old output files, open new ones, and print progress message
 				fasta.close()
 				f_ind += 1
 				fasta = open("%s/%s_%03d.fasta" % (folder_tree.vgene, prj_name, f_ind), 'w')
-				print "%d processed, %d good; starting file %s_%03d" %(total, total_good, prj_name, f_ind)
+				print "%d processed, %d good, %d unique; starting file %s_%03d" %(total, total_good, total_unique, prj_name, f_ind)
 
 				'''
 				if use_qual == 1:
@@ -130,7 +183,7 @@ def main():
 					qual = open("%s/%s_%03d.qual"%(folder_tree.vgene, prj_name, f_ind), 'w')
 				'''
 				
-	print "TOTAL: %d processed, %d good" %(total, total_good)
+	print "TOTAL: %d processed, %d good, %d unique" %(total, total_good, total_unique)
 	
 	fasta.close()
         id_handle.close()
@@ -141,36 +194,73 @@ def main():
 
 	#print log message
 	handle = open("%s/1-split.log" % folder_tree.logs, "w")
-	handle.write("total: %d; good: %d; percentile: %f\n" %(total, total_good, float(total_good)/total * 100))
+	handle.write("total: %d; good: %d; percentile: %f; unique: %d\n" %(total, total_good, float(total_good)/total * 100, total_unique))
 	handle.close()
+
+	#with -update, split files (and their results) left over from a bigger earlier run have to go
+	remove_chunks("%s/%s_%%03d.fasta" % (folder_tree.vgene, prj_name), f_ind+1)
+	remove_chunks("%s/%s_%%03d.txt"   % (folder_tree.vgene, prj_name), f_ind+1)
+	
+
+
+def main():
+
+	global f_ind, fastaFiles
+
+	#iterate through sequences in all raw data files
+	if len(fastaFiles)==0: fastaFiles = [ f for ext in ["fa", "fas", "fst", "fasta", "fna", "fq", "fastq"] for f in glob.glob("*.%s"%ext) + glob.glob("*.%s.gz"%ext) ]
+
+	#the split files are only rewritten if the reads or the settings have changed
+	manifest  = Manifest(folder_tree)
+	split_sig = signature(fastaFiles, "split", fastaFiles, min_len, max_len, npf, collapse)
+	if update and manifest.current("split", split_sig):
+		f_ind = 0
+		while os.path.isfile("%s/%s_%03d.fasta" % (folder_tree.vgene, prj_name, f_ind+1)):
+			f_ind += 1
+		print "Input reads have not changed, using the existing %d split files..." % f_ind
+	else:
+		split_reads()
+		manifest.record("split", split_sig, [ "%s/id_lookup.txt" % folder_tree.internal ] + [ "%s/%s_%03d.fasta" % (folder_tree.vgene, prj_name, ind) for ind in range(1, f_ind+1) ])
+		manifest.save()
 	
 
 	#run BLAST
 	if useCluster:
 
-		# write pbs files and auto submit shell script
-		command = "NUM=`printf \"%s\" $SGE_TASK_ID`\n%s" % ( "%03d", CMD_BLAST % (cluster_blast, library, 
-									      "%s/%s_$NUM.fasta" % (folder_tree.vgene, prj_name),
-									      "%s/%s_$NUM.txt"   % (folder_tree.vgene, prj_name), V_BLAST_WORD_SIZE) )
-		pbs = open("%s/vblast.sh"%folder_tree.vgene, 'w')
-		pbs.write( PBS_STRING%("vBlast-%s"%prj_name, "2G", "2:00:00", "%s 2> %s/%s_$NUM.err"%(command, folder_tree.vgene, prj_name)) )
-		pbs.close()
-		os.system( "%s -t 1-%d %s/vblast.sh"%(qsub,f_ind,folder_tree.vgene) )
-		
-		check = "%s/utilities/checkClusterBlast.py -gene v -big %d -check %s/vmonitor.sh" % (SCRIPT_FOLDER, f_ind, folder_tree.vgene)
+		#one BLAST job per split file, resubmitted if it fails; 1.2 is started
+		#    from here (it submits its own jobs) once all of them are done,
+		#    since it reads the V results of every split file in one pass
+		#    (for the V gene counts and the trimmed reads of each chunk).
+		#    Split files whose results are still current are left out.
+		graph = TaskGraph("%s/tasks" % folder_tree.vgene, get_cluster_backend(numThreads), prefix=prj_name)
+		vblast, searches = [], []
+		for ind in range(1, f_ind+1):
+			chunk = "%s/%s_%03d" % (folder_tree.vgene, prj_name, ind)
+			sig   = search_signature(chunk+".fasta", library, "blast", V_BLAST_WORD_SIZE)
+			if manifest.current("vgene_%03d" % ind, sig):
+				continue
+			vblast.append( graph.add( "vblast_%03d" % ind, "%s 2> %s.err" % (CMD_BLAST % (cluster_blast, library, chunk+".fasta", chunk+".txt", V_BLAST_WORD_SIZE), chunk),
+						  outputs=[chunk+".txt"], mem="2G", time="2:00:00" ) )
+			searches.append( ("vgene_%03d" % ind, sig, chunk+".txt") )
 		if callJ:
-			check += " -after '%s/annotate/1.2-blast_J.py %s'" % (SCRIPT_FOLDER, jArgs)
-			monitor = open("%s/vmonitor.sh"%folder_tree.vgene, 'w')
-			monitor.write( PBS_STRING%("vMonitor-%s"%prj_name, "2G", "1:00:00", "#$ -hold_jid vBlast-%s\n%s >> %s/qmonitor.log 2>&1"%(prj_name, check, folder_tree.logs)) )
-			monitor.close()
-			os.system( "%s %s/vmonitor.sh"%(qsub,folder_tree.vgene) )
+			graph.add( "blast_J", "%s/annotate/1.2-blast_J.py %s" % (SCRIPT_FOLDER, jArgs), after=vblast, local=True, retries=0 )
+
+		success = graph.run()
+		manifest.record_searches( [ search for search, task in zip(searches, vblast) if task.status == "done" ] )
+		if not success:
+			sys.exit("Some cluster jobs did not finish successfully; see %s/tasks for the job scripts" % folder_tree.vgene)
 
 	else:
 
-		#run locally
-		partial_blast = partial( blastProcess, filebase="%s/%s_%%03d.fasta"%(folder_tree.vgene, prj_name), db=library, outbase="%s/%s_%%03d.txt"%(folder_tree.vgene, prj_name), wordSize= V_BLAST_WORD_SIZE)
+		#run locally (with -pipeline, 1.2 runs the V assignments along with the rest)
+		if callJ and pipeline:
+			os.system( "%s/annotate/1.2-blast_J.py %s" % (SCRIPT_FOLDER, jArgs) )
+			return
+
+		partial_blast = partial( run_search, manifest=manifest, process=get_assign_process(engine, cacheFile, cacheSize), engine=engine, name="vgene",
+					 filebase="%s/%s_%%03d.fasta"%(folder_tree.vgene, prj_name), db=library, outbase="%s/%s_%%03d.txt"%(folder_tree.vgene, prj_name), wordSize= V_BLAST_WORD_SIZE)
 		blast_pool = Pool(numThreads)
-		blast_pool.map(partial_blast, range(1,f_ind+1))
+		manifest.record_searches( blast_pool.map(partial_blast, range(1,f_ind+1)) )
 		blast_pool.close()
 		blast_pool.join()
 
@@ -199,6 +289,12 @@ if __name__ == '__main__':
 		sys.argv.remove(flag[0])
 		force = True
 
+	#check whether to reuse the results of an earlier run
+	update = False
+	if q("-update"):
+		sys.argv.remove("-update")
+		update = True
+
 	#check cluster usage
 	useCluster = False
 	if q("-cluster"):
@@ -207,6 +303,18 @@ if __name__ == '__main__':
 		if not clusterExists:
 			sys.exit("Cannot submit jobs to non-existent cluster! Please re-run setup.sh to add support for a cluster\n")
 
+	#check whether to collapse identical reads
+	collapse = True
+	if q("-noCollapse"):
+		sys.argv.remove("-noCollapse")
+		collapse = False
+
+	#check whether to pipeline V and J assignment
+	pipeline = False
+	if q("-pipeline"):
+		sys.argv.remove("-pipeline")
+		pipeline = True
+
 	#check if call J
 	callJ = False
 	if q("-callJ"):
@@ -214,9 +322,26 @@ if __name__ == '__main__':
 		callJ = True
 
 	# get parameters from input
-	dict_args = processParas(sys.argv, minl="min_len", maxl="max_len", locus="locus", qual="use_qual", lib="library", threads = "numThreads", jArgs="jArgs", npf="npf", fasta="fastaFiles")
-	defaultParams = dict(min_len=300, max_len=600, use_qual=0, locus='H', library="", numThreads=1, jArgs="", npf=10000, fastaFiles=[])
-	min_len, max_len, locus, use_qual, library, numThreads, jArgs, npf, fastaFiles = getParasWithDefaults(dict_args, defaultParams, "min_len", "max_len", "locus", "use_qual", "library", "numThreads", "jArgs", "npf", "fastaFiles")
+	dict_args = processParas(sys.argv, minl="min_len", maxl="max_len", locus="locus", qual="use_qual", lib="library", threads = "numThreads", jArgs="jArgs", npf="npf", fasta="fastaFiles", engine="engine", cache="cacheFile", cacheSize="cacheSize")
+	defaultParams = dict(min_len=300, max_len=600, use_qual=0, locus='H', library="", numThreads=1, jArgs="", npf=10000, fastaFiles=[], engine="blast", cacheFile="", cacheSize=1024)
+	min_len, max_len, locus, use_qual, library, numThreads, jArgs, npf, fastaFiles, engine, cacheFile, cacheSize = getParasWithDefaults(dict_args, defaultParams, "min_len", "max_len", "locus", "use_qual", "library", "numThreads", "jArgs", "npf", "fastaFiles", "engine", "cacheFile", "cacheSize")
+
+	if engine not in ASSIGN_ENGINES:
+		sys.exit("Unknown engine %s (options are %s)\n" % (engine, ", ".join(sorted(ASSIGN_ENGINES.keys()))))
+	if useCluster and engine != "blast":
+		sys.exit("The %s engine only runs locally; please use -engine blast with -cluster\n" % engine)
+	if engine != "blast" and not re.search("-engine", jArgs):
+		jArgs += " -engine %s" % engine
+	if useCluster and pipeline:
+		sys.exit("Pipelined assignment is only available when running locally\n")
+	if pipeline and not re.search("-pipeline", jArgs):
+		jArgs += " -pipeline"
+		if not re.search("-threads", jArgs):
+			jArgs += " -threads %d" % numThreads
+	if useCluster and cacheFile != "":
+		sys.exit("The annotation cache is only available when running locally\n")
+	if cacheFile != "" and not re.search("-cache ", jArgs):
+		jArgs += " -cache %s -cacheSize %s" % (os.path.abspath(cacheFile), cacheSize)
 
 	if not jArgs == "":
 		callJ = True
@@ -229,7 +354,7 @@ if __name__ == '__main__':
 
 	# create 1st and 2nd subfolders
 	prj_folder  = os.getcwd()
-	folder_tree = create_folders( prj_folder, force=force )
+	folder_tree = create_folders( prj_folder, force=force, update=update )
 	prj_name    = prj_folder[prj_folder.rindex("/") + 1 :]
 
 	#log command line
@@ -9,10 +9,16 @@ This script parses the BLAST output from 1.1-blast-V_assignment.py. For reads
       of the J gene. Will also try to assign the D gene if relevant and the 
       constant region class. 
 
+      Searches whose results from an earlier run are still current (same
+      reads, germline library and settings, see 1.1-blast_V.py -update)
+      are not repeated.
+
 Usage: 1.2-blast-J.py -lib  path/to/j-library.fa
                       -dlib path/to/d-library.fa
 		      -clib path/to/c-library.fa
 		      -threads 1 -cluster
+		      -engine <blast|native> -pipeline
+		      -cache path/to/cache.db -cacheSize 1024
 		      -noD -noC
 		      -callFinal -h
 
@@ -29,8 +35,25 @@ Usage: 1.2-blast-J.py -lib  path/to/j-library.fa
     threads     Number of threads to use when running locally. Ignored if 
                    -cluster is specified. Default = 1.
     cluster     Flag to indicate that blast jobs should be submitted to the
-                   SGE cluster. Throws an error if presence of a cluster was
-		   not indicated during setup. Default = run locally.
+                   cluster (SGE or Slurm, as set up by setup.sh). The script
+		   keeps running to resubmit jobs that fail and to submit 1.3
+		   (with -callFinal) as soon as all of them are done. Throws
+		   an error if presence of a cluster was not indicated during
+		   setup. Default = run locally.
+    engine      Germline assignment engine to use when running locally. "blast"
+                   runs blastn on each split file; "native" uses SONAR's
+		   built-in k-mer seeded aligner. Cannot be combined with
+		   -cluster. Default = blast.
+    cache       SQLite file holding a persistent cache of germline assignments
+                   (see 1.1-blast_V.py). Cannot be combined with -cluster.
+		   Default = no cache.
+    cacheSize   Maximum size of the cache in MB. Default = 1024.
+    pipeline    Flag to also run V assignment here, one chunk at a time: as
+                   soon as a chunk has its V assignments it is trimmed and
+		   sent for J/D/C assignment, while other workers carry on
+		   with the remaining chunks. Normally set by 1.1-blast_V.py
+		   -pipeline rather than directly. Cannot be combined with
+		   -cluster. Default = False.
     noD         Flag to indicate that no blast jobs should be submitted for a
                    D gene library. Default = False (do D gene blast) unless a 
 		   light chain library is specified.
@@ -53,7 +76,8 @@ Copyright (c) 2011-2016 Columbia University and Vaccine Research Center, Nationa
 
 """
 
-import sys, os, time
+import sys, os, time, itertools
+from cStringIO import StringIO
 from multiprocessing import Pool
 from functools import partial
 
@@ -65,6 +89,90 @@ except ImportError:
 	from sonar.annotate import *
 
 
+def trim_chunk(f_ind):
+
+	"""
+	cut each read in one chunk down to the part 3' of its V gene and save it
+	   for the J/D/C searches; returns the top hit table rows, V gene counts and
+	   read totals for the chunk (weighted by copy number)
+	"""
+
+	tophits = StringIO()
+	dict_germ_aln, dict_other_germs, dict_germ_count = get_top_hits( "%s/%s_%03d.txt" % (prj_tree.vgene, prj_name, f_ind), topHitWriter=csv.writer(tophits, delimiter=sep), dict_germ_count=dict() )
+
+	#identical reads were collapsed by 1.1, so weight each unique read by its copy number
+	germ_count = Counter(dict_germ_count)
+	for read_id in dict_germ_aln:
+		if read_id in dups:
+			germ_count[dict_germ_aln[read_id].sid] += dups[read_id]
+
+	total, good  = 0, 0
+	fasta_handle = open("%s/%s_%03d.fasta" %(prj_tree.jgene, prj_name, f_ind), "w")
+	for entry in SeqIO.parse("%s/%s_%03d.fasta" % (prj_tree.vgene, prj_name, f_ind), "fasta"):
+
+		total += 1 + dups[entry.id]
+		if entry.id in dict_germ_aln:
+			if dict_germ_aln[entry.id].strand == "plus":
+				entry.seq = entry.seq[ dict_germ_aln[entry.id].qend : ]
+			else:
+				entry.seq = entry.seq[ : dict_germ_aln[entry.id].qstart -1 ]
+				entry.seq = entry.reverse_complement().seq
+
+			if len(entry.seq) > 30: #can probably be 50...
+				fasta_handle.write(">%s\n%s\n" % (entry.id,entry.seq))
+				good += 1 + dups[entry.id]
+
+	fasta_handle.close()
+
+	return tophits.getvalue(), germ_count, total, good
+
+
+def jdc_searches():
+
+	"""
+	the local J (and C and D, if relevant) assignment runs, as functions of the
+	   chunk number; searches whose results are still current are skipped
+	"""
+
+	process  = partial( run_search, manifest=manifest, process=get_assign_process(engine, cacheFile, cacheSize), engine=engine,
+			    filebase="%s/%s_%%03d.fasta"%(prj_tree.jgene, prj_name), wordSize=J_BLAST_WORD_SIZE )
+	searches = [ partial( process, name="jgene", db=library, outbase="%s/%s_%%03d.txt"%(prj_tree.jgene, prj_name), hits=3) ]
+	if os.path.isfile(const_lib):
+		searches.append( partial( process, name="cgene", db=const_lib, outbase="%s/%s_C_%%03d.txt"%(prj_tree.jgene, prj_name), hits=3, constant=True) )
+	if os.path.isfile(dlib):
+		searches.append( partial( process, name="dgene", db=dlib, outbase="%s/%s_D_%%03d.txt"%(prj_tree.jgene, prj_name)) )
+	return searches
+
+
+def pipeline_chunk(f_ind):
+
+	"""
+	V assignment, 5' trimming and J/D/C assignment of a single chunk (for
+	   -pipeline), then, with -callFinal, its final assignments (saved by
+	   1.3 for the merge at the end); also returns the searches that were
+	   run, for the manifest
+	"""
+
+	#never leave the shard of an earlier run for 1.3 to merge
+	shard = "%s/%s_%03d.shard" % (prj_tree.jgene, prj_name, f_ind)
+	if os.path.isfile(shard):
+		os.remove(shard)
+
+	done = [ run_search( f_ind, manifest, get_assign_process(engine, cacheFile, cacheSize), engine, "vgene", filebase="%s/%s_%%03d.fasta"%(prj_tree.vgene, prj_name),
+			     db=vlib, outbase="%s/%s_%%03d.txt"%(prj_tree.vgene, prj_name), wordSize=V_BLAST_WORD_SIZE ) ]
+
+	summary = trim_chunk(f_ind)
+
+	for search in jdc_searches():
+		done.append( search(f_ind) )
+
+	if callF:
+		with open(os.devnull, "w") as null:
+			subprocess.call( [ sys.executable, "%s/annotate/1.3-finalize_assignments.py" % SCRIPT_FOLDER, "-chunk", str(f_ind) ], stdout=null )
+
+	return summary + (done,)
+
+
 def main():
 	
         if not glob.glob("%s/%s_*.fasta" % (prj_tree.vgene, prj_name)):
@@ -73,44 +181,50 @@ def main():
 	print "curating 5'end and strand...."
 
 	# cut nucleotide sequences from 5'end alignment to germline
-	total, good, f_ind = 0, 0, 1
-	dict_germ_count	= dict()
+	total, good = 0, 0
+	dict_germ_count	= Counter()
+
+	chunks = []
+	while os.path.isfile("%s/%s_%03d.fasta" % (prj_tree.vgene, prj_name, len(chunks)+1)):
+		chunks.append(len(chunks)+1)
+	f_ind = len(chunks)
+
+	#remove trimmed reads and J/D/C results that are left over from an earlier run with more
+	#    split files, or for a library that is no longer being searched (before any
+	#    chunk is finalized with -pipeline)
+	for tag, lib in [ ("", library), ("C_", const_lib), ("D_", dlib) ]:
+		remove_chunks("%s/%s_%s%%03d.txt" % (prj_tree.jgene, prj_name, tag), f_ind+1 if os.path.isfile(lib) else 1)
+	remove_chunks("%s/%s_%%03d.fasta" % (prj_tree.jgene, prj_name), f_ind+1)
+
+	#with -pipeline, each chunk goes through V, trimming and J/D/C as soon as a
+	#    worker is free, instead of waiting for every chunk to finish each stage
+	if pipeline:
+		pipe_pool = Pool(numThreads)
+		summaries = pipe_pool.imap(pipeline_chunk, chunks)
+	else:
+		summaries = itertools.imap(lambda ind: trim_chunk(ind) + ([],), chunks)
 	
         topHandle = open("%s/%s_vgerm_tophit.txt" %(prj_tree.tables, prj_name), "w")
 	writer    = csv.writer(topHandle, delimiter = sep)
 	writer.writerow(PARSED_BLAST_HEADER)
 	
-	while os.path.isfile("%s/%s_%03d.fasta" % (prj_tree.vgene, prj_name, f_ind)):
-
-		split_fasta = "%s/%s_%03d.fasta" %(prj_tree.jgene, prj_name, f_ind)
-		fasta_handle = open(split_fasta, "w")
-
-		# parse blast output
-		dict_germ_aln, dict_other_germs, dict_germ_count = get_top_hits( "%s/%s_%03d.txt" % (prj_tree.vgene, prj_name, f_ind), topHitWriter=writer, dict_germ_count=dict_germ_count )
-	
-		# process each sequence
-		for entry in SeqIO.parse("%s/%s_%03d.fasta" % (prj_tree.vgene, prj_name, f_ind), "fasta"):
-
-			total += 1
-			if entry.id in dict_germ_aln:
-				if dict_germ_aln[entry.id].strand == "plus":
-					entry.seq = entry.seq[ dict_germ_aln[entry.id].qend : ]
-				else:
-					entry.seq = entry.seq[ : dict_germ_aln[entry.id].qstart -1 ]
-					entry.seq = entry.reverse_complement().seq
-
-				if len(entry.seq) > 30: #can probably be 50...
-					fasta_handle.write(">%s\n%s\n" % (entry.id,entry.seq))
-					good += 1
-
-		fasta_handle.close()
-		f_ind += 1
+	searches = []
+	for hits, chunk_counts, chunk_total, chunk_good, chunk_searches in summaries:
+
+		topHandle.write(hits)
+		dict_germ_count.update(chunk_counts)
+		total += chunk_total
+		good  += chunk_good
+		searches += chunk_searches
 		
 		print "%d done, %d good..." %(total, good)
 
-
-	f_ind -= 1 #had to go 1 extra to break while loop, now reset to actual number of files
         topHandle.close()
+
+	if pipeline:
+		pipe_pool.close()
+		pipe_pool.join()
+		manifest.record_searches(searches)
         
 
 	#print log message
@@ -133,79 +247,52 @@ def main():
 	#run BLAST
 	if useCluster:
 
-		# write pbs files and auto submit shell script
-		if os.path.isfile(const_lib):
-			command = "NUM=`printf \"%s\" $SGE_TASK_ID`\n%s -perc_identity 100" % ( "%03d", CMD_BLAST % (cluster_blast, const_lib, 
-									      "%s/%s_$NUM.fasta" % (prj_tree.jgene, prj_name),
-									      "%s/%s_C_$NUM.txt"   % (prj_tree.jgene, prj_name), J_BLAST_WORD_SIZE) )
-			pbs = open("%s/cblast.sh"%prj_tree.jgene, 'w')
-			pbs.write( PBS_STRING%("cBlast-%s"%prj_name, "2G", "1:00:00", "%s 2> %s/%s_C_$NUM.err"%(command, prj_tree.jgene, prj_name)) )
-			pbs.close()
-			os.system("%s -t 1-%d %s/cblast.sh"%(qsub,f_ind,prj_tree.jgene))
-
-			check = "%s/utilities/checkClusterBlast.py -gene c -big %d -check %s/cmonitor.sh -rehold jMonitor%s" % (SCRIPT_FOLDER, f_ind, prj_tree.jgene, prj_name)
-			monitor = open("%s/cmonitor.sh"%prj_tree.jgene, 'w')
-			monitor.write( PBS_STRING%("cMonitor-%s"%prj_name, "2G", "0:30:00", "#$ -hold_jid cBlast-%s\n%s >> %s/qmonitor.log 2>&1"%(prj_name, check, prj_tree.logs)))
-			monitor.close()
-			os.system( "%s %s/cmonitor.sh"%(qsub,prj_tree.jgene) )
+		#J, C and D searches of each split file are separate jobs; 1.3 is
+		#    submitted as soon as all of them have finished
+		graph = TaskGraph("%s/tasks" % prj_tree.jgene, get_cluster_backend(numThreads), prefix=prj_name)
 
+		#gene, library, output file tag, extra blast options, time limit
+		libraries = [ ("j", library, "", "", "2:00:00") ]
+		if os.path.isfile(const_lib):
+			libraries.append( ("c", const_lib, "C_", " -perc_identity 100", "1:00:00") )
 		if os.path.isfile(dlib):
-			command = "NUM=`printf \"%s\" $SGE_TASK_ID`\n%s" % ( "%03d", CMD_BLAST % (cluster_blast, dlib, 
-									      "%s/%s_$NUM.fasta" % (prj_tree.jgene, prj_name),
-									      "%s/%s_D_$NUM.txt"   % (prj_tree.jgene, prj_name), J_BLAST_WORD_SIZE) )
-			pbs = open("%s/dblast.sh"%prj_tree.jgene, 'w')
-			pbs.write( PBS_STRING%("dBlast-%s"%prj_name, "2G", "1:00:00", "%s 2> %s/%s_D_$NUM.err"%(command, prj_tree.jgene, prj_name)) )
-			pbs.close()
-			os.system("%s -t 1-%d %s/dblast.sh"%(qsub,f_ind,prj_tree.jgene))
-
-			check = "%s/utilities/checkClusterBlast.py -gene d -big %d -check %s/dmonitor.sh -rehold jMonitor%s" % (SCRIPT_FOLDER, f_ind, prj_tree.jgene, prj_name)
-			monitor = open("%s/dmonitor.sh"%prj_tree.jgene, 'w')
-			monitor.write( PBS_STRING%("dMonitor-%s"%prj_name, "2G", "2:00:00", "#$ -hold_jid dBlast-%s\n%s >> %s/qmonitor.log 2>&1"%(prj_name, check, prj_tree.logs)))
-			monitor.close()
-			os.system( "%s %s/dmonitor.sh"%(qsub,prj_tree.jgene) )
-
-		#now basic J (do last so the holds work properly -at least for the first round)
-		command = "NUM=`printf \"%s\" $SGE_TASK_ID`\n%s" % ( "%03d", CMD_BLAST % (cluster_blast, library, 
-									      "%s/%s_$NUM.fasta" % (prj_tree.jgene, prj_name),
-									      "%s/%s_$NUM.txt"   % (prj_tree.jgene, prj_name), J_BLAST_WORD_SIZE) )
-		pbs = open("%s/jblast.sh"%prj_tree.jgene, 'w')
-		pbs.write( PBS_STRING%("jBlast-%s"%prj_name, "2G", "2:00:00", "%s 2> %s/%s_$NUM.err"%(command, prj_tree.jgene, prj_name)) )
-		pbs.close()
-		os.system("%s -t 1-%d %s/jblast.sh"%(qsub, f_ind,prj_tree.jgene))
-
-		check = "%s/utilities/checkClusterBlast.py -gene j -big %d -check %s/jmonitor.sh" % (SCRIPT_FOLDER, f_ind, prj_tree.jgene)
-		if callF:
-			check += " -after %s/annotate/1.3-finalize_assignments.py" % SCRIPT_FOLDER
-		monitor = open("%s/jmonitor.sh"%prj_tree.jgene, 'w')
-		monitor.write( PBS_STRING%("jMonitor-%s"%prj_name, "2G", "0:30:00", "#$ -hold_jid jBlast-%s,cMonitor-%s,dMonitor-%s\n%s >> %s/qmonitor.log 2>&1"%(prj_name, prj_name, prj_name, check, prj_tree.logs))) #wait for C and D to finish before calling 1.3 (if relevant)
-		monitor.close()
-		os.system( "%s %s/jmonitor.sh"%(qsub,prj_tree.jgene) )
+			libraries.append( ("d", dlib, "D_", "", "1:00:00") )
+
+		#searches whose results are still current are left out
+		tasks, searches = [], []
+		for ind in range(1, f_ind+1):
+			chunk = "%s/%s_%03d.fasta" % (prj_tree.jgene, prj_name, ind)
+			for gene, lib, tag, options, limit in libraries:
+				out = "%s/%s_%s%03d" % (prj_tree.jgene, prj_name, tag, ind)
+				sig = search_signature(chunk, lib, "blast", J_BLAST_WORD_SIZE, constant=(gene=="c"))
+				if manifest.current("%sgene_%03d" % (gene, ind), sig):
+					continue
+				tasks.append( graph.add( "%sblast_%03d" % (gene, ind), "%s%s 2> %s.err" % (CMD_BLAST % (cluster_blast, lib, chunk, out+".txt", J_BLAST_WORD_SIZE), options, out),
+							 outputs=[out+".txt"], mem="2G", time=limit ) )
+				searches.append( ("%sgene_%03d" % (gene, ind), sig, out+".txt") )
 
-	else:
+		if callF:
+			graph.add( "finalize", "%s/annotate/1.3-finalize_assignments.py >> %s/qmonitor.log 2>&1" % (SCRIPT_FOLDER, prj_tree.logs),
+				   after=tasks, mem="4G", time="4:00:00", retries=0 )
 
-		#run locally
-                partial_blast = partial( blastProcess, filebase="%s/%s_%%03d.fasta"%(prj_tree.jgene, prj_name), db=library, outbase="%s/%s_%%03d.txt"%(prj_tree.jgene, prj_name), wordSize=J_BLAST_WORD_SIZE, hits=3)
-                blast_pool = Pool(numThreads)
-                blast_pool.map(partial_blast, range(1,f_ind+1))
-                blast_pool.close()
-                blast_pool.join()
+		success = graph.run()
+		manifest.record_searches( [ search for search, task in zip(searches, tasks) if task.status == "done" ] )
+		if not success:
+			sys.exit("Some cluster jobs did not finish successfully; see %s/tasks for the job scripts" % prj_tree.jgene)
 
-		if os.path.isfile(const_lib):
-			partial_blast = partial( blastProcess, filebase="%s/%s_%%03d.fasta"%(prj_tree.jgene, prj_name), db=const_lib, outbase="%s/%s_C_%%03d.txt"%(prj_tree.jgene, prj_name), wordSize=J_BLAST_WORD_SIZE, hits=3, constant=True)
-			blast_pool = Pool(numThreads)
-			blast_pool.map(partial_blast, range(1,f_ind+1))
-			blast_pool.close()
-			blast_pool.join()
+	else:
 
-		if os.path.isfile(dlib):
-			partial_blast = partial( blastProcess, filebase="%s/%s_%%03d.fasta"%(prj_tree.jgene, prj_name), db=dlib, outbase="%s/%s_D_%%03d.txt"%(prj_tree.jgene, prj_name), wordSize=J_BLAST_WORD_SIZE)
-			blast_pool = Pool(numThreads)
-			blast_pool.map(partial_blast, range(1,f_ind+1))
-			blast_pool.close()
-			blast_pool.join()
+		#run locally (already done chunk by chunk with -pipeline)
+		if not pipeline:
+			for search in jdc_searches():
+				blast_pool = Pool(numThreads)
+				manifest.record_searches( blast_pool.map(search, range(1,f_ind+1)) )
+				blast_pool.close()
+				blast_pool.join()
 
+		#with -pipeline, 1.3 only has to merge the chunks finalized above
 		if callF:
-			os.system( "%s/annotate/1.3-finalize_assignments.py" % SCRIPT_FOLDER )
+			os.system( "%s/annotate/1.3-finalize_assignments.py -threads %d%s" % (SCRIPT_FOLDER, numThreads, " -merge" if pipeline else "") )
 
 
 
@@ -235,6 +322,12 @@ if __name__ == '__main__':
                 sys.argv.remove("-callFinal")
                 callF = True
 
+	#check whether V assignment still needs to be done
+	pipeline = False
+	if q("-pipeline"):
+		sys.argv.remove("-pipeline")
+		pipeline = True
+
         #check if blast D
         blastD = True
         if q("-noD"):
@@ -248,8 +341,17 @@ if __name__ == '__main__':
                 blastC = False
 
 	#get parameters from input
-	dict_args = processParas(sys.argv, lib="library", dlib="dlib", clib="const_lib", threads = "numThreads")
-	library, dlib, const_lib, numThreads = getParasWithDefaults(dict_args, dict(library="", dlib="", const_lib="", numThreads=1), "library", "dlib", "const_lib", "numThreads")
+	dict_args = processParas(sys.argv, lib="library", dlib="dlib", clib="const_lib", threads = "numThreads", engine="engine", cache="cacheFile", cacheSize="cacheSize")
+	library, dlib, const_lib, numThreads, engine, cacheFile, cacheSize = getParasWithDefaults(dict_args, dict(library="", dlib="", const_lib="", numThreads=1, engine="blast", cacheFile="", cacheSize=1024), "library", "dlib", "const_lib", "numThreads", "engine", "cacheFile", "cacheSize")
+
+	if engine not in ASSIGN_ENGINES:
+		sys.exit("Unknown engine %s (options are %s)\n" % (engine, ", ".join(sorted(ASSIGN_ENGINES.keys()))))
+	if useCluster and engine != "blast":
+		sys.exit("The %s engine only runs locally; please use -engine blast with -cluster\n" % engine)
+	if useCluster and cacheFile != "":
+		sys.exit("The annotation cache is only available when running locally\n")
+	if useCluster and pipeline:
+		sys.exit("Pipelined assignment is only available when running locally\n")
 
 	
 	prj_tree        = ProjectFolders(os.getcwd())
@@ -257,8 +359,10 @@ if __name__ == '__main__':
 
 
 	#load saved locus information
-	handle = open( "%s/gene_locus.txt" % prj_tree.internal, "a+")
+	handle = open( "%s/gene_locus.txt" % prj_tree.internal, "rU")
 	locus = handle.readline().strip()
+	vlib  = handle.readline().strip()
+	handle.close()
 
 	# we'll keep custom libraries even for a default locus (maybe someone wants to use an updated set of D alleles?)
 	if not os.path.isfile(library):
@@ -271,11 +375,19 @@ if __name__ == '__main__':
 		if blastD and not os.path.isfile(dlib)     : dlib      = DH_DB
 		if blastC and not os.path.isfile(const_lib): const_lib = CH_DB
 
-	# save J/D/C library locations for next step
+	# save J/D/C library locations for next step (replacing those of any earlier run)
+	handle = open( "%s/gene_locus.txt" % prj_tree.internal, "w")
+	handle.write("%s\n%s\n" % (locus, vlib))
 	handle.write("%s\n" % library)
 	handle.write("%s\n" % dlib)
 	handle.write("%s\n" % const_lib)
 	handle.close()
 
+	#identical reads were collapsed by 1.1, so weight each unique read by its copy number
+	dups = load_duplicate_counts("%s/id_lookup.txt" % prj_tree.internal)
+
+	#searches whose results from an earlier run are still current are not repeated
+	manifest = Manifest(prj_tree)
+
 	main()
 
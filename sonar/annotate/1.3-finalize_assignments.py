@@ -8,7 +8,8 @@ This script parses the BLAST output from 1.1-blast-V_assignment.py and
       output into fasta files and a master table is created summarizing the
       properties of all input sequences.
 
-Usage:  1.3-finalize_assignments.py [ -h -jmotif "TT[C|T][G|A]G" ]
+Usage:  1.3-finalize_assignments.py [ -h -jmotif "TT[C|T][G|A]G" -threads 1 -clean
+                                      -chunk 1 -merge ]
 
     Invoke with -h or --help to print this documentation.
 
@@ -19,6 +20,25 @@ Usage:  1.3-finalize_assignments.py [ -h -jmotif "TT[C|T][G|A]G" ]
 		TT[C|T][G|A]G for light chains; set manually for species
 		which may have a different motif.
 
+    threads - Number of processes to use. Each chunk of reads from 1.1 is
+                finalized separately and the results are merged back in order,
+		so the output does not depend on this setting. Default = 1.
+
+    chunk - Only finalize the given chunk of reads, saving the results for a
+                later run with -merge. Used by 1.2-blast_J.py -pipeline, to
+		finalize each chunk as soon as its J/D/C assignments are done.
+
+    merge - Flag to use the results of chunks that were already finalized
+                with -chunk (any others are finalized as usual). Set by
+		1.2-blast_J.py -pipeline -callFinal.
+
+    clean - Flag to delete the intermediate files (the split reads and the
+                results of the germline searches) when done. By default they
+		are kept, so that this script can be re-run with different
+		settings, and 1.1-blast_V.py -update and 1.2-blast_J.py can
+		reuse any results that are still current, without repeating
+		any searches.
+
 Created by Chaim A Schramm on 2013-07-05
 Edited and commented for publication by Chaim A Schramm on 2015-02-25.
 Edited to add custom J motif option for other species by CAS 2016-05-16.
@@ -28,7 +48,9 @@ Copyright (c) 2011-2016 Columbia University and Vaccine Research Center, Nationa
 
 """
 
-import sys, os
+import sys, os, itertools, cPickle
+from cStringIO import StringIO
+from multiprocessing import Pool
 
 try:
 	from sonar.annotate import *
@@ -39,17 +61,18 @@ except ImportError:
 
 global jMotif
 
-def find_cdr3_borders(v_id,vgene,vlength,vstart,vend,jgene,jstart,j_start_on_read,jgaps,read_sequence):
+def find_cdr3_borders(v_cys,vlength,vstart,vend,j_motif,jstart,j_start_on_read,jgaps,read_sequence):
 
 	'''
-	v_id = name of assigned V gene (eg IGHV1-2*02)
-	vgene = germline sequence of assigned V gene
+	v_cys = position of the conserved cysteine on the germline V gene
+	            (precomputed for each gene by germlineCache.py, -1 if none)
 	vlength = length of QUERY sequence taken up by match
 	            (might be different from blast-reported length 
 		     and/or vend-vstart+1 because of in-dels)
 	vstart = position on germline V gene where match begins (hopefully = 1)
 	vend = position on germline V gene where match ends
-	jgene = germline sequence of assigned J gene
+	j_motif = position of jMotif on the germline J gene (precomputed
+	            by germlineCache.py, -1 if not found)
 	jstart = position on germline J gene where match begins
 	j_start_on_read = position on query (v-cut version, not full 454 read) 
 	            where match with germline J begins
@@ -57,22 +80,9 @@ def find_cdr3_borders(v_id,vgene,vlength,vstart,vend,jgene,jstart,j_start_on_rea
 	read_sequence = V(D)J-trimmed sequence of the 454 read
 	'''
 
-	vMatches = []
-	cys_pat = "TG[T|C|N]" #N is for a couple of shorter V's, like VH4-31
-	if re.match("IGLV2-(11|23)", v_id):
-		cys_pat = "TGCTGC" #special case
-	if re.match("IGHV1-C",v_id):
-		cys_pat = "TATGC"
-	for m in re.finditer(cys_pat,vgene):
-		vMatches.append(m)
-
-	#last one **IN FRAME** is the cysteine we want! (matters for light chains)
 	cdr3_start=-1
-	vMatches.reverse()
-	for cys in vMatches:
-		if cys.start() % 3 == 0:
-			cdr3_start = vlength - (vend - cys.start())
-			break
+	if v_cys >= 0:
+		cdr3_start = vlength - (vend - v_cys)
                 
 	# If BLAST has truncated the V gene alignment prior to reaching the conserved cysteine, but still found the J gene,
 	#   that likely indicates a large in-del, which must be accounted for, or the start position of CDR 3 will be wrong.
@@ -86,13 +96,12 @@ def find_cdr3_borders(v_id,vgene,vlength,vstart,vend,jgene,jstart,j_start_on_rea
 		else:
 			cdr3_start = -1
 
-	jMatch = re.search(jMotif,jgene)
         WF_motif = -1 #pass back to main program to check for out-of-frame junctions
 
-	try:
-		cdr3_end = vlength + j_start_on_read + (jMatch.start() - jstart) +3
-                WF_motif = jMatch.start()
-	except:
+	if j_motif >= 0:
+		cdr3_end = vlength + j_start_on_read + (j_motif - jstart) +3
+                WF_motif = j_motif
+	else:
 		cdr3_end = -1 #if we didn't find the motif, we'll count it as a bad cdr3 without crashing
 
 	if jgaps > 0:
@@ -109,221 +118,333 @@ def find_cdr3_borders(v_id,vgene,vlength,vstart,vend,jgene,jstart,j_start_on_rea
 	return cdr3_start, cdr3_end, WF_motif
 
 
-def main():
+def finalize_chunk(f_ind):
 
-        if not glob.glob("%s/%s_*.fasta" % (prj_tree.jgene, prj_name)):
-                sys.exit("No jBlast output found!\n")
-        
-	print "curating junction and 3' end..."
+	"""
+	work out the final assignments for every read in one chunk, saving the
+	   results to a shard file so main() can merge the chunks back in order
+	"""
 
+	tophits = dict( j=StringIO(), c=StringIO(), d=StringIO() )
+	geneTotals = dict( j=dict(), c=dict(), d=dict() )
 
-        allV_aa      = open ("%s/%s_allV.fa"     % (prj_tree.aa, prj_name), "w" )
-        allV_nt      = open( "%s/%s_allV.fa"     % (prj_tree.nt, prj_name), "w" )
+	dict_vgerm_aln, dict_other_vgerms, dict_vcounts  =  get_top_hits("%s/%s_%03d.txt"%(prj_tree.vgene, prj_name, f_ind) )
+	dict_jgerm_aln, dict_other_jgerms, dict_jcounts  =  get_top_hits("%s/%s_%03d.txt"%(prj_tree.jgene, prj_name, f_ind), topHitWriter=csv.writer(tophits['j'], delimiter=sep), dict_germ_count=geneTotals['j'] )
 
-        allJ_aa      = open( "%s/%s_allJ.fa"     % (prj_tree.aa, prj_name), "w" )
-        allJ_nt      = open( "%s/%s_allJ.fa"     % (prj_tree.nt, prj_name), "w" )
+	if c:
+		minCStartPos = dict( [ (x, dict_jgerm_aln[x].qend) for x in dict_jgerm_aln.keys() ] )
+		dict_cgerm_aln, dict_other_cgerms, dict_ccounts  =  get_top_hits("%s/%s_C_%03d.txt"%(prj_tree.jgene, prj_name, f_ind), topHitWriter=csv.writer(tophits['c'], delimiter=sep), dict_germ_count=geneTotals['c'], minQStart=minCStartPos )
 
-        vj_aa        = open( "%s/%s_goodVJ.fa"   % (prj_tree.aa, prj_name), "w" )
-        vj_nt        = open( "%s/%s_goodVJ.fa"   % (prj_tree.nt, prj_name), "w" )
+	if d:
+		maxDEndPos = dict( [ (x, dict_jgerm_aln[x].qstart) for x in dict_jgerm_aln.keys() ] )
+		dict_dgerm_aln, dict_other_dgerms, dict_dcounts  =  get_top_hits("%s/%s_D_%03d.txt"%(prj_tree.jgene, prj_name, f_ind), topHitWriter=csv.writer(tophits['d'], delimiter=sep), dict_germ_count=geneTotals['d'], maxQEnd=maxDEndPos )
 
-        good_cdr3_aa = open( "%s/%s_goodCDR3.fa" % (prj_tree.aa, prj_name), "w" )
-        good_cdr3_nt = open( "%s/%s_goodCDR3.fa" % (prj_tree.nt, prj_name), "w" )
+	reads = []
+	for entry in SeqIO.parse( "%s/%s_%03d.fasta" % (prj_tree.vgene, prj_name, f_ind), "fasta"):
 
-        all_cdr3_nt  = open( "%s/%s_allCDR3.fa"  % (prj_tree.nt, prj_name), "w" )
+		records = []
+		if not entry.id in dict_vgerm_aln:
+			outcome = "noV"
+			tail = ["NA", "NA", "NA", "NA", "NA", "NA", "NA", "noV", "NA", "NA", "NA", "NA"]
+		elif not entry.id in dict_jgerm_aln:
+			outcome = "noJ"
+			myV = dict_vgerm_aln[entry.id]
+			if (myV.strand == 'plus'):
+				entry.seq = entry.seq[ myV.qstart - 1 :  ]
+			else:
+				entry.seq = entry.seq[  : myV.qend ].reverse_complement()
+			myVgenes = ",".join( [myV.sid] + dict_other_vgerms.get(entry.id,[]) )
+			entry.description = "V_gene=%s status=noJ" % (myVgenes)
+			records.append( ("allV_nt", entry.description, entry.seq) )
+
+			#prevent BioPython errors
+			if (len(entry.seq) % 3) > 0:
+				entry.seq = entry.seq [ :  -1 * (len(entry.seq) % 3) ]
+			records.append( ("allV_aa", entry.description, translate(entry.seq)) )
+			tail = [len(entry.seq), myVgenes, "NA", "NA", "NA", "NA", "NA", "noJ", "NA", "NA", "NA", "NA"]
+		else:
 
+			myV = dict_vgerm_aln[entry.id]
+			myJ = dict_jgerm_aln[entry.id]
+			indel = "F"
+			stop = "F"
+			cdr3 = True
+			
+			#get actual V(D)J sequence
+			v_len   = myV.qend - (myV.qstart-1) #need to use qstart and qend instead of alignment to account for gaps
+			vdj_len = v_len + myJ.qend
+			if (myV.strand == 'plus'):
+				entry.seq = entry.seq[ myV.qstart - 1 : myV.qstart + vdj_len - 1 ]
+			else:
+				entry.seq = entry.seq[ myV.qend - vdj_len + 1 : myV.qend ].reverse_complement()
+
+			#get CDR3 boundaries
+			cdr3_start,cdr3_end,WF_motif = find_cdr3_borders(v_cys[myV.sid], v_len, min(myV.sstart, myV.send), max(myV.sstart, myV.send), j_motif[myJ.sid], myJ.sstart, myJ.qstart, myJ.gaps, str(entry.seq)) #min and max statments take care of switching possible minus strand hit
+			cdr3_seq = entry.seq[ cdr3_start : cdr3_end ]
+
+			#push the sequence into frame for translation, if need be
+			v_frame = min([myV.sstart, myV.send]) % 3
+			five_prime_add = (v_frame-1) % 3
+			entry.seq = 'N' * five_prime_add + entry.seq 
+
+			#prevent BioPython errors by trimming to last full codon
+			if (len(entry.seq) % 3) > 0:
+				entry.seq = entry.seq [ :  -1 * (len(entry.seq) % 3) ]
+
+			#check for stop codons (the translation is reused for all of the amino acid outputs)
+			aa_seq = translate(entry.seq)
+			if '*' in aa_seq:
+				stop = "T"
+
+			#check for in-frame junction
+			if len(cdr3_seq) % 3 != 0:
+				indel = "T"
+			else: #even if cdr3 looks ok, might be indels in V and/or J
+				j_frame = 3 - ( ( WF_motif - myJ.sstart ) % 3 ) #j genes start in different frames, so caluclate based on position of conserved W/F found by the cdr3 subroutine above
+				frame_shift = (v_len + myJ.qstart - 1) % 3
+
+				if (v_frame + frame_shift) % 3 != j_frame % 3:
+					indel = "T"   #for gDNA we would probably want to distinguish between an out-of-frame recombination and sequencing in-dels in V or J
+					                #but that can be ambiguous and for cDNA we can assume that it's sll sequencing in-del anyway, even in CDR3.
+				else:
+					#use blast gaps to detect frame shift in-dels
+					#most of these have stop codons or other sequence problems, but we'll catch a few extra this way
+					if (abs(myV.send-myV.sstart)-(myV.qend-myV.qstart)) % 3 != 0 or ((myJ.send-myJ.sstart)-(myJ.qend-myJ.qstart)) % 3 != 0:
+						indel = "T"
+
+			#make sure cdr3 boundaries make sense
+			if (cdr3_end<=cdr3_start or cdr3_end>vdj_len or cdr3_start<0):
+				cdr3 = False
+
+			status = "good"
+			if not cdr3:
+				status = "noCDR3"
+			elif indel == "T":
+				status = "indel"
+			elif stop == "T":
+				status = "stop"
+
+			#add germline assignments to fasta description and write to disk
+			myVgenes = ",".join( [myV.sid] + dict_other_vgerms.get(entry.id,[]) )
+			myJgenes = ",".join( [myJ.sid] + dict_other_jgerms.get(entry.id,[]) )
+			
+			myDgenes = "NA"
+			if d:
+				if entry.id in dict_dgerm_aln:
+					myDgenes = ",".join( [dict_dgerm_aln[entry.id].sid] + dict_other_dgerms.get(entry.id,[]) )
+				else:
+					myDgenes = "not_found"
 
-	#get raw seq stats from temp table
-	raw = csv.reader(open("%s/id_lookup.txt" % prj_tree.internal,'rU'), delimiter=sep)
+			myCgenes = "NA"
+			if c:
+				if entry.id in dict_cgerm_aln:
+					myCgenes = ",".join( [dict_cgerm_aln[entry.id].sid] + dict_other_cgerms.get(entry.id,[]) )
+				else:
+					myCgenes = "not_found"
+			elif any( x in myV.sid for x in ["LV", "lambda", "Lambda", "LAMBDA"] ):
+				myCgenes = "lambda"
+			elif any( x in myV.sid for x in ["KV", "kappa", "Kappa", "KAPPA"] ):
+				myCgenes = "kappa"
+				
+			entry.description = "V_gene=%s J_gene=%s D_gene=%s constant=%s status=%s est_V_div=%3.1f%% cdr3_nt_len=%d" % (myVgenes, myJgenes, myDgenes, myCgenes, status, 100-myV.identity, len(cdr3_seq)-6)
 
+			records.append( ("allV_nt", entry.description, entry.seq) )
+			records.append( ("allV_aa", entry.description, aa_seq) )
 
-	raw_count, total, found, noV, noJ, f_ind  = 0, 0, 0, 0, 0, 1
-	counts = {'good':0,'indel':0,'noCDR3':0,'stop':0}
+			records.append( ("allJ_nt", entry.description, entry.seq) )
+			records.append( ("allJ_aa", entry.description, aa_seq) )
 
-	writer = csv.writer(open("%s/%s_jgerm_tophit.txt" %(prj_tree.tables, prj_name), "w"), delimiter = sep)
-	writer.writerow(PARSED_BLAST_HEADER)
-	dict_jcounts = dict()
-	dict_ccounts = dict()
-	dict_dcounts = dict()
-		
-	c = False
-	if os.path.isfile("%s/%s_C_001.txt" % (prj_tree.jgene, prj_name)):
-		c = True
-		cWriter = csv.writer(open("%s/%s_cgerm_tophit.txt" %(prj_tree.tables, prj_name), "w"), delimiter = sep)
-		cWriter.writerow(PARSED_BLAST_HEADER)
+			if status == "good":
+				cdr3_aa = translate(cdr3_seq)
+				entry.description += " cdr3_aa_len=%d cdr3_aa_seq=%s" % ((len(cdr3_seq)/3)-2, cdr3_aa)
 
-	d = False
-	if os.path.isfile("%s/%s_D_001.txt" % (prj_tree.jgene, prj_name)):
-		d = True
-		dWriter = csv.writer(open("%s/%s_dgerm_tophit.txt" %(prj_tree.tables, prj_name), "w"), delimiter = sep)
-		dWriter.writerow(PARSED_BLAST_HEADER)
+				records.append( ("vj_nt", entry.description, entry.seq) )
+				records.append( ("vj_aa", entry.description, aa_seq) )
 
+				records.append( ("good_cdr3_nt", entry.description, cdr3_seq) )
+				records.append( ("good_cdr3_aa", entry.description, cdr3_aa) )
 
-	seq_stats = csv.writer(open("%s/%s_all_seq_stats.txt"%(prj_tree.tables, prj_name), "w"), delimiter = sep)
-	seq_stats.writerow(["id","source_file","source_id","raw_len","trim_len","V_genes","D_genes","J_genes","Ig_class", "indels","stop_codons","status","blast_div","cdr3_nt_len","cdr3_aa_len","cdr3_aa_seq"])
+				records.append( ("all_cdr3_nt", entry.description, cdr3_seq) )
 
-	
-	while os.path.isfile("%s/%s_%03d.fasta" % (prj_tree.vgene, prj_name, f_ind)):
+				tail = [len(entry.seq), myVgenes, myDgenes, myJgenes, myCgenes, "F", "F", status, "%3.1f%%"%(100-myV.identity), "%d"%(len(cdr3_seq)-6), "%d"%(len(cdr3_seq)/3-2), cdr3_aa]
 
-		dict_vgerm_aln, dict_other_vgerms, dict_vcounts  =  get_top_hits("%s/%s_%03d.txt"%(prj_tree.vgene, prj_name, f_ind) )
-		dict_jgerm_aln, dict_other_jgerms, dict_jcounts  =  get_top_hits("%s/%s_%03d.txt"%(prj_tree.jgene, prj_name, f_ind), topHitWriter=writer, dict_germ_count=dict_jcounts )
+			elif cdr3:
+				#CDR3 but not "good"
+				records.append( ("all_cdr3_nt", entry.description, cdr3_seq) )
+				tail = [len(entry.seq), myVgenes, myDgenes, myJgenes, myCgenes, "%s"%indel, "%s"%stop, status, "%3.1f%%"%(100-myV.identity), "%d"%(len(cdr3_seq)-6), "NA", "NA"]
+			else:
+				tail = [len(entry.seq), myVgenes, myDgenes, myJgenes, myCgenes, "%s"%indel, "%s"%stop, status, "%3.1f%%"%(100-myV.identity), "NA", "NA", "NA"]
 
-		if c:
-			minCStartPos = dict( [ (x, dict_jgerm_aln[x].qend) for x in dict_jgerm_aln.keys() ] )
-			dict_cgerm_aln, dict_other_cgerms, dict_ccounts  =  get_top_hits("%s/%s_C_%03d.txt"%(prj_tree.jgene, prj_name, f_ind), topHitWriter=cWriter, dict_germ_count=dict_ccounts, minQStart=minCStartPos )
 
-		if d:
-			maxDEndPos = dict( [ (x, dict_jgerm_aln[x].qstart) for x in dict_jgerm_aln.keys() ] )
-			dict_dgerm_aln, dict_other_dgerms, dict_dcounts  =  get_top_hits("%s/%s_D_%03d.txt"%(prj_tree.jgene, prj_name, f_ind), topHitWriter=dWriter, dict_germ_count=dict_dcounts, maxQEnd=maxDEndPos )
+			outcome = status
 
-		for entry in SeqIO.parse( "%s/%s_%03d.fasta" % (prj_tree.vgene, prj_name, f_ind), "fasta"):
-			total += 1
+		geneCounts = []
+		if entry.id in dict_jgerm_aln:
+			geneCounts.append( ("j", dict_jgerm_aln[entry.id].sid) )
+		if c and entry.id in dict_cgerm_aln:
+			geneCounts.append( ("c", dict_cgerm_aln[entry.id].sid) )
+		if d and entry.id in dict_dgerm_aln:
+			geneCounts.append( ("d", dict_dgerm_aln[entry.id].sid) )
 
-			raw_stats = raw.next()
-			raw_count += 1
-			while not entry.id == raw_stats[0]:
-				#we found a read that did not meet the length cut-off
-				seq_stats.writerow(raw_stats + ["NA", "NA", "NA", "NA", "NA", "NA", "NA", "wrong_length", "NA", "NA", "NA", "NA"])
-				raw_stats = raw.next()
-				raw_count += 1
+		reads.append( (entry.id, [ (key, desc, str(seq)) for key, desc, seq in records ], tail, outcome, geneCounts) )
 
 
-			if not entry.id in dict_vgerm_aln:
-				noV+=1
-				seq_stats.writerow(raw_stats + ["NA", "NA", "NA", "NA", "NA", "NA", "NA", "noV", "NA", "NA", "NA", "NA"])
-			elif not entry.id in dict_jgerm_aln:
-				noJ+=1
-				myV = dict_vgerm_aln[entry.id]
-				if (myV.strand == 'plus'):
-					entry.seq = entry.seq[ myV.qstart - 1 :  ]
-				else:
-					entry.seq = entry.seq[  : myV.qend ].reverse_complement()
-				myVgenes = ",".join( [myV.sid] + dict_other_vgerms.get(entry.id,[]) )
-				entry.description = "V_gene=%s status=noJ" % (myVgenes)
-				allV_nt.write(">%s %s\n%s\n" %(entry.id, entry.description, entry.seq))
-
-				#prevent BioPython errors
-				if (len(entry.seq) % 3) > 0:
-					entry.seq = entry.seq [ :  -1 * (len(entry.seq) % 3) ]
-				allV_aa.write(">%s %s\n%s\n" %(entry.id, entry.description, entry.seq.translate()))
-				seq_stats.writerow(raw_stats + [len(entry.seq), myVgenes, "NA", "NA", "NA", "NA", "NA", "noJ", "NA", "NA", "NA", "NA"])
-			else:
+	#via a temp file, so that -merge never picks up a partial shard
+	shard = shard_file(f_ind)
+	with open(shard + ".tmp", "wb") as handle:
+		cPickle.dump( (reads, dict( (k, v.getvalue()) for k, v in tophits.items() ), geneTotals), handle, cPickle.HIGHEST_PROTOCOL )
+	os.rename(shard + ".tmp", shard)
+
+	return shard
+
+
+def shard_file(f_ind):
+	return "%s/%s_%03d.shard" % (prj_tree.jgene, prj_name, f_ind)
+
+
+def saved_or_finalize(f_ind):
+	"""with -merge, the shard of a chunk that was already finalized with -chunk"""
+	if merge and os.path.isfile(shard_file(f_ind)):
+		return shard_file(f_ind)
+	return finalize_chunk(f_ind)
+
+
+def main():
+
+        if not glob.glob("%s/%s_*.fasta" % (prj_tree.jgene, prj_name)):
+                sys.exit("No jBlast output found!\n")
+        
+	print "curating junction and 3' end..."
+
+
+	outputs = dict( allV_aa      = open( "%s/%s_allV.fa"     % (prj_tree.aa, prj_name), "w" ),
+			allV_nt      = open( "%s/%s_allV.fa"     % (prj_tree.nt, prj_name), "w" ),
+			allJ_aa      = open( "%s/%s_allJ.fa"     % (prj_tree.aa, prj_name), "w" ),
+			allJ_nt      = open( "%s/%s_allJ.fa"     % (prj_tree.nt, prj_name), "w" ),
+			vj_aa        = open( "%s/%s_goodVJ.fa"   % (prj_tree.aa, prj_name), "w" ),
+			vj_nt        = open( "%s/%s_goodVJ.fa"   % (prj_tree.nt, prj_name), "w" ),
+			good_cdr3_aa = open( "%s/%s_goodCDR3.fa" % (prj_tree.aa, prj_name), "w" ),
+			good_cdr3_nt = open( "%s/%s_goodCDR3.fa" % (prj_tree.nt, prj_name), "w" ),
+			all_cdr3_nt  = open( "%s/%s_allCDR3.fa"  % (prj_tree.nt, prj_name), "w" ) )
 
-				found += 1
-				myV = dict_vgerm_aln[entry.id]
-				myJ = dict_jgerm_aln[entry.id]
-				indel = "F"
-				stop = "F"
-				cdr3 = True
-				
-				#get actual V(D)J sequence
-				v_len   = myV.qend - (myV.qstart-1) #need to use qstart and qend instead of alignment to account for gaps
-				vdj_len = v_len + myJ.qend
-				if (myV.strand == 'plus'):
-					entry.seq = entry.seq[ myV.qstart - 1 : myV.qstart + vdj_len - 1 ]
-				else:
-					entry.seq = entry.seq[ myV.qend - vdj_len + 1 : myV.qend ].reverse_complement()
-
-				#get CDR3 boundaries
-				cdr3_start,cdr3_end,WF_motif = find_cdr3_borders(myV.sid,str(dict_v[myV.sid].seq), v_len, min(myV.sstart, myV.send), max(myV.sstart, myV.send), str(dict_j[myJ.sid].seq), myJ.sstart, myJ.qstart, myJ.gaps, str(entry.seq)) #min and max statments take care of switching possible minus strand hit
-				cdr3_seq = entry.seq[ cdr3_start : cdr3_end ]
-
-				#push the sequence into frame for translation, if need be
-				v_frame = min([myV.sstart, myV.send]) % 3
-				five_prime_add = (v_frame-1) % 3
-				entry.seq = 'N' * five_prime_add + entry.seq 
-
-				#prevent BioPython errors by trimming to last full codon
-				if (len(entry.seq) % 3) > 0:
-					entry.seq = entry.seq [ :  -1 * (len(entry.seq) % 3) ]
-
-				#check for stop codons
-				if '*' in entry.seq.translate():
-					stop = "T"
-
-				#check for in-frame junction
-				if len(cdr3_seq) % 3 != 0:
-					indel = "T"
-				else: #even if cdr3 looks ok, might be indels in V and/or J
-					j_frame = 3 - ( ( WF_motif - myJ.sstart ) % 3 ) #j genes start in different frames, so caluclate based on position of conserved W/F found by the cdr3 subroutine above
-					frame_shift = (v_len + myJ.qstart - 1) % 3
-
-					if (v_frame + frame_shift) % 3 != j_frame % 3:
-						indel = "T"   #for gDNA we would probably want to distinguish between an out-of-frame recombination and sequencing in-dels in V or J
-						                #but that can be ambiguous and for cDNA we can assume that it's sll sequencing in-del anyway, even in CDR3.
-					else:
-						#use blast gaps to detect frame shift in-dels
-						#most of these have stop codons or other sequence problems, but we'll catch a few extra this way
-						if (abs(myV.send-myV.sstart)-(myV.qend-myV.qstart)) % 3 != 0 or ((myJ.send-myJ.sstart)-(myJ.qend-myJ.qstart)) % 3 != 0:
-							indel = "T"
-
-				#make sure cdr3 boundaries make sense
-				if (cdr3_end<=cdr3_start or cdr3_end>vdj_len or cdr3_start<0):
-					cdr3 = False
-
-				status = "good"
-				if not cdr3:
-					status = "noCDR3"
-				elif indel == "T":
-					status = "indel"
-				elif stop == "T":
-					status = "stop"
-
-				#add germline assignments to fasta description and write to disk
-				myVgenes = ",".join( [myV.sid] + dict_other_vgerms.get(entry.id,[]) )
-				myJgenes = ",".join( [myJ.sid] + dict_other_jgerms.get(entry.id,[]) )
-				
-				myDgenes = "NA"
-				if d:
-					if entry.id in dict_dgerm_aln:
-						myDgenes = ",".join( [dict_dgerm_aln[entry.id].sid] + dict_other_dgerms.get(entry.id,[]) )
-					else:
-						myDgenes = "not_found"
-
-				myCgenes = "NA"
-				if c:
-					if entry.id in dict_cgerm_aln:
-						myCgenes = ",".join( [dict_cgerm_aln[entry.id].sid] + dict_other_cgerms.get(entry.id,[]) )
-					else:
-						myCgenes = "not_found"
-				elif any( x in myV.sid for x in ["LV", "lambda", "Lambda", "LAMBDA"] ):
-					myCgenes = "lambda"
-				elif any( x in myV.sid for x in ["KV", "kappa", "Kappa", "KAPPA"] ):
-					myCgenes = "kappa"
-					
-				entry.description = "V_gene=%s J_gene=%s D_gene=%s constant=%s status=%s est_V_div=%3.1f%% cdr3_nt_len=%d" % (myVgenes, myJgenes, myDgenes, myCgenes, status, 100-myV.identity, len(cdr3_seq)-6)
-
-				allV_nt.write(">%s %s\n%s\n" %(entry.id, entry.description, entry.seq))
-				allV_aa.write(">%s %s\n%s\n" %(entry.id, entry.description, entry.seq.translate()))
-
-				allJ_nt.write(">%s %s\n%s\n" %(entry.id, entry.description, entry.seq))
-				allJ_aa.write(">%s %s\n%s\n" %(entry.id, entry.description, entry.seq.translate()))
-
-				if status == "good":
-					entry.description += " cdr3_aa_len=%d cdr3_aa_seq=%s" % ((len(cdr3_seq)/3)-2, cdr3_seq.translate())
-
-					vj_nt.write(">%s %s\n%s\n" %(entry.id, entry.description, entry.seq))
-					vj_aa.write(">%s %s\n%s\n" %(entry.id, entry.description, entry.seq.translate()))
-
-					good_cdr3_nt.write(">%s %s\n%s\n" %(entry.id, entry.description, cdr3_seq))
-					good_cdr3_aa.write(">%s %s\n%s\n" %(entry.id, entry.description, cdr3_seq.translate()))
-
-					all_cdr3_nt.write(">%s %s\n%s\n" %(entry.id, entry.description, cdr3_seq))
-
-					seq_stats.writerow(raw_stats + [len(entry.seq), myVgenes, myDgenes, myJgenes, myCgenes, "F", "F", status, "%3.1f%%"%(100-myV.identity), "%d"%(len(cdr3_seq)-6), "%d"%(len(cdr3_seq)/3-2), cdr3_seq.translate()])
-
-				elif cdr3:
-					#CDR3 but not "good"
-					all_cdr3_nt.write(">%s %s\n%s\n" %(entry.id, entry.description, cdr3_seq))
-					seq_stats.writerow(raw_stats + [len(entry.seq), myVgenes, myDgenes, myJgenes, myCgenes, "%s"%indel, "%s"%stop, status, "%3.1f%%"%(100-myV.identity), "%d"%(len(cdr3_seq)-6), "NA", "NA"])
-				else:
-					seq_stats.writerow(raw_stats + [len(entry.seq), myVgenes, myDgenes, myJgenes, myCgenes, "%s"%indel, "%s"%stop, status, "%3.1f%%"%(100-myV.identity), "NA", "NA", "NA"])
 
+	#get raw seq stats from temp table
+	raw = csv.reader(open("%s/id_lookup.txt" % prj_tree.internal,'rU'), delimiter=sep)
+
+	#1.1 only sends one copy of each distinct read for assignment; the results for
+	#    a unique read are kept until all of its duplicates have been written out
+	dupsLeft = load_duplicate_counts("%s/id_lookup.txt" % prj_tree.internal)
+	dupCache = dict()
+
+	tally = Counter()
+	geneTotals = dict( j=Counter(), c=Counter(), d=Counter() )
+
+	def emit_other(raw_row):
+		raw_stats, rep = split_lookup_row(raw_row)
+		if rep is None or rep == raw_stats[0]:
+			#we found a read that did not meet the length cut-off
+			write_stats(raw_stats + ["NA", "NA", "NA", "NA", "NA", "NA", "NA", "wrong_length", "NA", "NA", "NA", "NA"])
+			return
+
+		#an exact duplicate of a read that has already been processed
+		records, tail, outcome, geneCounts = dupCache[rep]
+		for key, desc, seq in records:
+			outputs[key].write(">%s %s\n%s\n" % (raw_stats[0], desc, seq))
+		write_stats(raw_stats + tail)
+		tally[outcome] += 1
+		for gene_type, gene in geneCounts:
+			geneTotals[gene_type][gene] += 1
+		dupsLeft[rep] -= 1
+		if dupsLeft[rep] == 0:
+			del dupsLeft[rep]
+			del dupCache[rep]
+
+
+	raw_count = 0
+
+	tophits = dict( j = open("%s/%s_jgerm_tophit.txt" %(prj_tree.tables, prj_name), "w") )
+	if c:
+		tophits['c'] = open("%s/%s_cgerm_tophit.txt" %(prj_tree.tables, prj_name), "w")
+	if d:
+		tophits['d'] = open("%s/%s_dgerm_tophit.txt" %(prj_tree.tables, prj_name), "w")
+	for handle in tophits.values():
+		csv.writer(handle, delimiter = sep).writerow(PARSED_BLAST_HEADER)
+
+	#the same rows also go to a columnar store for quick lookups by later steps (see annotationStore.py)
+	seq_stats = csv.writer(open("%s/%s_all_seq_stats.txt"%(prj_tree.tables, prj_name), "w"), delimiter = sep)
+	store     = AnnotationStoreWriter("%s/%s_annotations" % (prj_tree.tables, prj_name))
+	def write_stats(row):
+		seq_stats.writerow(row)
+		store.writerow(row)
+
+	seq_stats.writerow(["id","source_file","source_id","raw_len","trim_len","V_genes","D_genes","J_genes","Ig_class", "indels","stop_codons","status","blast_div","cdr3_nt_len","cdr3_aa_len","cdr3_aa_seq"])
+
+	
+	#chunks are finalized independently (in parallel if requested), then merged
+	#    back in chunk order so the output is the same as a single-threaded run
+	chunks = []
+	while os.path.isfile("%s/%s_%03d.fasta" % (prj_tree.vgene, prj_name, len(chunks)+1)):
+		chunks.append(len(chunks)+1)
 
+	if numThreads > 1:
+		pool   = Pool(numThreads)
+		shards = pool.imap(saved_or_finalize, chunks)
+	else:
+		shards = itertools.imap(saved_or_finalize, chunks)
 
-				counts[status] += 1
+	for shard in shards:
 
-		print "%d done, found %d; %d good..." %(total, found, counts['good'])
-		f_ind += 1
+		with open(shard, "rb") as handle:
+			reads, chunkHits, chunkGenes = cPickle.load(handle)
+		os.remove(shard)
+
+		for gene_type in tophits:
+			tophits[gene_type].write(chunkHits[gene_type])
+			geneTotals[gene_type].update(chunkGenes[gene_type])
+
+		for read_id, records, tail, outcome, geneCounts in reads:
+
+			raw_row = raw.next()
+			raw_count += 1
+			while not read_id == raw_row[0]:
+				emit_other(raw_row)
+				raw_row = raw.next()
+				raw_count += 1
+			raw_stats = split_lookup_row(raw_row)[0]
+
+			for key, desc, seq in records:
+				outputs[key].write(">%s %s\n%s\n" % (read_id, desc, seq))
+			write_stats(raw_stats + tail)
+			tally[outcome] += 1
+
+			if read_id in dupsLeft:
+				dupCache[read_id] = ( records, tail, outcome, geneCounts )
+
+		found = sum( tally[status] for status in ["good", "indel", "noCDR3", "stop"] )
+		print "%d done, found %d; %d good..." %(sum(tally.values()), found, tally['good'])
+
+	if numThreads > 1:
+		pool.close()
+		pool.join()
+
+	#anything left in the lookup table comes after the last unique read
+	for raw_row in raw:
+		raw_count += 1
+		emit_other(raw_row)
+
+	for handle in tophits.values() + outputs.values():
+		handle.close()
+	store.close()
+
+	#summary counts
+	total  = sum(tally.values())
+	noV    = tally['noV']
+	noJ    = tally['noJ']
+	counts = dict( (status, tally[status]) for status in ["good", "indel", "noCDR3", "stop"] )
+	found  = sum(counts.values())
+	dict_jcounts = geneTotals['j']
+	dict_ccounts = geneTotals['c']
+	dict_dcounts = geneTotals['d']
 
 	#print out some statistics
 	handle = open("%s/%s_jgerm_stat.txt" %(prj_tree.tables, prj_name),'w')
@@ -362,10 +483,11 @@ def main():
 	handle.write(message)
 	handle.close()
 
-	#clean up!!
-	oldFiles = glob.glob("%s/*txt"%prj_tree.vgene) + glob.glob("%s/*fasta"%prj_tree.vgene) +  glob.glob("%s/*txt"%prj_tree.jgene) + glob.glob("%s/*fasta"%prj_tree.jgene) + glob.glob("%s/id_lookup.txt"%prj_tree.internal)
-	if len(oldFiles) > 0:
-		[os.remove(f) for f in oldFiles]
+	#clean up!! (only on request, the intermediate files can still be reused)
+	if clean:
+		oldFiles = glob.glob("%s/*txt"%prj_tree.vgene) + glob.glob("%s/*fasta"%prj_tree.vgene) +  glob.glob("%s/*txt"%prj_tree.jgene) + glob.glob("%s/*fasta"%prj_tree.jgene) + glob.glob("%s/id_lookup.txt"%prj_tree.internal) + glob.glob("%s/manifest.txt"%prj_tree.internal)
+		if len(oldFiles) > 0:
+			[os.remove(f) for f in oldFiles]
 			
 
 
@@ -380,6 +502,18 @@ if __name__ == '__main__':
 	#log command line
 	logCmdLine(sys.argv)
 
+	#check whether to delete intermediate files
+	clean = False
+	if q("-clean"):
+		sys.argv.remove("-clean")
+		clean = True
+
+	#check whether chunks have already been finalized by 1.2 -pipeline
+	merge = False
+	if q("-merge"):
+		sys.argv.remove("-merge")
+		merge = True
+
 	prj_tree  = ProjectFolders(os.getcwd())
 	prj_name  = fullpath2last_folder(prj_tree.home)
 
@@ -396,10 +530,21 @@ if __name__ == '__main__':
                 else:
 		        defaultParams['jmotif'] = "TT[C|T][G|A]G"
 
-	dict_args = processParas(sys.argv, jmotif="jmotif")
-	jMotif = getParasWithDefaults(dict_args, defaultParams, "jmotif")
+	defaultParams['numThreads'] = 1
+	defaultParams['chunk'] = 0
+	dict_args = processParas(sys.argv, jmotif="jmotif", threads="numThreads", chunk="chunk")
+	jMotif, numThreads, chunk = getParasWithDefaults(dict_args, defaultParams, "jmotif", "numThreads", "chunk")
+
+	#CDR3 anchors of each germline gene (see germlineCache.py)
+	v_cys     =  GermlineLibrary(vlib, prj_tree.internal).cys
+	j_motif   =  GermlineLibrary(jlib, prj_tree.internal).motif_positions(jMotif)
 
-	dict_v    =  load_fastas(vlib)
-	dict_j    =  load_fastas(jlib)
+	#are there constant region and D gene assignments to parse?
+	#    (with -chunk, other chunks may not have them yet)
+	c = os.path.isfile("%s/%s_C_%03d.txt" % (prj_tree.jgene, prj_name, max(chunk, 1)))
+	d = os.path.isfile("%s/%s_D_%03d.txt" % (prj_tree.jgene, prj_name, max(chunk, 1)))
 
-	main()
+	if chunk > 0:
+		finalize_chunk(chunk)
+	else:
+		main()
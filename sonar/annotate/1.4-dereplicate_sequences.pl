@@ -10,7 +10,7 @@ use version qw/logCmdLine/;
 #########checking parameters#######
 my $usage="
 Usage:
-This script performs two steps of clustering to remove sequences potentially containing sequencing errors. The first step finds duplicates, remove reads with coverage lower then cutoff which may contain sequencing errors, calculate read coverage for each cluster. The second step further cluster the filtered sequences using lower sequence identity cutoff. At the meantime, the second clustering will use reads with high coverage as centroids by assuming biological reads are coming from cDNA with many identical copies while reads containing sequencing errors has very low coverage. please install usearch v7 or higher verion. 
+This script performs two steps of clustering to remove sequences potentially containing sequencing errors. The first step finds duplicates (using SONAR's own dereplication, which runs in parallel and has no limit on file size), remove reads with coverage lower then cutoff which may contain sequencing errors, calculate read coverage for each cluster. The second step further cluster the filtered sequences using lower sequence identity cutoff. At the meantime, the second clustering will use reads with high coverage as centroids by assuming biological reads are coming from cDNA with many identical copies while reads containing sequencing errors has very low coverage. please install usearch v7 or higher verion for the second step. 
 
 options:
 	-id	 percent sequence identity used for the second step of clustering, default:0.99
@@ -18,6 +18,7 @@ options:
 	-min2	minimun sequencing coverage of a read to be kept in the seconde step of clustering, default:3
 	-f	sequence file in fasta format
 	-t	number of threads to run the script. Default:1
+	-mem	approximate memory budget in MB for finding duplicates. Default:2048
 Example:
 1.4-dereplicate_sequences.pl -pu usearch -min1 2 -min2 3 -f ./test.fa -t 5
 
@@ -43,6 +44,7 @@ if(!$para{'-f'}){
 	else{die "no input seq file\n";}
 }
 if(!$para{'-t'}){$para{'-t'}=1;}
+if(!$para{'-mem'}){$para{'-mem'}=2048;}
 if(!$para{'-id'}){$para{'-id'}=0.99;}
 #########do calculation##########
 
@@ -75,20 +77,8 @@ sub usearch{#do the two steps of clustering
     my %derep=();
 	  	my %final_good=();
 
-                #split files that are too big for 32-bit usearch (added by CAS 2016-05-18)
-                if (-s $file > 3_000_000_000) {
-		    system("$FindBin::Bin/../utilities/splitFastaForUSearch.py $file -o myDerepSplitter");
-		    for my $splitFile (glob "myDerepSplitter*fa") {
-			system("$para{'-pu'} -derep_fulllength $splitFile -threads $para{'-t'} -fastaout processed-$splitFile -sizeout ");
-			system("cat processed-$splitFile >> temp_derepped.fa");
-			system("rm $splitFile processed-$splitFile");
-		    }
-		    $file = "temp_derepped.fa";
-		} #done splitting, back to regular program
-
-	  	system("$para{'-pu'} -derep_fulllength $file -threads $para{'-t'} -fastaout $file_out\_unique.fa -sizein -sizeout -uc $file_out.cluster ");#first step on higher identity
-	  	if(-z "$file_out\_unique.fa"){die "No duplicate sequence found in your input sample.\n";}
-	  	system("$para{'-pu'} -sortbysize $file_out\_unique.fa -minsize $para{'-min1'} -fastaout $file_out.nonredundant.fa");
+	  	#first step: exact duplicates, with SONAR's own dereplication (no limit on file size, unlike 32-bit usearch)
+	  	system("$FindBin::Bin/../utilities/dereplicate.py -f $file -o $file_out.nonredundant.fa -uc $file_out.cluster -sizein -minsize $para{'-min1'} -t $para{'-t'} -mem $para{'-mem'}");
 	  	if(-z "$file_out.nonredundant.fa"){die "No duplicate sequence found in your input sample.\n";}
 	  	system("$para{'-pu'} -cluster_fast $file_out.nonredundant.fa -sort size -id $para{'-id'} -sizein -sizeout -uc $file_out.cluster -centroids $file_out\_unique.fa ");#second step on higher identity
 	  	if(-z "$file_out\_unique.fa"){die "No cluster found for your sequences.\n";}
@@ -1,7 +1,15 @@
 
 from .. import *
-from Bio.Blast.Applications import NcbiblastnCommandline
 import traceback
+from collections import Counter
+from functools import partial
+
+from .annotationCache import AnnotationCache, cachedProcess
+from .topHits import load_top_hits
+from .germlineCache import GermlineLibrary
+from .checkpoint import Manifest, signature, search_signature, run_search, remove_chunks
+
+NcbiblastnCommandline = LazyObject("Bio.Blast.Applications", "NcbiblastnCommandline")
 
 
 def blastProcess(threadID, filebase, db, outbase, wordSize, hits=10, constant=False):
@@ -20,115 +28,73 @@ def blastProcess(threadID, filebase, db, outbase, wordSize, hits=10, constant=Fa
 					      outfmt="\'6 qseqid sseqid pident length mismatch gaps qstart qend sstart send evalue bitscore sstrand\'",
 					      gapopen=5, gapextend=2, penalty=-1, reward=1, evalue=1e-3, max_target_seqs=hits, word_size=wordSize)
 
-        try:
-	        cline()
-        except:
-               print traceback.format_exc()
+	try:
+		cline()
+	except:
+		print traceback.format_exc()
+		#don't leave a partial table behind to be taken for a finished search
+		if os.path.isfile(output):
+			os.remove(output)
+		return False
+
+	return True
+
+
+def nativeProcess(*args, **kwargs):
+	"""SONAR's built-in aligner (see nativeAssign.py); imported on first use, as it sets up NumPy tables on import"""
+	from .nativeAssign import nativeProcess
+	return nativeProcess(*args, **kwargs)
+
+
+#germline assignment back ends selectable with -engine in 1.1 and 1.2
+#    (all take the same arguments as blastProcess, write the same tabular output
+#    and return whether the search succeeded)
+ASSIGN_ENGINES = dict( blast=blastProcess, native=nativeProcess )
+
+
+def get_assign_process(engine, cacheFile="", cacheSize=1024):
+	"""look up an assignment engine, wrapped by the persistent annotation cache if one was requested"""
+	if cacheFile == "":
+		return ASSIGN_ENGINES[engine]
+	return partial(cachedProcess, engine=ASSIGN_ENGINES[engine], cacheFile=os.path.abspath(cacheFile), cacheSize=cacheSize)
 
 
 
 def get_top_hits(infile, topHitWriter=None, dict_germ_count=dict(), maxQEnd=dict(), minQStart=dict()):
 	"""retrieve top hits from all result files"""
-	
-	dict_germ_aln    =  dict()
-	dict_other_germs =  dict()
-	old_id           =  ""
-
-
-	reader = csv.reader(open(infile, "rU"), delimiter = sep)
-	for row in reader:
-
-		if len(row) != 13:
-			pass;
-
-		else:
-                        my_alignment = MyAlignment(row)
-
-                        if my_alignment.qid != old_id:
-                                if old_id != "":
-					aline = best_row
-                                        if len(others)>0:
-                                                aline.append(",".join(others))
-                                                dict_other_germs[best_alignment.qid] = others
-
-                                        if topHitWriter is not None:
-                                                topHitWriter.writerow(aline)
-                                                if len(second_match)>0:
-                                                        topHitWriter.writerow(second_match)
-
-                                        dict_germ_aln[best_alignment.qid] = best_alignment
-
-                                        if best_alignment.sid not in dict_germ_count:
-                                                dict_germ_count[best_alignment.sid] 	= 0
-                                        dict_germ_count[best_alignment.sid] 		+= 1
-
-						
-                                #skips D genes that matched 5' J
-                                if my_alignment.qend > maxQEnd.get(my_alignment.qid, 99999):
-                                        old_id=""
-                                        continue
-
-                                #skips C genes that matched 3' J (not sure if necessary)
-                                if my_alignment.qstart < minQStart.get(my_alignment.qid, -1):
-                                        old_id=""
-                                        continue
-
-				old_id = my_alignment.qid
-				best_alignment = my_alignment
-				best_row = row
-				others = []
-				second_match = []
-				
-			else:
-				#added 20150107 by CAS
-				'''
-				need three conditions:
-				1. hit is on same gene
-				2. hit is on same strand
-				3. hits are non-overlapping
-				'''
-				if my_alignment.sid == best_alignment.sid and my_alignment.strand == best_alignment.strand and (max(my_alignment.sstart, my_alignment.send)<min(best_alignment.sstart,best_alignment.send) or min(my_alignment.sstart, my_alignment.send)>max(best_alignment.sstart,best_alignment.send)):
-					second_match = row
-					#change boundaries of alignment on both query and hit (to get J properly)
-					if my_alignment.send < best_alignment.sstart:
-						best_alignment.sstart = my_alignment.sstart
-						if best_alignment.strand == "plus":
-							best_alignment.qstart = my_alignment.qstart
-						else:
-							best_alignment.qend = my_alignment.qend
-					else:
-						best_alignment.send = my_alignment.send
-						if best_alignment.strand == "plus":
-							best_alignment.qend = my_alignment.qend
-						else:
-							best_alignment.qstart = my_alignment.qstart
-
-						
-				elif my_alignment.score >= best_alignment.score - 3 and my_alignment.sid.split("*")[0] != best_alignment.sid.split("*")[0] and not any( my_alignment.sid.split("*")[0] == x.split("*")[0] for x in others ):
-					others.append(my_alignment.sid)
-
-        #last line, repeat of what's in the loop
-        if old_id != "":
-                aline = best_row
-                if len(others)>0:
-                        aline.append(",".join(others))
-                        dict_other_germs[best_alignment.qid] = others
-
-                if topHitWriter is not None:
-                        topHitWriter.writerow(aline)
-                        if len(second_match)>0:
-                                topHitWriter.writerow(second_match)
-
-                dict_germ_aln[best_alignment.qid] = best_alignment
-
-                if best_alignment.sid not in dict_germ_count:
-                        dict_germ_count[best_alignment.sid] 	= 0
-                dict_germ_count[best_alignment.sid] 		+= 1
-
-
-        #warns user if blast crashed for some reason
-	if len(dict_germ_aln) == 0:
+
+	hits = load_top_hits(infile, maxQEnd=maxQEnd, minQStart=minQStart)
+
+	if topHitWriter is not None:
+		hits.write(topHitWriter)
+	hits.count_genes(dict_germ_count)
+
+	#warns user if blast crashed for some reason
+	if len(hits.ids) == 0:
 		print("%s appears to be empty..."%infile)
 
+	return hits.alignments(), hits.others, dict_germ_count
 
-	return dict_germ_aln, dict_other_germs, dict_germ_count
+
+
+def split_lookup_row(row):
+	"""
+	split a row of id_lookup.txt into the raw read stats (id, source file, source
+	   id, length) and the id of the unique read it was collapsed onto (None if
+	   the read failed the length filter or if the table predates collapsing)
+	"""
+	if len(row) < 5 or row[4] == "NA":
+		return row[:4], None
+	else:
+		return row[:4], row[4]
+
+
+def load_duplicate_counts(lookupFile):
+	"""count how many additional reads were collapsed onto each unique read by 1.1"""
+	dups = Counter()
+	with open(lookupFile, "rU") as handle:
+		for row in csv.reader(handle, delimiter=sep):
+			raw_stats, rep = split_lookup_row(row)
+			if rep is not None and rep != raw_stats[0]:
+				dups[rep] += 1
+	return dups
@@ -0,0 +1,192 @@
+#!/usr/bin/env python
+
+"""
+annotationCache.py
+
+Persistent, content-addressed cache of germline assignment hits, shared across
+      runs and projects (eg on a scratch file system). Entries are keyed by a
+      hash of the read sequence, a checksum of the germline library file and
+      the assignment parameters, and hold the tabular hit rows the engine
+      produced for that read (with the query id removed). Keeping the raw rows
+      rather than just the top hit means get_top_hits reconstructs exactly the
+      same top hit, alternate genes and split hits from a cached read.
+
+Only reads that the engine reported hits for are stored, and only if the
+      search as a whole succeeded: a missing read could just as well be the
+      result of a crashed or truncated search as a read with no hits, so
+      reads without hits are simply searched again next time.
+
+The cache is a single SQLite file with a size cap; least recently used entries
+      are evicted when the cap is exceeded.
+
+Copyright (c) 2011-2017 Columbia University and Vaccine Research Center, National
+                         Institutes of Health, USA. All rights reserved.
+
+"""
+
+import os, csv, time, hashlib, sqlite3
+from sonar import LazyModule
+
+SeqIO = LazyModule("Bio.SeqIO")
+
+
+# bump if the tabular output format or the engine defaults change
+CACHE_FORMAT = "sonar-hits-1"
+
+# how many keys to put in a single SQL statement (SQLite allows 999 variables)
+SQL_BATCH = 500
+
+_LIBRARY_SUMS = dict()
+
+
+def library_checksum(library):
+	"""md5 of a germline library file, remembered per process (and per mtime)"""
+	stamp = (library, os.path.getmtime(library), os.path.getsize(library))
+	if stamp not in _LIBRARY_SUMS:
+		md5 = hashlib.md5()
+		with open(library, "rb") as handle:
+			for block in iter(lambda: handle.read(1 << 20), b""):
+				md5.update(block)
+		_LIBRARY_SUMS[stamp] = md5.hexdigest()
+	return _LIBRARY_SUMS[stamp]
+
+
+class AnnotationCache:
+
+	def __init__(self, path, maxMB=1024):
+
+		self.path     = path
+		self.maxBytes = int(maxMB * 1024 * 1024)
+
+		self.db = sqlite3.connect(path, timeout=600)
+		self.db.text_factory = str
+		with self.db:
+			self.db.execute("CREATE TABLE IF NOT EXISTS hits (key TEXT PRIMARY KEY, rows TEXT, size INTEGER, last_used REAL)")
+			self.db.execute("CREATE INDEX IF NOT EXISTS hits_lru ON hits (last_used)")
+			self.db.execute("CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value INTEGER)")
+			self.db.execute("INSERT OR IGNORE INTO meta VALUES ('total_size', 0)")
+
+
+	def close(self):
+		self.db.close()
+
+
+	@staticmethod
+	def make_keys(sequences, library, params):
+		"""one cache key per sequence for this library/parameter combination"""
+		context = "%s|%s|%s|" % (CACHE_FORMAT, library_checksum(library), params)
+		return [ hashlib.sha1(context + s.upper()).hexdigest() for s in sequences ]
+
+
+	def lookup(self, keys):
+		"""return a dict key -> list of rows (each a list of the 12 non-id columns) for cached keys"""
+		found = dict()
+		now   = time.time()
+		for b in range(0, len(keys), SQL_BATCH):
+			batch  = keys[b : b + SQL_BATCH]
+			marks  = ",".join("?" * len(batch))
+			for key, rows in self.db.execute("SELECT key, rows FROM hits WHERE key IN (%s)" % marks, batch):
+				found[key] = [ line.split("\t") for line in rows.split("\n") if line != "" ]
+			with self.db:
+				self.db.execute("UPDATE hits SET last_used = ? WHERE key IN (%s)" % marks, [now] + batch)
+		return found
+
+
+	def store(self, entries):
+		"""save a dict key -> list of rows"""
+		now   = time.time()
+		items = []
+		added = 0
+		for key, rows in entries.items():
+			text   = "\n".join( "\t".join(map(str, r)) for r in rows )
+			items.append( (key, text, len(key) + len(text), now) )
+			added += len(key) + len(text)
+
+		with self.db:
+			self.db.executemany("INSERT OR IGNORE INTO hits VALUES (?, ?, ?, ?)", items)
+			self.db.execute("UPDATE meta SET value = value + ? WHERE name = 'total_size'", (added,))
+
+		self.evict()
+
+
+	def evict(self):
+		"""drop least recently used entries until the cache is back under 90% of its cap"""
+		total = self.db.execute("SELECT value FROM meta WHERE name = 'total_size'").fetchone()[0]
+		if total <= self.maxBytes:
+			return
+
+		with self.db:
+			#the running total can drift when concurrent writers store the same key, so resync first
+			total = self.db.execute("SELECT COALESCE(SUM(size), 0) FROM hits").fetchone()[0]
+			target = int(self.maxBytes * 0.9)
+			while total > target:
+				oldest = self.db.execute("SELECT key, size FROM hits ORDER BY last_used LIMIT ?", (SQL_BATCH,)).fetchall()
+				if len(oldest) == 0:
+					break
+				drop = []
+				for key, size in oldest:
+					drop.append(key)
+					total -= size
+					if total <= target:
+						break
+				self.db.execute("DELETE FROM hits WHERE key IN (%s)" % ",".join("?" * len(drop)), drop)
+			self.db.execute("UPDATE meta SET value = ? WHERE name = 'total_size'", (max(total, 0),))
+
+
+
+def cachedProcess(threadID, engine, cacheFile, cacheSize, filebase, db, outbase, wordSize, hits=10, constant=False):
+	"""
+	wrap one of the assignment engines (eg blastProcess) so that only reads
+	   missing from the annotation cache are actually aligned; returns
+	   whether the search succeeded (if not, nothing is cached and no output
+	   is written)
+	"""
+
+	fasta  = filebase % threadID
+	output = outbase  % threadID
+
+	reads  = [ (entry.id, str(entry.seq)) for entry in SeqIO.parse(open(fasta, "rU"), "fasta") ]
+	params = "%s|word_size=%d|max_target_seqs=%d|constant=%s" % (engine.__name__, wordSize, hits, constant)
+	keys   = AnnotationCache.make_keys([ s for r, s in reads ], db, params)
+
+	cache  = AnnotationCache(cacheFile, cacheSize)
+	cached = cache.lookup(keys)
+	print "%s: %d of %d reads found in annotation cache" % (fasta, sum(1 for k in keys if k in cached), len(reads))
+
+	# align the misses using the requested engine
+	newRows = dict()
+	misses  = [ (r, k) for r, k in zip(reads, keys) if k not in cached ]
+	if len(misses) > 0:
+		todo = "%s.todo" % output
+		with open(todo, "w") as handle:
+			for (read_id, seq), key in misses:
+				handle.write(">%s\n%s\n" % (read_id, seq))
+		success = engine(threadID, outbase + ".todo", db, outbase + ".new", wordSize, hits=hits, constant=constant) and os.path.isfile("%s.new" % output)
+
+		if success:
+			with open("%s.new" % output, "rU") as handle:
+				for row in csv.reader(handle, delimiter="\t"):
+					if len(row) == 13:
+						newRows.setdefault(row[0], []).append(row[1:])
+			os.remove("%s.new" % output)
+		os.remove(todo)
+
+		if not success:
+			print "%s: assignment of %d reads failed; nothing was cached" % (fasta, len(misses))
+			cache.close()
+			#an old table must not be taken for the result of this search
+			if os.path.isfile(output):
+				os.remove(output)
+			return False
+
+		cache.store( dict( (key, newRows[read_id]) for (read_id, seq), key in misses if read_id in newRows ) )
+
+	cache.close()
+
+	# write the combined results in chunk order, under the current read ids
+	with open(output, "w") as handle:
+		for (read_id, seq), key in zip(reads, keys):
+			for row in cached.get(key, newRows.get(read_id, [])):
+				handle.write("%s\t%s\n" % (read_id, "\t".join(row)))
+
+	return True
@@ -0,0 +1,150 @@
+#!/usr/bin/env python
+
+"""
+checkpoint.py
+
+Bookkeeping that lets the annotation scripts pick up where an earlier run left
+      off. Every intermediate result (the split read files from 1.1 and the
+      hit tables from the V, J, D and C searches of each split file) is
+      recorded in a manifest, work/internal/manifest.txt, under a signature:
+      an md5 of the contents of the files it was made from (eg the split file
+      and the germline library) and of the settings that were used.
+
+A step can be skipped on a re-run if its signature is unchanged and all of its
+      output files are still there, with the sizes they had when they were
+      recorded. 1.1 (with -update) and 1.2 only redo the searches that were
+      invalidated this way, and 1.3 keeps the intermediate files (unless run
+      with -clean), so that it can be re-run with different settings without
+      repeating any searches.
+
+work/internal/manifest.txt holds a single JSON object: the manifest format
+      and, for each step, its signature and the size of each of its output
+      files (with paths relative to the project folder). Several scripts may
+      update it in turn (with -cluster, 1.1 is still waiting on its own jobs
+      while 1.2 runs), so save() re-reads the file and only writes back the
+      entries that this process changed.
+
+Copyright (c) 2011-2017 Columbia University and Vaccine Research Center, National
+                         Institutes of Health, USA. All rights reserved.
+
+"""
+
+import os, json, hashlib
+
+from .annotationCache import library_checksum
+
+
+# bump if the meaning of the signatures changes
+MANIFEST_FORMAT = 1
+
+
+def signature(inputs, *params):
+	"""md5 of the contents of the input files and of the settings"""
+	md5 = hashlib.md5()
+	for f in inputs:
+		md5.update("%s\n" % library_checksum(f))
+	md5.update(repr(params))
+	return md5.hexdigest()
+
+
+def search_signature(fasta, db, engine, wordSize, hits=10, constant=False):
+	"""signature of one germline search, with the same arguments as blastProcess"""
+	return signature([fasta, db], engine, wordSize, hits, constant)
+
+
+def remove_chunks(pattern, first):
+	"""delete the files numbered `first` and above of a chunked intermediate (eg left over from a larger earlier run)"""
+	n = first
+	while os.path.isfile(pattern % n):
+		os.remove(pattern % n)
+		n += 1
+
+
+
+class Manifest:
+
+	def __init__(self, prj_tree):
+		self.home    = prj_tree.home
+		self.path    = "%s/manifest.txt" % prj_tree.internal
+		self.entries = self.load()
+		self.changes = dict()
+
+
+	def load(self):
+		try:
+			with open(self.path, "rU") as handle:
+				saved = json.load(handle)
+		except (IOError, ValueError):
+			return dict()
+		if saved.get("format") != MANIFEST_FORMAT:
+			return dict()
+		return saved["entries"]
+
+
+	def current(self, key, sig):
+		"""whether the step was recorded with this signature and its outputs are intact"""
+		entry = self.entries.get(key)
+		if entry is None or entry["signature"] != sig:
+			return False
+		for f, size in entry["outputs"].items():
+			f = os.path.join(self.home, f)
+			if not os.path.isfile(f) or os.path.getsize(f) != size:
+				return False
+		return True
+
+
+	def record(self, key, sig, outputs):
+		"""remember a finished step (output paths are saved relative to the project folder)"""
+		entry = dict( signature=sig, outputs=dict( (os.path.relpath(os.path.abspath(f), self.home), os.path.getsize(f)) for f in outputs ) )
+		self.entries[key] = entry
+		self.changes[key] = entry
+
+
+	def record_searches(self, searches):
+		"""record the results returned by run_search (skipping searches that did not run or left no output) and save"""
+		for search in searches:
+			if search is not None and os.path.isfile(search[2]):
+				self.record(search[0], search[1], [search[2]])
+		self.save()
+
+
+	def forget(self, key):
+		self.entries.pop(key, None)
+		self.changes[key] = None
+
+
+	def save(self):
+
+		entries = self.load()
+		for key, entry in self.changes.items():
+			if entry is None:
+				entries.pop(key, None)
+			else:
+				entries[key] = entry
+
+		temp = "%s.%d.tmp" % (self.path, os.getpid())
+		with open(temp, "w") as handle:
+			json.dump( dict(format=MANIFEST_FORMAT, entries=entries), handle, indent=1, sort_keys=True )
+		os.rename(temp, self.path)
+
+		self.entries = entries
+		self.changes = dict()
+
+
+def run_search(f_ind, manifest, process, engine, name, filebase, db, outbase, wordSize, hits=10, constant=False):
+	"""
+	run one germline search of one chunk (as blastProcess does), unless the
+	   manifest has a current result for it; returns (key, signature, output)
+	   for the caller to record, or None if the search was skipped or failed
+	"""
+
+	key = "%s_%03d" % (name, f_ind)
+	sig = search_signature(filebase % f_ind, db, engine, wordSize, hits, constant)
+	if manifest.current(key, sig):
+		print "%s is still current, skipping search..." % (outbase % f_ind)
+		return None
+
+	if not process(f_ind, filebase=filebase, db=db, outbase=outbase, wordSize=wordSize, hits=hits, constant=constant):
+		print "Search for %s failed; it will not be recorded as done." % (outbase % f_ind)
+		return None
+	return key, sig, outbase % f_ind
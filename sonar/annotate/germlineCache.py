@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+
+"""
+germlineCache.py
+
+Germline libraries for 1.3-finalize_assignments.py, with the CDR3 anchors of
+      each gene worked out once instead of once per read: the conserved
+      cysteine at the end of each V gene (the last in-frame TGT/TGC, or the
+      special motifs of IGLV2-11/23 and IGHV1-C) and the start of the W/F
+      motif of FWR4 in each J gene (for each J motif that is asked for).
+
+The sequences and anchors are saved in a pickle in the given folder (1.3
+      uses the project's work/internal folder, so nothing is written to the
+      germDB folder), named after the library and a hash of its full path,
+      which is used for as long as the size and modification time of the
+      library stay the same. Anchors for a J motif
+      that is not in the pickle yet are added to it on first use. If the
+      pickle can't be saved (eg in a read-only folder), it is simply kept in
+      memory.
+
+Copyright (c) 2011-2017 Columbia University and Vaccine Research Center, National
+                         Institutes of Health, USA. All rights reserved.
+
+"""
+
+import os, re, cPickle, hashlib
+
+from sonar import LazyModule
+
+SeqIO = LazyModule("Bio.SeqIO")
+
+
+# bump if the way anchors are found changes
+SGC_FORMAT = 1
+
+
+def find_cys(v_id, vgene):
+	"""start of the conserved cysteine codon on a germline V gene, or -1 if there isn't one"""
+
+	cys_pat = "TG[T|C|N]" #N is for a couple of shorter V's, like VH4-31
+	if re.match("IGLV2-(11|23)", v_id):
+		cys_pat = "TGCTGC" #special case
+	if re.match("IGHV1-C",v_id):
+		cys_pat = "TATGC"
+
+	#last one **IN FRAME** is the cysteine we want! (matters for light chains)
+	vMatches = list(re.finditer(cys_pat,vgene))
+	vMatches.reverse()
+	for cys in vMatches:
+		if cys.start() % 3 == 0:
+			return cys.start()
+	return -1
+
+
+def find_motif(jMotif, jgene):
+	"""start of the first match to the FWR4 motif on a germline J gene, or -1 if there isn't one"""
+	jMatch = re.search(jMotif,jgene)
+	return jMatch.start() if jMatch else -1
+
+
+
+class GermlineLibrary:
+
+	def __init__(self, fasta, folder, save=True):
+
+		self.fasta = fasta
+		self.path  = "%s/%s.%s.sgc" % ( folder, os.path.basename(fasta), hashlib.md5(os.path.abspath(fasta)).hexdigest()[:8] )
+		self.save  = save
+
+		stat = os.stat(fasta)
+		self.stamp = (SGC_FORMAT, stat.st_size, stat.st_mtime)
+
+		if not self.load():
+			print "loading sequence info from %s..." % fasta
+			self.seqs   = dict( (entry.id, str(entry.seq)) for entry in SeqIO.parse(open(fasta, "rU"), "fasta") )
+			self.cys    = dict( (gene, find_cys(gene, seq)) for gene, seq in self.seqs.items() )
+			self.motifs = dict()
+			self.write()
+
+
+	def load(self):
+		"""read a saved pickle, if there is one that matches the current library"""
+
+		if not os.path.isfile(self.path):
+			return False
+		try:
+			with open(self.path, "rb") as handle:
+				saved = cPickle.load(handle)
+		except Exception:
+			return False
+		if saved.get("stamp") != self.stamp:
+			return False
+
+		self.seqs, self.cys, self.motifs = saved["seqs"], saved["cys"], saved["motifs"]
+		return True
+
+
+	def write(self):
+		"""save the pickle (via a temp file, in case someone else is reading it)"""
+		if not self.save:
+			return
+		temp = "%s.%d.tmp" % (self.path, os.getpid())
+		try:
+			with open(temp, "wb") as handle:
+				cPickle.dump( dict(stamp=self.stamp, seqs=self.seqs, cys=self.cys, motifs=self.motifs), handle, cPickle.HIGHEST_PROTOCOL )
+			os.rename(temp, self.path)
+		except (IOError, OSError):
+			if os.path.isfile(temp):
+				os.remove(temp)
+
+
+	def motif_positions(self, jMotif):
+		"""dict gene -> start of jMotif on that gene (-1 if not found)"""
+		if jMotif not in self.motifs:
+			self.motifs[jMotif] = dict( (gene, find_motif(jMotif, seq)) for gene, seq in self.seqs.items() )
+			self.write()
+		return self.motifs[jMotif]
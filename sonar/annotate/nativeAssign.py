@@ -0,0 +1,206 @@
+#!/usr/bin/env python
+
+"""
+nativeAssign.py
+
+In-process germline assignment engine, used by 1.1 and 1.2 as an alternative
+      to shelling out to blastn once per chunk ("-engine native"). A k-mer
+      index over the germline library is built once per worker process;
+      each read is seeded against it on both strands, the best-supported
+      diagonals are extended with a banded Smith-Waterman alignment and the
+      results are emitted in the same 13-column tabular format that BLAST
+      writes, so get_top_hits and everything downstream are unchanged. The
+      hit tables have to be written out anyway: 1.3 reads them in a separate
+      process (or a later run), and they are what the annotation cache and
+      the manifest of intermediate files keep track of.
+
+Only one HSP is reported per read/germline pair, so the "split hit" rescue in
+      get_top_hits never triggers with this engine. BLAST remains the
+      reference implementation.
+
+Copyright (c) 2011-2017 Columbia University and Vaccine Research Center, National
+                         Institutes of Health, USA. All rights reserved.
+
+"""
+
+import sys, csv
+import numpy
+from Bio import SeqIO
+
+from sonar.align import encode_seq, revcomp_codes, banded_local_align, bit_score, evalue
+
+
+# indices are expensive to build relative to a single chunk, so keep one per
+#    library in each worker process
+_INDEX_CACHE = dict()
+
+
+class GermlineIndex:
+	"""k-mer index of a germline library (forward strand only; reads are flipped instead)"""
+
+	def __init__(self, library, wordSize):
+
+		self.library  = library
+		self.k        = wordSize
+		self.names    = []
+		self.codes    = []
+
+		for entry in SeqIO.parse(open(library, "rU"), "fasta"):
+			self.names.append(entry.id)
+			self.codes.append(encode_seq(entry.seq))
+
+		self.dblen = sum(len(c) for c in self.codes)
+
+		# CSR-style table: for each k-mer code, the (gene, position) pairs where it occurs
+		allKmers, allGenes, allPos = [], [], []
+		for g, c in enumerate(self.codes):
+			kmers, ok = self.kmer_codes(c)
+			pos = numpy.nonzero(ok)[0]
+			allKmers.append(kmers[pos])
+			allGenes.append(numpy.repeat(g, len(pos)))
+			allPos.append(pos)
+		allKmers = numpy.concatenate(allKmers)
+		order    = numpy.argsort(allKmers, kind="mergesort")
+		self.hitGene  = numpy.concatenate(allGenes)[order].astype(numpy.int32)
+		self.hitPos   = numpy.concatenate(allPos)[order].astype(numpy.int32)
+		self.tableEnd = numpy.cumsum( numpy.bincount(allKmers, minlength=4 ** self.k) )
+		self.tableStart = self.tableEnd - numpy.bincount(allKmers, minlength=4 ** self.k)
+
+
+	def kmer_codes(self, codes):
+		"""return the integer code of each k-mer and whether it was free of ambiguous bases"""
+		n = len(codes) - self.k + 1
+		if n <= 0:
+			return numpy.zeros(0, dtype=numpy.int64), numpy.zeros(0, dtype=numpy.bool_)
+		kmers = numpy.zeros(n, dtype=numpy.int64)
+		bad   = numpy.zeros(n, dtype=numpy.bool_)
+		for x in range(self.k):
+			window = codes[x : x + n]
+			kmers  = kmers * 4 + numpy.minimum(window, 3)
+			bad   |= window > 3
+		return kmers, ~bad
+
+
+	def seed(self, codes, maxCandidates):
+		"""
+		find candidate germlines for one (already oriented) read by voting on
+		   diagonals; returns a list of (votes, gene, diagonal)
+		"""
+		kmers, ok = self.kmer_codes(codes)
+		qpos  = numpy.nonzero(ok)[0]
+		kmers = kmers[qpos]
+		start = self.tableStart[kmers]
+		count = self.tableEnd[kmers] - start
+		total = count.sum()
+		if total == 0:
+			return []
+
+		# expand the hit lists for every query k-mer
+		rep    = numpy.repeat(numpy.arange(len(kmers)), count)
+		within = numpy.arange(total) - numpy.repeat(numpy.cumsum(count) - count, count)
+		idx    = start[rep] + within
+		genes  = self.hitGene[idx]
+		diags  = qpos[rep] - self.hitPos[idx]
+
+		# vote on (gene, diagonal) pairs
+		dmin   = diags.min()
+		width  = diags.max() - dmin + 1
+		keys   = genes.astype(numpy.int64) * width + (diags - dmin)
+		uniq, votes = numpy.unique(keys, return_counts=True)
+		byGene = uniq // width
+		order  = numpy.lexsort((-votes, byGene))
+		first  = numpy.ones(len(order), dtype=numpy.bool_)
+		first[1:] = byGene[order][1:] != byGene[order][:-1]
+		best   = order[first]
+
+		ranked = best[ numpy.argsort(-votes[best], kind="mergesort") ][:maxCandidates]
+		return [ (int(votes[b]), int(byGene[b]), int(uniq[b] % width + dmin)) for b in ranked ]
+
+
+
+def get_index(library, wordSize):
+	key = (library, wordSize)
+	if key not in _INDEX_CACHE:
+		_INDEX_CACHE[key] = GermlineIndex(library, wordSize)
+	return _INDEX_CACHE[key]
+
+
+def assign_reads(index, reads, hits=10, constant=False, band=10, maxEvalue=1e-3, batchSize=128, seedFraction=0.8):
+	"""
+	align a list of (read_id, sequence) pairs against the germline index and
+	   return a list of BLAST-style rows (sorted by read, then score), ready to
+	   be written as outfmt 6
+	"""
+
+	rows = []
+	for b in range(0, len(reads), batchSize):
+		batch = reads[b : b + batchSize]
+
+		queries, subjects, diagonals, owners = [], [], [], []
+		for r, (read_id, seq) in enumerate(batch):
+			fwd = encode_seq(seq)
+			candidates = []
+			for strand, codes in (("plus", fwd), ("minus", revcomp_codes(fwd))):
+				candidates += [ (votes, gene, diag, strand, codes) for votes, gene, diag in index.seed(codes, hits) ]
+			if len(candidates) == 0:
+				continue
+
+			#only extend seeds with reasonable support relative to the best one
+			#    (this is usually enough to drop the wrong strand entirely)
+			minVotes = max(c[0] for c in candidates) * seedFraction
+			for votes, gene, diag, strand, codes in candidates:
+				if votes >= minVotes:
+					queries.append(codes)
+					subjects.append(index.codes[gene])
+					diagonals.append(diag)
+					owners.append( (r, gene, strand) )
+
+		alignments = banded_local_align(queries, subjects, diagonals, band=band)
+
+		perRead = [ dict() for x in batch ]
+		for (r, gene, strand), aln in zip(owners, alignments):
+			if aln is None:
+				continue
+			if constant and aln.mismatches + aln.gaps > 0:
+				continue
+			e = evalue(aln.score, len(batch[r][1]), index.dblen)
+			if e > maxEvalue:
+				continue
+			#keep the better strand if a gene seeded on both
+			if gene in perRead[r] and perRead[r][gene][0].score >= aln.score:
+				continue
+			perRead[r][gene] = (aln, strand, e)
+
+		for r, found in enumerate(perRead):
+			qlen = len(batch[r][1])
+			ranked = sorted(found.items(), key=lambda x: (-x[1][0].score, x[0]))[:hits]
+			for gene, (aln, strand, e) in ranked:
+				if strand == "plus":
+					qstart, qend, sstart, send = aln.qstart, aln.qend, aln.sstart, aln.send
+				else:
+					#report in original read coordinates, with the subject running backwards like BLAST does
+					qstart, qend, sstart, send = qlen - aln.qend + 1, qlen - aln.qstart + 1, aln.send, aln.sstart
+				rows.append([ batch[r][0], index.names[gene], "%.3f" % (100.0 * aln.matches / aln.length),
+					      aln.length, aln.mismatches, aln.gaps, qstart, qend, sstart, send,
+					      "%.2e" % e, "%.1f" % bit_score(aln.score), strand ])
+
+	return rows
+
+
+def nativeProcess(threadID, filebase, db, outbase, wordSize, hits=10, constant=False):
+	"""drop-in replacement for blastProcess that runs the native engine on one chunk"""
+
+	fasta  = filebase % threadID
+	output = outbase  % threadID
+
+	print "Starting native assignment of %s against %s..." % (fasta, db)
+
+	index = get_index(db, wordSize)
+	reads = [ (entry.id, str(entry.seq)) for entry in SeqIO.parse(open(fasta, "rU"), "fasta") ]
+
+	with open(output, "w") as handle:
+		writer = csv.writer(handle, delimiter="\t", lineterminator="\n")
+		for row in assign_reads(index, reads, hits=hits, constant=constant):
+			writer.writerow(row)
+
+	return True
@@ -0,0 +1,307 @@
+#!/usr/bin/env python
+
+"""
+topHits.py
+
+Columnar parser for the 13-column tabular hit files written by the assignment
+      engines, and the top-hit selection used by get_top_hits. A whole chunk
+      is loaded into NumPy arrays and the per-read logic (top hit, alternate
+      genes scoring within 3 bits of the top hit, maxQEnd/minQStart filters)
+      is done with grouped array operations, so that only the top hit of each
+      read is turned into a MyAlignment object.
+
+Reads with a second HSP on the same germline and strand as their top hit
+      (candidates for the "split hit" merge) are rare and their boundaries
+      are updated sequentially, so those reads go through the original
+      row-by-row logic.
+
+Copyright (c) 2011-2017 Columbia University and Vaccine Research Center, National
+                         Institutes of Health, USA. All rights reserved.
+
+"""
+
+from sonar import MyAlignment, sep, LazyModule
+
+numpy = LazyModule("numpy")
+
+
+#rows converted at a time (the temporary arrays are rows x widest field)
+PARSE_BLOCK = 16384
+
+# column names and types
+COLUMNS = [ ("qid", str), ("sid", str), ("identity", float), ("alignment", int), ("mismatches", int),
+	    ("gaps", int), ("qstart", int), ("qend", int), ("sstart", int), ("send", int),
+	    ("evalue", float), ("score", float), ("strand", str) ]
+
+
+class HitRows:
+	"""the raw rows of a hit table, split into fields only on request (each line starts after the end of the one before)"""
+
+	def __init__(self, text, lineEnd):
+		self.text    = text
+		self.lineEnd = lineEnd
+
+	def __len__(self):
+		return len(self.lineEnd)
+
+	def __getitem__(self, i):
+		return self.text[ self.lineEnd[i-1] + 1 if i > 0 else 0 : self.lineEnd[i] ].split(sep)
+
+	def slice(self, start, end):
+		return [ self[i] for i in range(start, end) ]
+
+
+def parse_hit_table(infile):
+	"""
+	read a tabular hit file; returns the raw rows (as csv.reader would give them)
+	   and a dict of typed NumPy columns (fixed width strings for ids and strand)
+
+	The file is handled as one byte array: field boundaries come from the
+	   positions of the tabs and newlines, and each column is gathered into a
+	   padded character matrix that NumPy converts in one call per block of
+	   rows.
+	"""
+
+	with open(infile, "rU") as handle:
+		text = handle.read()
+
+	buf  = numpy.frombuffer(text, dtype=numpy.uint8)
+	seps = _separators(buf)
+	n    = len(seps) // 13
+	if len(seps) != 13 * n or not (buf[seps].reshape(n, 13) == [9] * 12 + [10]).all():
+		#blank, truncated or otherwise malformed lines are skipped, as with csv.reader
+		lines = [ line for line in text.split("\n") if line.count(sep) == 12 ]
+		text  = "".join( line + "\n" for line in lines )
+		buf   = numpy.frombuffer(text, dtype=numpy.uint8)
+		seps  = _separators(buf)
+		n     = len(lines)
+
+	if n == 0:
+		return HitRows(text, []), None
+
+	#each field starts just after the end of the one before it; the fields are
+	#    converted a block of rows at a time, which keeps the peak memory of a
+	#    large chunk close to that of the columns themselves
+	ends   = seps.reshape(n, 13)
+	blocks = range(0, n, PARSE_BLOCK)
+	widths = numpy.max([ (ends[ b : b+PARSE_BLOCK ] - _block_starts(ends, b)).max(axis=0) for b in blocks ], axis=0)
+
+	parts = dict( (name, []) for name, kind in COLUMNS )
+	for b in blocks:
+		start = _block_starts(ends, b)
+		for k, (name, kind) in enumerate(COLUMNS):
+			parts[name].append( _convert_field(buf, start[:, k], ends[ b : b+PARSE_BLOCK, k ], max(1, int(widths[k])), kind) )
+	cols = dict( (name, numpy.concatenate(parts[name])) for name, kind in COLUMNS )
+
+	return HitRows(text, ends[:, 12].tolist()), cols
+
+
+def _separators(buf):
+	"""positions of the tabs and newlines (with a single temporary the size of the file)"""
+	found  = buf == 9
+	found |= buf == 10
+	return numpy.flatnonzero(found)
+
+
+def _block_starts(ends, b):
+	"""where the fields of the block of rows starting at row b start, from where they all end"""
+	block = ends[ b : b+PARSE_BLOCK ]
+	start = numpy.empty(block.shape, dtype=numpy.int64)
+	start[:, 1:]  = block[:, :-1] + 1
+	start[1:, 0]  = block[:-1, 12] + 1
+	start[0, 0]   = ends[b-1, 12] + 1 if b > 0 else 0
+	return start
+
+
+def _convert_field(buf, start, end, width, kind):
+	"""one field of a block of rows, from the byte positions where it starts and ends"""
+
+	length = end - start
+	index  = start[:, None] + numpy.arange(width)
+	inside = index < end[:, None]
+	chars  = numpy.where(inside, buf[numpy.minimum(index, len(buf) - 1)], 0).astype(numpy.uint8)
+
+	if kind is str:
+		return chars.view("S%d" % width).ravel()
+	elif kind is int:
+		#place value of each digit, counted from the end of the field
+		negative = chars[:, 0] == ord("-")
+		digits   = numpy.where(inside & (chars >= 48), chars.astype(numpy.int64) - 48, 0)
+		power    = numpy.maximum(length[:, None] - 1 - numpy.arange(width), 0)
+		return numpy.where(negative, -1, 1) * (digits * 10 ** power).sum(axis=1)
+	else:
+		chars[~inside] = 32
+		return numpy.fromstring(numpy.hstack([ chars, numpy.full((len(start), 1), 32, dtype=numpy.uint8) ]).tostring(), sep=" ")
+
+
+class TopHits:
+	"""
+	top hit of every read in one hit file:
+	   rows    the raw rows of the file, and cols its parsed columns
+	   ids     read ids with a top hit, in file order
+	   best    index into rows of each read's top hit
+	   others  dict read id -> alternate genes (only for reads that have any)
+	   merged  dict read id -> (MyAlignment, second_match row) for reads whose
+	              top hit absorbed a split HSP
+	"""
+
+	def __init__(self, rows, cols, ids, best, others, merged):
+		self.rows   = rows
+		self.cols   = cols
+		self.ids    = ids
+		self.best   = best
+		self.others = others
+		self.merged = merged
+
+
+	def alignments(self):
+		"""dict read id -> MyAlignment of the top hit"""
+
+		if len(self.ids) == 0:
+			return dict()
+
+		#hand MyAlignment values that are already converted, so it has nothing left to parse
+		typed = [ self.ids ]
+		for name, numeric in COLUMNS[1:]:
+			typed.append( self.cols[name][self.best].tolist() )
+		typed[1] = [ x.strip() for x in typed[1] ]
+
+		result = dict()
+		for row in zip(*typed):
+			if row[0] in self.merged:
+				result[row[0]] = self.merged[row[0]][0]
+			else:
+				result[row[0]] = MyAlignment(row)
+		return result
+
+
+	def write(self, topHitWriter):
+		for read_id, b in zip(self.ids, self.best):
+			aline = self.rows[b]
+			if read_id in self.others:
+				aline.append(",".join(self.others[read_id]))
+			topHitWriter.writerow(aline)
+			if read_id in self.merged and len(self.merged[read_id][1]) > 0:
+				topHitWriter.writerow(self.merged[read_id][1])
+
+
+	def count_genes(self, dict_germ_count):
+		"""add one to the count of each top hit gene"""
+		for b in self.best:
+			gene = self.rows[b][1].strip()
+			dict_germ_count[gene] = dict_germ_count.get(gene, 0) + 1
+		return dict_germ_count
+
+
+
+def _merge_split_hits(rows):
+	"""
+	the original row-by-row pass over one read's hits, starting at its top hit;
+	   returns (top hit, alternate genes, second_match row)
+	"""
+
+	best_alignment = MyAlignment(rows[0])
+	others = []
+	second_match = []
+
+	for row in rows[1:]:
+		my_alignment = MyAlignment(row)
+		if my_alignment.sid == best_alignment.sid and my_alignment.strand == best_alignment.strand and (max(my_alignment.sstart, my_alignment.send)<min(best_alignment.sstart,best_alignment.send) or min(my_alignment.sstart, my_alignment.send)>max(best_alignment.sstart,best_alignment.send)):
+			second_match = row
+			#change boundaries of alignment on both query and hit (to get J properly)
+			if my_alignment.send < best_alignment.sstart:
+				best_alignment.sstart = my_alignment.sstart
+				if best_alignment.strand == "plus":
+					best_alignment.qstart = my_alignment.qstart
+				else:
+					best_alignment.qend = my_alignment.qend
+			else:
+				best_alignment.send = my_alignment.send
+				if best_alignment.strand == "plus":
+					best_alignment.qend = my_alignment.qend
+				else:
+					best_alignment.qstart = my_alignment.qstart
+
+		elif my_alignment.score >= best_alignment.score - 3 and my_alignment.sid.split("*")[0] != best_alignment.sid.split("*")[0] and not any( my_alignment.sid.split("*")[0] == x.split("*")[0] for x in others ):
+			others.append(my_alignment.sid)
+
+	return best_alignment, others, second_match
+
+
+def select_top_hits(rows, cols, maxQEnd=dict(), minQStart=dict()):
+	"""
+	pick the top hit and alternate genes for each read from a parsed hit table
+
+	Hits for a read are in decreasing score order. Leading hits that end past
+	   maxQEnd[read] or start before minQStart[read] are skipped; the first one
+	   left is the top hit. Later hits on a different gene scoring within 3
+	   bits of it are listed as alternates (one allele per gene).
+	"""
+
+	if cols is None:
+		return TopHits(rows, cols, [], numpy.zeros(0, dtype=numpy.int64), dict(), dict())
+
+	n      = len(rows)
+	pos    = numpy.arange(n)
+	qid    = cols['qid']
+
+	# consecutive rows with the same query make up one read
+	newRun = numpy.ones(n, dtype=numpy.bool_)
+	newRun[1:] = qid[1:] != qid[:-1]
+	runStart = numpy.flatnonzero(newRun)
+	runEnd   = numpy.append(runStart[1:], n)
+	runOf    = numpy.cumsum(newRun) - 1
+	runIds   = [ q.strip() for q in qid[runStart].tolist() ]
+
+	ok = numpy.ones(n, dtype=numpy.bool_)
+	if len(maxQEnd) > 0:
+		ok &= cols['qend'] <= numpy.array([ maxQEnd.get(q, 99999) for q in runIds ])[runOf]
+	if len(minQStart) > 0:
+		ok &= cols['qstart'] >= numpy.array([ minQStart.get(q, -1) for q in runIds ])[runOf]
+
+	passing = numpy.flatnonzero(ok)
+	hasBest, first = numpy.unique(runOf[passing], return_index=True)
+	best = passing[first]
+
+	bestOf = numpy.empty(len(runStart), dtype=numpy.int64)
+	bestOf.fill(-1)
+	bestOf[hasBest] = best
+	rowBest = bestOf[runOf]
+	after   = (rowBest >= 0) & (pos > rowBest)
+	rowBest = numpy.maximum(rowBest, 0)
+
+	# germline genes (allele names without the *NN suffix)
+	sids, sidCode = numpy.unique(cols['sid'], return_inverse=True)
+	genes, geneOfSid = numpy.unique([ s.strip().split("*")[0] for s in sids ], return_inverse=True)
+	gene = geneOfSid[sidCode]
+
+	# a later hit on the same germline and strand that does not overlap the top hit
+	#    gets merged into it (which moves its boundaries for any further hits)
+	sLow  = numpy.minimum(cols['sstart'], cols['send'])
+	sHigh = numpy.maximum(cols['sstart'], cols['send'])
+	slow  = after & (sidCode == sidCode[rowBest]) & (cols['strand'] == cols['strand'][rowBest]) & \
+		( (sHigh < sLow[rowBest]) | (sLow > sHigh[rowBest]) )
+	slowRuns = numpy.zeros(len(runStart), dtype=numpy.bool_)
+	slowRuns[runOf[slow]] = True
+
+	# alternates: first hit on each other gene scoring within 3 bits of the top hit
+	alt = after & ~slowRuns[runOf] & (cols['score'] >= cols['score'][rowBest] - 3) & (gene != gene[rowBest])
+	idx = numpy.flatnonzero(alt)
+	unused, firstOfGene = numpy.unique(runOf[idx] * len(genes) + gene[idx], return_index=True)
+	others = dict()
+	for i in numpy.sort(idx[firstOfGene]):
+		others.setdefault(runIds[runOf[i]], []).append(cols['sid'][i].strip())
+
+	merged = dict()
+	for r in numpy.flatnonzero(slowRuns):
+		top, alternates, second_match = _merge_split_hits(rows.slice(bestOf[r], runEnd[r]))
+		merged[runIds[r]] = (top, second_match)
+		if len(alternates) > 0:
+			others[runIds[r]] = alternates
+
+	return TopHits(rows, cols, [ runIds[r] for r in hasBest ], best, others, merged)
+
+
+def load_top_hits(infile, maxQEnd=dict(), minQStart=dict()):
+	rows, cols = parse_hit_table(infile)
+	return select_top_hits(rows, cols, maxQEnd=maxQEnd, minQStart=minQStart)
@@ -0,0 +1,319 @@
+#!/usr/bin/env python
+
+"""
+annotationStore.py
+
+Columnar copy of the per-read annotations in <project>_all_seq_stats.txt,
+      written by 1.3-finalize_assignments.py to output/tables/
+      <project>_annotations/, so that later steps can look up reads or
+      filter them by gene, status or CDR3 length without parsing the table
+      (or the FASTA description lines) again.
+
+Every column is saved as NumPy arrays, which are memory-mapped when the store
+      is opened, so opening even a very large project is nearly instant:
+         int     lengths (NA is saved as INT_NA)              <col>.npy
+         float   blast_div, in percent (NA is saved as nan)   <col>.npy
+         str     one string per read (ids, CDR3 sequences)    <col>.data.npy, <col>.offsets.npy
+         cat     repetitive strings (gene calls, status...)   <col>.codes.npy and a str column <col>.vocab
+      together with two kinds of index: the order of the read ids (for
+      binary search; <col>.order.npy) and, for the gene and status columns,
+      the rows for each distinct value (<col>.index.npy, <col>.starts.npy).
+
+    store = AnnotationStore("output/tables/myproject_annotations")
+    store.row( store.find("00000042") )
+    rows  = store.select(V="IGHV1-2", status="good", cdr3_aa_len=(15, 20))
+    store.ids(rows)
+
+Copyright (c) 2011-2017 Columbia University and Vaccine Research Center, National
+                         Institutes of Health, USA. All rights reserved.
+
+"""
+
+import os, json
+from array import array
+from cStringIO import StringIO
+
+import numpy
+
+
+STORE_FORMAT = 2
+
+#NA in int columns; CDR3 lengths can really be negative when the borders come out short
+INT_NA = numpy.iinfo(numpy.int64).min
+
+#the columns of _all_seq_stats.txt
+COLUMNS = [ ("id", "str"), ("source_file", "cat"), ("source_id", "str"), ("raw_len", "int"), ("trim_len", "int"),
+	    ("V_genes", "cat"), ("D_genes", "cat"), ("J_genes", "cat"), ("Ig_class", "cat"), ("indels", "cat"),
+	    ("stop_codons", "cat"), ("status", "cat"), ("blast_div", "float"), ("cdr3_nt_len", "int"),
+	    ("cdr3_aa_len", "int"), ("cdr3_aa_seq", "str") ]
+
+#columns that get an index of rows per value
+INDEXED = [ "V_genes", "D_genes", "J_genes", "Ig_class", "status" ]
+
+
+
+def _save_array(path, values):
+	"""
+	numpy.save through a temp file, so that a reader never memory-maps an
+	   array that another process is still writing (or has truncated)
+	"""
+	temp = "%s.%d.tmp" % (path, os.getpid())
+	with open(temp, "wb") as handle:
+		numpy.save(handle, values)
+	os.rename(temp, path)
+
+
+def _save_strings(folder, name, strings):
+	"""save a list of strings as one byte array plus offsets"""
+	offsets = numpy.zeros(len(strings) + 1, dtype=numpy.int64)
+	offsets[1:] = numpy.cumsum([ len(s) for s in strings ])
+	_save_array( "%s/%s.data.npy" % (folder, name), numpy.frombuffer("".join(strings), dtype=numpy.uint8) )
+	_save_array( "%s/%s.offsets.npy" % (folder, name), offsets )
+
+
+class Int64Buffer:
+	"""a growable int64 array (array("l") is only 64 bits wide where a C long is)"""
+
+	def __init__(self):
+		self.data = numpy.zeros(1024, dtype=numpy.int64)
+		self.size = 0
+
+	def append(self, value):
+		if self.size == len(self.data):
+			self.data = numpy.resize(self.data, 2 * len(self.data))
+		self.data[self.size] = value
+		self.size += 1
+
+	def array(self):
+		return self.data[ : self.size ]
+
+
+class AnnotationStoreWriter:
+	"""collects the rows of _all_seq_stats.txt (as written with csv.writer) and saves them as a store on close()"""
+
+	def __init__(self, folder):
+
+		self.folder = folder
+		self.rows   = 0
+
+		self.ints    = dict( (name, Int64Buffer()) for name, kind in COLUMNS if kind == "int" )
+		self.floats  = dict( (name, array("d"))    for name, kind in COLUMNS if kind == "float" )
+		self.codes   = dict( (name, Int64Buffer()) for name, kind in COLUMNS if kind == "cat" )
+		self.vocab   = dict( (name, dict())        for name, kind in COLUMNS if kind == "cat" )
+		self.strings = dict( (name, StringIO())    for name, kind in COLUMNS if kind == "str" )
+		self.ends    = dict( (name, Int64Buffer()) for name, kind in COLUMNS if kind == "str" )
+
+
+	def writerow(self, row):
+
+		for (name, kind), value in zip(COLUMNS, row):
+			value = str(value)
+			if kind == "int":
+				self.ints[name].append( INT_NA if value == "NA" else int(value) )
+			elif kind == "float":
+				self.floats[name].append( float("nan") if value == "NA" else float(value.rstrip("%")) )
+			elif kind == "cat":
+				self.codes[name].append( self.vocab[name].setdefault(value, len(self.vocab[name])) )
+			else:
+				self.strings[name].write(value)
+				self.ends[name].append( self.strings[name].tell() )
+		self.rows += 1
+
+
+	def close(self):
+
+		if not os.path.isdir(self.folder):
+			os.makedirs(self.folder)
+
+		for name, kind in COLUMNS:
+
+			if kind == "int":
+				numpy.save( "%s/%s.npy" % (self.folder, name), self.ints[name].array() )
+
+			elif kind == "float":
+				numpy.save( "%s/%s.npy" % (self.folder, name), numpy.frombuffer(self.floats[name], dtype=numpy.float64) if self.rows > 0 else numpy.zeros(0) )
+
+			elif kind == "cat":
+				codes = self.codes[name].array()
+				numpy.save( "%s/%s.codes.npy" % (self.folder, name), codes )
+				_save_strings( self.folder, name + ".vocab", sorted(self.vocab[name], key=self.vocab[name].get) )
+				if name in INDEXED:
+					numpy.save( "%s/%s.index.npy" % (self.folder, name), numpy.argsort(codes, kind="mergesort") )
+					starts = numpy.zeros(len(self.vocab[name]) + 1, dtype=numpy.int64)
+					starts[1:] = numpy.cumsum( numpy.bincount(codes, minlength=len(self.vocab[name])) )
+					numpy.save( "%s/%s.starts.npy" % (self.folder, name), starts )
+
+			else:
+				data    = numpy.frombuffer(self.strings[name].getvalue(), dtype=numpy.uint8)
+				offsets = numpy.zeros(self.rows + 1, dtype=numpy.int64)
+				offsets[1:] = self.ends[name].array()
+				numpy.save( "%s/%s.data.npy" % (self.folder, name), data )
+				numpy.save( "%s/%s.offsets.npy" % (self.folder, name), offsets )
+
+		#read ids in sorted order, for binary search
+		ids = [ s for s in StringColumn(self.folder, "id") ]
+		numpy.save( "%s/id.order.npy" % self.folder, numpy.argsort(numpy.array(ids, dtype=str), kind="mergesort") if self.rows > 0 else numpy.zeros(0, dtype=numpy.int64) )
+
+		with open("%s/meta.json" % self.folder, "w") as handle:
+			json.dump( dict(format=STORE_FORMAT, rows=self.rows, columns=COLUMNS), handle )
+
+
+
+class StringColumn:
+	"""a str column, decoded one string at a time"""
+
+	def __init__(self, folder, name):
+		self.data    = numpy.load("%s/%s.data.npy" % (folder, name), mmap_mode="r")
+		self.offsets = numpy.load("%s/%s.offsets.npy" % (folder, name), mmap_mode="r")
+
+	def __len__(self):
+		return len(self.offsets) - 1
+
+	def __getitem__(self, i):
+		return self.data[ self.offsets[i] : self.offsets[i+1] ].tostring()
+
+	def __iter__(self):
+		data, offsets = self.data[:].tostring(), self.offsets[:].tolist()
+		for start, end in zip(offsets[:-1], offsets[1:]):
+			yield data[start:end]
+
+
+
+class AnnotationStore:
+
+	def __init__(self, folder):
+
+		self.folder = folder
+		with open("%s/meta.json" % folder, "rU") as handle:
+			meta = json.load(handle)
+		if meta["format"] != STORE_FORMAT:
+			raise ValueError("%s was written by a different version of SONAR; please re-run 1.3-finalize_assignments.py" % folder)
+
+		self.rows  = meta["rows"]
+		self.kinds = dict( (str(name), kind) for name, kind in meta["columns"] )
+
+		self.arrays, self.strings, self.vocab = dict(), dict(), dict()
+		for name, kind in self.kinds.items():
+			if kind in ["int", "float"]:
+				self.arrays[name] = numpy.load("%s/%s.npy" % (folder, name), mmap_mode="r")
+			elif kind == "cat":
+				self.arrays[name] = numpy.load("%s/%s.codes.npy" % (folder, name), mmap_mode="r")
+				self.vocab[name]  = list( StringColumn(folder, name + ".vocab") )
+			else:
+				self.strings[name] = StringColumn(folder, name)
+
+		self.order = numpy.load("%s/id.order.npy" % folder, mmap_mode="r")
+
+
+	@classmethod
+	def for_project(cls, prj_tree):
+		prj_name = prj_tree.home[prj_tree.home.rindex("/") + 1 :]
+		return cls( "%s/%s_annotations" % (prj_tree.tables, prj_name) )
+
+
+	def __len__(self):
+		return self.rows
+
+
+	def column(self, name):
+		"""
+		NumPy array of an int, float or cat column (NA is INT_NA in an int
+		   column and nan in a float one; for a cat column, these are codes
+		   into self.vocab[name])
+		"""
+		return self.arrays[name]
+
+
+	def value(self, name, i):
+		kind = self.kinds[name]
+		if kind == "int":
+			v = int(self.arrays[name][i])
+			return None if v == INT_NA else v
+		elif kind == "float":
+			v = float(self.arrays[name][i])
+			return None if v != v else v
+		elif kind == "cat":
+			return self.vocab[name][ self.arrays[name][i] ]
+		else:
+			return self.strings[name][i]
+
+
+	def row(self, i):
+		"""dict column -> value for row i (None for NA in int and float columns)"""
+		return dict( (name, self.value(name, i)) for name, kind in COLUMNS if name in self.kinds )
+
+
+	def find(self, read_id):
+		"""row of a read id, or -1 if it is not in the store"""
+		ids = self.strings["id"]
+		low, high = 0, self.rows
+		while low < high:
+			mid = (low + high) // 2
+			if ids[ self.order[mid] ] < read_id:
+				low = mid + 1
+			else:
+				high = mid
+		if low < self.rows and ids[ self.order[low] ] == read_id:
+			return int(self.order[low])
+		return -1
+
+
+	def rows_with(self, name, values):
+		"""sorted rows whose value in an indexed column is one of values"""
+		index  = numpy.load("%s/%s.index.npy" % (self.folder, name), mmap_mode="r")
+		starts = numpy.load("%s/%s.starts.npy" % (self.folder, name), mmap_mode="r")
+		codes  = [ c for c, v in enumerate(self.vocab[name]) if v in values ]
+		if len(codes) == 0:
+			return numpy.zeros(0, dtype=numpy.int64)
+		return numpy.sort( numpy.concatenate([ index[ starts[c] : starts[c+1] ] for c in codes ]) )
+
+
+	def rows_with_gene(self, name, gene, top_only=False):
+		"""
+		sorted rows assigned to a gene (with or without an allele, eg IGHV1-2 or
+		   IGHV1-2*02) in V_genes, D_genes, J_genes or Ig_class; includes
+		   alternate assignments unless top_only is set
+		"""
+		matches = set()
+		for v in self.vocab[name]:
+			genes = v.split(",")[:1] if top_only else v.split(",")
+			if any( g == gene or g.split("*")[0] == gene for g in genes ):
+				matches.add(v)
+		return self.rows_with(name, matches)
+
+
+	def select(self, V=None, D=None, J=None, status=None, cdr3_aa_len=None, top_only=False):
+		"""
+		sorted rows matching all of the given filters:
+		   V, D, J       a gene, with or without an allele (see rows_with_gene)
+		   status        a status (eg "good") or a list of them
+		   cdr3_aa_len   a length or a (min, max) range, inclusive
+		"""
+
+		keep = numpy.ones(self.rows, dtype=numpy.bool_)
+		for name, gene in [ ("V_genes", V), ("D_genes", D), ("J_genes", J) ]:
+			if gene is not None:
+				mask = numpy.zeros(self.rows, dtype=numpy.bool_)
+				mask[ self.rows_with_gene(name, gene, top_only) ] = True
+				keep &= mask
+
+		if status is not None:
+			mask = numpy.zeros(self.rows, dtype=numpy.bool_)
+			mask[ self.rows_with("status", [status] if isinstance(status, basestring) else status) ] = True
+			keep &= mask
+
+		if cdr3_aa_len is not None:
+			low, high = (cdr3_aa_len, cdr3_aa_len) if isinstance(cdr3_aa_len, (int, long)) else cdr3_aa_len
+			lengths = self.arrays["cdr3_aa_len"]
+			keep &= (lengths != INT_NA) & (lengths >= low) & (lengths <= high)
+
+		return numpy.flatnonzero(keep)
+
+
+	def ids(self, rows):
+		ids = self.strings["id"]
+		return [ ids[i] for i in rows ]
+
+
+	def records(self, rows):
+		return [ self.row(i) for i in rows ]
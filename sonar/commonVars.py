@@ -9,8 +9,11 @@ Renamed by Chaim A Schramm on 2015-02-10.
 Copyright (c) 2011-2016 Columbia University and Vaccine Research Center, National Institutes of Health, USA. All rights reserved.
 """
 
-import sys, os, csv, shutil, re, glob, pickle, string, time, random, commands
+import sys, os, csv, shutil, re, glob, pickle, string, time, random
 from sonar.paths import *
+from sonar.lazyImport import LazyModule
+
+commands = LazyModule("commands")
 
 sep = "\t"
 linesep = os.linesep
@@ -0,0 +1,163 @@
+#!/usr/bin/env python
+
+"""
+derep.py
+
+Exact (full-length) dereplication of FASTA/FASTQ files of any size, in place
+      of "usearch -derep_fulllength" (which, as a 32-bit program, can only
+      hold about 3GB of reads at a time).
+
+Reads are streamed once and spread over partition files on disk according to
+      an md5 of their sequence, so that all copies of a sequence end up in
+      the same partition. Each partition is then dereplicated on its own, in
+      memory (in parallel, with threads > 1), and the sorted partitions are
+      merged back together. The number of partitions is chosen so that the
+      workers together stay within the given memory budget.
+
+Output follows usearch: unique sequences are sorted by decreasing abundance
+      (ties in order of first appearance) and written with the full title of
+      their first copy, with ";size=N;" added to the ID (ie, before the
+      first space, so that the rest of the title can still be parsed). The
+      optional .uc file has an S line for each unique sequence, an H line
+      (query ID, then the ID of the unique sequence as written) for each
+      additional copy and a C line with the size of each cluster. Sequences
+      are compared without regard to case.
+
+Copyright (c) 2011-2017 Columbia University and Vaccine Research Center, National
+                         Institutes of Health, USA. All rights reserved.
+
+"""
+
+import os, re, heapq, shutil, hashlib, tempfile
+from multiprocessing import Pool
+
+from sonar.seqReader import read_sequences, is_gzip
+
+
+#rough in-memory cost of a read relative to its size on disk, when dereplicating a partition
+MEMORY_FACTOR = 6
+
+#partition files are all open at once while splitting, so stay well under the usual limit of 1024 handles
+MAX_PARTITIONS = 512
+
+SIZE_LABEL = re.compile(";size=(\d+);?")
+
+
+
+def _partition_count(inputs, threads, memMB):
+	total = 0
+	for f in inputs:
+		#compressed input will be several times bigger once decompressed
+		total += os.path.getsize(f) * (4 if is_gzip(f) else 1)
+	return min( MAX_PARTITIONS, max( threads, int( total * MEMORY_FACTOR * threads / (memMB * 1024.0 * 1024) ) + 1 ) )
+
+
+def _split(inputs, folder, parts, sizeIn):
+	"""spread the reads over partition files by sequence hash; returns the number of reads"""
+
+	handles = [ open("%s/part_%04d.txt" % (folder, p), "w") for p in range(parts) ]
+	ordinal = 0
+	for f in inputs:
+		for title, seq in read_sequences(f, titles=True):
+			size = 1
+			if sizeIn:
+				found = SIZE_LABEL.search(title)
+				if found:
+					size  = int(found.group(1))
+					title = SIZE_LABEL.sub(";", title, 1).replace("; ", " ").rstrip(";")
+			digest = hashlib.md5(seq.upper()).digest()
+			handles[ (ord(digest[0]) * 256 + ord(digest[1])) % parts ].write("%d\t%d\t%s\t%s\n" % (ordinal, size, seq, title))
+			ordinal += 1
+	for handle in handles:
+		handle.close()
+	return ordinal
+
+
+def _derep_partition(partFile):
+	"""
+	dereplicate one partition, writing its unique sequences sorted by
+	   decreasing size and then first appearance, as lines of
+	   size, first read, sequence, IDs of the other copies, title
+	"""
+
+	clusters = dict()
+	with open(partFile) as handle:
+		for line in handle:
+			ordinal, size, seq, title = line.rstrip("\n").split("\t", 3)
+			key = seq.upper()
+			if key in clusters:
+				cluster = clusters[key]
+				cluster[0] += int(size)
+				cluster[3].append( title.split(None, 1)[0] if title else "" )
+			else:
+				clusters[key] = [ int(size), int(ordinal), seq, [], title ]
+
+	result = partFile.replace(".txt", ".sorted")
+	with open(result, "w") as handle:
+		for size, ordinal, seq, copies, title in sorted( clusters.values(), key=lambda c: (-c[0], c[1]) ):
+			handle.write( "%d\t%d\t%s\t%s\t%s\n" % (size, ordinal, seq, " ".join(copies), title) )
+	os.remove(partFile)
+	return result
+
+
+def _read_sorted(sortedFile):
+	with open(sortedFile) as handle:
+		for line in handle:
+			size, ordinal, seq, copies, title = line.rstrip("\n").split("\t", 4)
+			yield -int(size), int(ordinal), seq, copies, title
+
+
+def dereplicate(inputs, output, ucFile=None, sizeIn=False, sizeOut=True, minSize=0, threads=1, memMB=2048, tempDir=None):
+	"""
+	dereplicate one or more FASTA/FASTQ files into output (FASTA); returns
+	   the number of reads and the number of unique sequences written
+	"""
+
+	folder = tempfile.mkdtemp(prefix="sonar_derep_", dir=tempDir)
+	try:
+		parts = _partition_count(inputs, threads, memMB)
+		reads = _split(inputs, folder, parts, sizeIn)
+
+		partFiles = [ "%s/part_%04d.txt" % (folder, p) for p in range(parts) ]
+		if threads > 1:
+			pool = Pool(threads)
+			sortedFiles = pool.map(_derep_partition, partFiles)
+			pool.close()
+			pool.join()
+		else:
+			sortedFiles = map(_derep_partition, partFiles)
+
+		unique = 0
+		out    = open(output, "w")
+		uc     = open(ucFile, "w") if ucFile else None
+		sizes  = open("%s/sizes.uc" % folder, "w")
+		for negSize, ordinal, seq, copies, title in heapq.merge( *[ _read_sorted(f) for f in sortedFiles ] ):
+			size = -negSize
+			if size < minSize:
+				#everything after this is smaller still
+				break
+
+			words = title.split(None, 1)
+			label = words[0] if len(words) > 0 else ""
+			if sizeOut:
+				label += ";size=%d;" % size
+			out.write( ">%s\n%s\n" % (" ".join([label] + words[1:]), seq) )
+
+			if uc is not None:
+				uc.write( "S\t%d\t%d\t*\t*\t*\t*\t*\t%s\t*\n" % (unique, len(seq), label) )
+				for copy in copies.split():
+					uc.write( "H\t%d\t%d\t100.0\t+\t0\t0\t*\t%s\t%s\n" % (unique, len(seq), copy, label) )
+				sizes.write( "C\t%d\t%d\t*\t*\t*\t*\t*\t%s\t*\n" % (unique, size, label) )
+			unique += 1
+		out.close()
+		sizes.close()
+
+		if uc is not None:
+			with open("%s/sizes.uc" % folder) as handle:
+				shutil.copyfileobj(handle, uc)
+			uc.close()
+
+	finally:
+		shutil.rmtree(folder, ignore_errors=True)
+
+	return reads, unique
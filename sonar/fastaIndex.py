@@ -0,0 +1,239 @@
+#!/usr/bin/env python
+
+"""
+fastaIndex.py
+
+Random access to the records of a (large) FASTA file. The first time a file is
+      opened, the position of every record is saved next to it as NumPy
+      arrays in a folder (<file>.sfi/), which are memory-mapped when the
+      file is opened again, so that individual records can be pulled out of
+      a memory-mapped copy of the FASTA by ID or by V gene without parsing
+      the rest of it, or even reading the whole index:
+         offsets.npy, lengths.npy   byte offset and length of each record
+         hashes.npy, order.npy      a 64-bit hash (from md5) of each read
+                                       ID, sorted, and the records in that
+                                       order, for binary search by ID
+         vgene.codes.npy            the V_gene tag of each record (as
+                                       written by 1.3-finalize_assignments.py,
+                                       or NA if there is none), as codes
+                                       into the distinct tags in
+                                       vgene.vocab.data.npy/.offsets.npy
+      Titles are read from the FASTA itself, which also rules out any hash
+      collisions.
+
+The index remembers the size and modification time of the FASTA file and is
+      rebuilt automatically if either changes. If it can't be saved (eg in a
+      read-only folder), it is simply kept in memory.
+
+Copyright (c) 2011-2017 Columbia University and Vaccine Research Center, National
+                         Institutes of Health, USA. All rights reserved.
+
+"""
+
+import os, re, mmap, json, hashlib
+from array import array
+
+import numpy
+from Bio.Seq import Seq
+from Bio.SeqRecord import SeqRecord
+from Bio.Alphabet import single_letter_alphabet
+
+from sonar.annotationStore import StringColumn, _save_array, _save_strings
+
+
+SFI_FORMAT = 2
+
+
+def id_hashes(ids):
+	"""first 8 bytes of the md5 of each read ID, as unsigned 64-bit integers"""
+	if len(ids) == 0:
+		return numpy.zeros(0, dtype=numpy.uint64)
+	return numpy.frombuffer( "".join( hashlib.md5(i).digest()[:8] for i in ids ), dtype="<u8" ).astype(numpy.uint64)
+
+
+class FastaIndex:
+
+	def __init__(self, fasta, save=True):
+
+		self.fasta  = fasta
+		self.folder = fasta + ".sfi"
+
+		stat = os.stat(fasta)
+		self.stamp = "%d\t%.6f" % (stat.st_size, stat.st_mtime)
+
+		self.handle = open(fasta, "rb")
+		if stat.st_size > 0:
+			self.data = mmap.mmap(self.handle.fileno(), 0, access=mmap.ACCESS_READ)
+		else:
+			self.data = ""
+
+		if not self.load():
+			self.build()
+			if save:
+				self.save()
+
+
+	def load(self):
+		"""open a saved index, if there is one that matches the current FASTA file"""
+		try:
+			with open("%s/meta.json" % self.folder, "rU") as handle:
+				meta = json.load(handle)
+		except (IOError, ValueError):
+			return False
+		if meta.get("format") != SFI_FORMAT or meta.get("stamp") != self.stamp:
+			return False
+
+		self.offsets = numpy.load("%s/offsets.npy" % self.folder, mmap_mode="r")
+		self.lengths = numpy.load("%s/lengths.npy" % self.folder, mmap_mode="r")
+		self.hashes  = numpy.load("%s/hashes.npy" % self.folder, mmap_mode="r")
+		self.order   = numpy.load("%s/order.npy" % self.folder, mmap_mode="r")
+		self.vgenes  = numpy.load("%s/vgene.codes.npy" % self.folder, mmap_mode="r")
+		self.vocab   = list( StringColumn(self.folder, "vgene.vocab") )
+		return True
+
+
+	def build(self):
+		"""find the start of every record (any line beginning with '>', like SeqIO)"""
+
+		offsets, lengths, codes = array("l"), array("l"), array("l")
+		ids, vocab = [], dict()
+
+		size  = len(self.data)
+		start = 0 if self.data[:1] == ">" else self.data.find("\n>") + 1
+		if start == 0 and self.data[:1] != ">":
+			start = size
+		while start < size:
+			nextRecord = self.data.find("\n>", start)
+			end = nextRecord + 1 if nextRecord >= 0 else size
+
+			eol = self.data.find("\n", start, end)
+			title = self.data[ start + 1 : eol if eol >= 0 else end ].rstrip()
+			vgene = re.search("V_gene=(\S+)", title)
+
+			offsets.append(start)
+			lengths.append(end - start)
+			ids.append( self.first_word(title) )
+			codes.append( vocab.setdefault(vgene.group(1) if vgene else "NA", len(vocab)) )
+
+			start = end
+
+		self.offsets = numpy.array(offsets, dtype=numpy.int64)
+		self.lengths = numpy.array(lengths, dtype=numpy.int64)
+		self.vgenes  = numpy.array(codes, dtype=numpy.int64)
+		self.vocab   = sorted(vocab, key=vocab.get)
+
+		hashes       = id_hashes(ids)
+		self.order   = numpy.argsort(hashes, kind="mergesort")
+		self.hashes  = hashes[self.order]
+
+
+	def save(self):
+		"""
+		save the index; several processes may be building the same one at
+		   once (eg parallel runs of getFastaFromList.py), so every file is
+		   written to a temp file and renamed into place, and meta.json is
+		   taken away first and put back last, so that a reader never maps a
+		   partial index or one from an older version of the FASTA file
+		"""
+		try:
+			#indices from earlier versions were a single text file
+			if os.path.isfile(self.folder):
+				os.remove(self.folder)
+			if not os.path.isdir(self.folder):
+				os.makedirs(self.folder)
+			if os.path.isfile("%s/meta.json" % self.folder):
+				os.remove("%s/meta.json" % self.folder)
+			_save_array("%s/offsets.npy" % self.folder, self.offsets)
+			_save_array("%s/lengths.npy" % self.folder, self.lengths)
+			_save_array("%s/hashes.npy" % self.folder, self.hashes)
+			_save_array("%s/order.npy" % self.folder, self.order)
+			_save_array("%s/vgene.codes.npy" % self.folder, self.vgenes)
+			_save_strings(self.folder, "vgene.vocab", self.vocab)
+			temp = "%s/meta.json.%d.tmp" % (self.folder, os.getpid())
+			with open(temp, "w") as handle:
+				json.dump( dict(format=SFI_FORMAT, stamp=self.stamp), handle )
+			os.rename(temp, "%s/meta.json" % self.folder)
+		except (IOError, OSError):
+			pass
+
+
+	@staticmethod
+	def first_word(title):
+		words = title.split(None, 1)
+		return words[0] if len(words) > 0 else ""
+
+
+	def __len__(self):
+		return len(self.offsets)
+
+
+	def __contains__(self, read_id):
+		return len( self.find([read_id]) ) > 0
+
+
+	def title(self, n):
+		start, end = int(self.offsets[n]), int(self.offsets[n] + self.lengths[n])
+		eol = self.data.find("\n", start, end)
+		return self.data[ start + 1 : eol if eol >= 0 else end ].rstrip()
+
+
+	def find(self, ids):
+		"""record numbers of whichever of the ids are in the file, in file order"""
+
+		ids = list(set(ids))
+		if len(ids) == 0 or len(self.hashes) == 0:
+			return []
+
+		wanted = id_hashes(ids)
+		left   = numpy.searchsorted(self.hashes, wanted, "left")
+		right  = numpy.searchsorted(self.hashes, wanted, "right")
+		found  = []
+		for k in numpy.flatnonzero(right > left):
+			for n in self.order[ left[k] : right[k] ]:
+				if self.first_word( self.title(n) ) == ids[k]:
+					found.append( int(n) )
+		return sorted(found)
+
+
+	def record(self, n):
+		"""parse the n-th record of the file into a SeqRecord, the same way SeqIO would"""
+		start = int(self.offsets[n])
+		lines = self.data[ start : start + int(self.lengths[n]) ].split("\n")
+		title = lines[0][1:].rstrip()
+		seq   = "".join( line.rstrip() for line in lines[1:] ).replace(" ", "").replace("\r", "")
+		read_id = self.first_word(title)
+		return SeqRecord( Seq(seq, single_letter_alphabet), id=read_id, name=read_id, description=title )
+
+
+	def fetch(self, read_id):
+		"""the record with this id (the last one, if the id is repeated)"""
+		found = self.find([read_id])
+		if len(found) == 0:
+			raise KeyError(read_id)
+		return self.record( found[-1] )
+
+
+	def fetch_many(self, ids):
+		"""generate the records for whichever of the ids are in the file, in file order"""
+		for n in self.find(ids):
+			yield self.record(n)
+
+
+	def with_vgene(self, pattern):
+		"""
+		records whose V_gene tag matches a regular expression, in file order;
+		   records without a tag (eg from a custom FASTA file) are kept if
+		   the pattern matches anywhere in their title
+		"""
+		codes = [ c for c, tag in enumerate(self.vocab) if tag != "NA" and re.search(pattern, tag) ]
+		found = numpy.flatnonzero( numpy.in1d(self.vgenes, codes) ).tolist()
+		if "NA" in self.vocab:
+			untagged = numpy.flatnonzero( self.vgenes == self.vocab.index("NA") )
+			found   += [ int(n) for n in untagged if re.search(pattern, self.title(n)) ]
+		return [ self.record(n) for n in sorted(found) ]
+
+
+	def close(self):
+		if len(self.data) > 0:
+			self.data.close()
+		self.handle.close()
@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+
+"""
+lazyImport.py
+
+Stand-ins for modules (and names imported from modules) that are only
+      imported the first time they are actually used. The sonar package
+      exports Biopython, NumPy and friends to every script via
+      "from sonar import *", but many scripts (especially the small
+      utilities) never touch most of them, and importing them all up front
+      dominates the start-up time of those scripts.
+
+    SeqIO = LazyModule("Bio.SeqIO")              # instead of: from Bio import SeqIO
+    mean  = LazyObject("numpy", "mean")          # instead of: from numpy import mean
+
+Once loaded, a LazyModule copies the module's namespace into itself, so that
+      later attribute lookups cost the same as with the real module. A
+      LazyObject forwards calls and attribute lookups to the real object.
+
+Copyright (c) 2011-2017 Columbia University and Vaccine Research Center, National
+                         Institutes of Health, USA. All rights reserved.
+
+"""
+
+import sys
+
+
+def _import(name):
+	__import__(name)
+	return sys.modules[name]
+
+
+class LazyModule(object):
+
+	def __init__(self, name):
+		self.__dict__["_lazy_name"] = name
+
+	def _lazy_load(self):
+		module = _import(self._lazy_name)
+		self.__dict__.update(module.__dict__)
+		return module
+
+	def __getattr__(self, attr):
+		#only called for names that are not in __dict__ yet, ie before the module is loaded
+		return getattr(self._lazy_load(), attr)
+
+	def __setattr__(self, attr, value):
+		setattr(_import(self._lazy_name), attr, value)
+		self.__dict__[attr] = value
+
+	def __repr__(self):
+		return "<lazily imported module '%s'>" % self._lazy_name
+
+
+class LazyObject(object):
+
+	def __init__(self, module, name):
+		self.__dict__["_lazy_module"] = module
+		self.__dict__["_lazy_name"]   = name
+
+	def _lazy_load(self):
+		target = getattr(_import(self._lazy_module), self._lazy_name)
+		self.__dict__["_lazy_target"] = target
+		return target
+
+	def __getattr__(self, attr):
+		return getattr(self._lazy_load(), attr)
+
+	def __call__(self, *args, **kwargs):
+		try:
+			target = self.__dict__["_lazy_target"]
+		except KeyError:
+			target = self._lazy_load()
+		return target(*args, **kwargs)
+
+	def __repr__(self):
+		return "<lazily imported %s.%s>" % (self._lazy_module, self._lazy_name)
@@ -20,12 +20,14 @@ Options:
 	-p\tprotein or DNA sequence. default: DNA
 	-ap\t name of the program for sequence alignment. muscle or clustalo or mafft. required. Based on our 
 	   \texperience, muscle is ~2 fold faster than clustalo. Clustalo version of 1.2.0 or higher is required.
-	-pu\tpath to usearch program to remove duplicates in the read file. Optional.
+	-pu\tremove duplicates in the read file before the calculation, 0 or 1. Optional. (A path to
+	   \tusearch, as used by earlier versions, also turns this on; duplicates are now found by
+	   \tSONAR's own dereplication.)
   -CDR3\tWhether the calculation is for CDR3s, 0 or 1, Default:0
   -ignoregap\t whether positions containing gap should be removed from idenity calculation, 0 or 1. Default: 0
   
 Example:
-2.1-calculate_id-div.pl -f test.fa -g germline.fa -a antibody.fa -t 5 -npt 1000 -p DNA -ap muscle -pu usearch
+2.1-calculate_id-div.pl -f test.fa -g germline.fa -a antibody.fa -t 5 -npt 1000 -p DNA -ap muscle -pu 1
 
 Created by Zizhang Sheng.
 
@@ -40,7 +42,6 @@ my %para=@ARGV;
 if(!$para{'-t'}){$para{'-t'}=5;}
 if(!$para{'-npt'}){$para{'-npt'}=1000;}
 $para{'-ap'}=ppath($para{'-ap'});
-$para{'-pu'}=ppath($para{'-pu'});
 if(!$para{'-ignoregap'}){$para{'-ignoregap'}=0;}
 if(!$para{'-ap'}){
 	 if(ppath('muscle')){
@@ -121,7 +122,7 @@ foreach(sort keys %{$anti}){
 print YY "\n";
 my $file_calculation=$para{'-f'};
 if($para{'-pu'}){#dereplicate
-  system("$para{'-pu'} -derep_fulllength $para{'-f'} -threads $para{'-t'} -fastaout $changefile\_unique.fa -uc $changefile.cluster -sizeout > usearchlog.txt");
+  system("$FindBin::Bin/../utilities/dereplicate.py -f $para{'-f'} -t $para{'-t'} -o $changefile\_unique.fa -uc $changefile.cluster -nosize > usearchlog.txt");
   $file_calculation="$changefile\_unique.fa";
 }
 open READs,"$file_calculation"or die "$file_calculation not found\n";#read sequences and assign to threads
@@ -0,0 +1,216 @@
+#!/usr/bin/env python
+
+"""
+2.1-calculate_id-div.py
+
+This script calculates the divergence of each read from its assigned germline
+      V gene and its identity to one or more known antibodies, like
+      2.1-calculate_id-div.pl, but aligns the reads in-process (see
+      sonar/lineage/idDiv.py) instead of calling MUSCLE once per pair.
+      Reads are processed in batches spread over several worker processes.
+      The output tables have the same names and layout as those of the Perl
+      script, so they can be used in exactly the same way.
+
+Usage: 2.1-calculate_id-div.py [ -f reads.fa -g germline.fa -a natives.fa
+                                 -t 5 -npt 1000 -p DNA -pu 1 -CDR3 0
+                                 -ignoregap 0 -gapopen 1000 -band 16 ]
+
+    All options are optional, see below for defaults.
+    Invoke with -h or --help to print this documentation.
+
+    f           Sequence file. If reads come from different germline V genes,
+                   the title of each read should contain a field giving its
+                   V gene, eg ">00000089 V_gene=IGHV1-2*02", as in the fasta
+                   files output by the pipeline.
+                   Default = output/sequences/nucleotide/<project>_goodVJ_unique.fa
+                   (or _goodVJ.fa).
+    g           Germline V gene file. Default = IgHKLV.fa in the germDB folder.
+    a           Fasta file with the sequences of known antibodies. Optional.
+    t           Number of worker processes. Default = 5.
+    npt         Number of reads per batch. Default = 1000.
+    p           "DNA" or "protein" sequences. Default = DNA.
+    pu          Remove duplicate reads before the calculation (and copy their
+                   results to the duplicates afterwards), 0 or 1. Default = 0.
+    CDR3        Whether the calculation is for CDR3s, 0 or 1 (only changes
+                   the name of the output). Default = 0.
+    ignoregap   Leave positions with a gap out of the identity calculation, 0
+                   or 1. Default = 0.
+    gapopen     Cost of opening a gap inside an alignment (gaps at the ends of
+                   either sequence are free). Default = 1000 for DNA, which
+                   keeps reads ungapped, as "muscle -gapopen -1000" does for
+                   the Perl script, and 5 for protein.
+    band        Width of the band, to either side of the diagonal found by
+                   k-mer matches, to which alignments are confined.
+                   Default = 16.
+
+Copyright (c) 2011-2017 Columbia University and Vaccine Research Center, National
+                         Institutes of Health, USA. All rights reserved.
+
+"""
+
+import sys, glob, time, itertools
+
+try:
+	from sonar.lineage import *
+except ImportError:
+	find_SONAR = sys.argv[0].split("sonar/lineage")
+	sys.path.append(find_SONAR[0])
+	from sonar.lineage import *
+
+from multiprocessing import Pool
+from sonar.lineage.idDiv import read_references, read_batches, init_worker, process_batch
+
+
+
+def recover_duplicates(ucFile, rows):
+	"""results for the reads that were collapsed into each unique sequence, from the H lines of the .uc file"""
+	copies = []
+	with open(ucFile) as handle:
+		for line in handle:
+			if line.startswith("H"):
+				fields = line.rstrip("\n").split("\t")
+				if fields[9] in rows:
+					copies.append( "\t".join( [fields[8]] + rows[fields[9]].split("\t")[1:] ) )
+	return copies
+
+
+def add_column_to_statistic(idFile):
+	"""add germline divergence to the all_seq_stats table, if it's there"""
+
+	with open(idFile) as handle:
+		header = handle.readline().split("\t")
+		if len(header) < 2 or "germ_div" not in header[1]:
+			print "Unexpected header line %s, cannot add %s to statistics file!" % ("\t".join(header), idFile)
+			return
+		divergence = dict()
+		for line in handle:
+			row = line.rstrip("\n").split("\t")
+			divergence[row[0]] = row[1]
+
+	stats = glob.glob("./output/tables/*all_seq_stats.txt")
+	if len(stats) == 0:
+		print "\n\nCould not find master table in output/tables/ \n\t-cannot add germline divergence to the all_seq_stats table for use with 4.1_setup_plots.pl\n"
+		return
+
+	with open(stats[0], "rU") as handle:
+		lines = handle.read().splitlines()
+	if len(lines) == 0 or "V_div" in lines[0]:
+		return
+
+	with open(stats[0], "w") as output:
+		output.write("%s\tV_div\n" % lines[0])
+		for line in lines[1:]:
+			if re.match("\w", line):
+				seq_id = line.split("\t")[0]
+				output.write( "%s\t%s\n" % (line, divergence[seq_id] + "%" if divergence.get(seq_id) else "NA") )
+
+
+def main():
+
+	start = time.time()
+
+	germlines = None
+	if germFile is not None:
+		germlines = read_references(germFile)
+	natives = dict()
+	if nativeFile is not None:
+		natives = read_references(nativeFile)
+
+	#output files go where the Perl script puts them
+	base = os.path.basename( re.sub("\.fa.*", "", inFile) )
+	idFile  = "%s%s" % (base, "_CDR3-id.tab" if cdr3 else "_id-div.tab")
+	covFile = "%s_coverage.tab" % base
+	if os.path.isdir("./output/tables"):
+		idFile, covFile = "./output/tables/%s" % idFile, "./output/tables/%s" % covFile
+
+	readFile = inFile
+	if unique:
+		readFile, ucFile = "%s_unique.fa" % base, "%s.cluster" % base
+		dereplicate( [inFile], readFile, ucFile=ucFile, sizeOut=False, threads=threads )
+
+	idHandle  = open(idFile, "w")
+	covHandle = open(covFile, "w")
+	idHandle.write( "\t".join( ["ID"] + (["germ_div"] if germlines is not None else []) + sorted(natives) ) + "\n" )
+
+	settings = (germlines, natives, protein, gapopen, band, ignoreGap)
+	if threads > 1:
+		pool    = Pool(threads, init_worker, settings)
+		results = pool.imap(process_batch, read_batches(readFile, batchSize))
+	else:
+		init_worker(*settings)
+		results = itertools.imap(process_batch, read_batches(readFile, batchSize))
+
+	#keep the rows of the unique reads to copy to their duplicates
+	idRows, covRows = dict(), dict()
+	count = 0
+	for ids, covs in results:
+		for idRow, covRow in zip(ids, covs):
+			idHandle.write(idRow + "\n")
+			covHandle.write(covRow + "\n")
+			if unique:
+				seq_id = idRow.split("\t", 1)[0]
+				idRows[seq_id], covRows[seq_id] = idRow, covRow
+		count += len(ids)
+		print "%d sequences processed..." % count
+
+	if threads > 1:
+		pool.close()
+		pool.join()
+
+	if unique:
+		for row in recover_duplicates(ucFile, idRows):
+			idHandle.write(row + "\n")
+		for row in recover_duplicates(ucFile, covRows):
+			covHandle.write(row + "\n")
+		os.remove(readFile)
+		os.remove(ucFile)
+
+	idHandle.close()
+	covHandle.close()
+	print "Calculated identity and divergence for %d sequences in %.1f seconds." % (count, time.time() - start)
+
+	add_column_to_statistic(idFile)
+
+
+if __name__ == '__main__':
+
+	#check if I should print documentation
+	q = lambda x: x in sys.argv
+	if any([q(x) for x in ["h", "-h", "--h", "help", "-help", "--help"]]):
+		print __doc__
+		sys.exit(0)
+
+	#log command line
+	logCmdLine(sys.argv)
+
+	# get parameters from input
+	dict_args = processParas(sys.argv, f="inFile", g="germFile", a="nativeFile", t="threads", npt="batchSize", p="seqType",
+				 pu="unique", CDR3="cdr3", ignoregap="ignoreGap", gapopen="gapopen", band="band")
+	inFile, germFile, nativeFile, threads, batchSize, seqType, unique, cdr3, ignoreGap, gapopen, band = \
+		getParasWithDefaults(dict_args, dict(inFile=None, germFile=VHKL_DB, nativeFile=None, threads=5, batchSize=1000, seqType="DNA",
+						     unique=0, cdr3=0, ignoreGap=0, gapopen=None, band=16),
+				     "inFile", "germFile", "nativeFile", "threads", "batchSize", "seqType", "unique", "cdr3", "ignoreGap", "gapopen", "band")
+
+	if inFile is None or not os.path.isfile(inFile):
+		found = glob.glob("./output/sequences/nucleotide/*goodVJ_unique.fa") + glob.glob("./output/sequences/nucleotide/*goodVJ.fa")
+		if len(found) == 0:
+			sys.exit("Sequence file %s doesn't exist." % inFile)
+		inFile = found[0]
+		print "Using sequence file %s" % inFile
+
+	if os.path.isfile(germFile):
+		print "using %s as germline file" % germFile
+	else:
+		sys.stderr.write("No calculation for hypermutation\n")
+
+	if nativeFile is None:
+		sys.stderr.write("No native sequence file specified; only divergence will be calculated...\n")
+
+	protein = re.search("protein", seqType, re.I) is not None
+	if gapopen is None:
+		gapopen = 5 if protein else 1000
+
+	#Perl-style 0/1 flags
+	unique, cdr3, ignoreGap = [ str(x) not in ["0", ""] for x in (unique, cdr3, ignoreGap) ]
+
+	main()
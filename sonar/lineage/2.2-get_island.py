@@ -4,11 +4,18 @@
 2.2-get_island.py
 
 This script selects sequences based on their positions in an identity-divergence
-      plot and copies them to a unique file.
+      plot and copies them to a unique file. Any number of islands can be
+      listed in a file (see -islands), in which case all of them are
+      extracted together, in a single pass through the sequence file, each
+      to its own output.
+      The identity-divergence table is indexed the first time it is used
+      (see sonar/lineage/idDivIndex.py), so that later queries don't have
+      to read it again.
 
 Usage: 2.2-get_island.py -n native [-imin min_identity -imax max_indentity
                                     -dmin min_divergence -dmax max_divergence
 				    -seq seqs.fa -div id-div.tab]
+       2.2-get_island.py -islands islands.txt [-seq seqs.fa -div id-div.tab]
 
     Invoke with -h or --help to print this documentation.
 
@@ -23,6 +30,10 @@ Usage: 2.2-get_island.py -n native [-imin min_identity -imax max_indentity
                    pipeline output with "goodVJ_unique" nucleotide sequences.
     div		If a custom sequence file is used, please specify the location
                    of the corresponding output from 2.1-calculate_id-div.pl.
+    islands	File listing islands to extract, one per line as
+                   "native imin imax dmin dmax" (separated by spaces or tabs;
+                   lines starting with # are skipped). Replaces -n, -imin,
+                   -imax, -dmin and -dmax.
 
 Created by Chaim A Schramm, 2012-10-04.
 Edited and commented for publication by Chaim A Schramm on 2015-04-20.
@@ -37,55 +48,77 @@ import sys
 try:
         from sonar.lineage import *
 except ImportError:
-        find_SONAR = sys.argv[0].split("sonar/annotate")
+        find_SONAR = sys.argv[0].split("sonar/lineage")
         sys.path.append(find_SONAR[0])
         from sonar.lineage import *
 
+from sonar.lineage.idDivIndex import IdDivIndex
+
 global inFile, native
 
 
+def read_islands(boxFile):
+	"""(native, min_iden, max_iden, min_div, max_div) for each line of a file of islands"""
+	islands = []
+	with open(boxFile, "rU") as handle:
+		for line in handle:
+			fields = line.split()
+			if len(fields) == 0 or fields[0].startswith("#"):
+				continue
+			if len(fields) != 5:
+				sys.exit("Can't parse island '%s' in %s (expected: native imin imax dmin dmax)." % (line.strip(), boxFile))
+			islands.append( tuple( [fields[0]] + [ float(x) for x in fields[1:] ] ) )
+	return islands
+
+
 def main():
 	
 	if not os.path.isfile(divFile):
 		sys.exit("Please run 2.1-calulate_id-div.pl before running this script!")
 
-	reader 	= csv.reader(open(divFile, "rU"), delimiter = sep)
-	natives = reader.next()[2:]
-
-	try:
-		pos = natives.index(native)
-	except:
-		sys.exit("Can't find desired mAb in %s (options are %s)." % (divFile, ", ".join(natives)))
-
-	# a dictionary for keeping track of those that survive the filter
-	island = []
-		
-	bad = 0
-	for row in reader:
-		if len(row) - 2 < len(natives):
-			pass;
-		elif row[1] == "NA" or row[2+pos] == "NA":
-			bad+=1
-		else:
-			read_id, divergence, identity = row[0], float(row[1]), float(row[2+pos])
-			if (divergence >= min_div and divergence <= max_div and identity >= min_iden and identity <= max_iden):
-				island.append(read_id)
-
-
-	#error checking
-	if len(island) == 0:
-		sys.exit( "No reads were in found in the specificed island (referent = %s; id: %d-%d; div: %d-%d).\n Please check boundaries and try again." % 
-			  ( native, min_iden, max_iden, min_div, max_div ) )
-
-	#now get the sequences
-	print "Found %d sequences in the island" % len(island)
-	island_reads = load_fastas_in_list(inFile, island)
-
-	#and write
-	outfile = "%s/%s_%s_id%d-%d_div%d-%d.fasta" % (prj_tree.nt, prj_name, native, min_iden, max_iden, min_div, max_div)
-	handle = open(outfile, "w")
-	SeqIO.write(island_reads.values(), handle, "fasta")
-	handle.close()
+	index = IdDivIndex(divFile)
+	for island in islands:
+		if island[0] not in index.natives:
+			sys.exit("Can't find desired mAb in %s (options are %s)." % (divFile, ", ".join(index.natives)))
+
+	# read ID -> the islands it belongs to
+	members = dict()
+	outputs = []
+	for n, (native, min_iden, max_iden, min_div, max_div) in enumerate(islands):
+		island = index.ids( index.island(native, min_iden, max_iden, min_div, max_div) )
+
+		#error checking
+		if len(island) == 0:
+			message = "No reads were in found in the specificed island (referent = %s; id: %d-%d; div: %d-%d).\n Please check boundaries and try again." % \
+				  ( native, min_iden, max_iden, min_div, max_div )
+			if len(islands) == 1:
+				sys.exit(message)
+			print message
+			continue
+
+		print "Found %d sequences in the island (referent = %s; id: %d-%d; div: %d-%d)" % ( len(island), native, min_iden, max_iden, min_div, max_div )
+		outputs.append( "%s/%s_%s_id%d-%d_div%d-%d.fasta" % (prj_tree.nt, prj_name, native, min_iden, max_iden, min_div, max_div) )
+		for read_id in island:
+			members.setdefault(read_id, []).append(len(outputs) - 1)
+
+	if len(outputs) == 0:
+		sys.exit("None of the islands in %s have any reads." % boxFile)
+
+	#now get the sequences for all islands at once, in a single pass through the file
+	print "loading reads from %s..." % inFile
+	handles = [ open(outfile, "w") for outfile in outputs ]
+	reads   = FastaIndex(inFile)
+	written = set()
+	for record in reads.fetch_many(members):
+		if record.id in written:
+			continue
+		written.add(record.id)
+		for n in members[record.id]:
+			SeqIO.write([record], handles[n], "fasta")
+	reads.close()
+	for handle in handles:
+		handle.close()
+	print "%d loaded...." % len(written)
 
 
 
@@ -107,14 +140,22 @@ if __name__ == '__main__':
 	prj_tree 	= ProjectFolders(os.getcwd())
 	prj_name 	= fullpath2last_folder(prj_tree.home)
 	
-	dict_args = processParas(sys.argv, n="native",imin="min_iden",imax="max_iden",dmin="min_div",dmax="max_div", seq="inFile", div="divFile")
-	defaults = dict( native="",min_iden=85,max_iden=100,min_div=0,max_div=40,inFile="%s/%s_goodVJ.fa"%(prj_tree.nt, prj_name),divFile="%s/%s_goodVJ_unique_id-div.tab" % (prj_tree.tables, prj_name) )
-	native,min_iden,max_iden,min_div,max_div,inFile,divFile = getParasWithDefaults(dict_args, defaults, "native","min_iden","max_iden","min_div","max_div","inFile", "divFile")
+	dict_args = processParas(sys.argv, n="native",imin="min_iden",imax="max_iden",dmin="min_div",dmax="max_div", seq="inFile", div="divFile", islands="boxFile")
+	defaults = dict( native="",min_iden=85,max_iden=100,min_div=0,max_div=40,inFile="%s/%s_goodVJ.fa"%(prj_tree.nt, prj_name),divFile="%s/%s_goodVJ_unique_id-div.tab" % (prj_tree.tables, prj_name), boxFile=None )
+	native,min_iden,max_iden,min_div,max_div,inFile,divFile,boxFile = getParasWithDefaults(dict_args, defaults, "native","min_iden","max_iden","min_div","max_div","inFile", "divFile", "boxFile")
 	
-	if native == "":
+	if boxFile is not None:
+		if not os.path.isfile(boxFile):
+			sys.exit("Can't find island file %s." % boxFile)
+		islands = read_islands(boxFile)
+		if len(islands) == 0:
+			sys.exit("No islands found in %s." % boxFile)
+	elif native == "":
 		print "Please specify native mAb to use as identity referent.\n\n"
 		print __doc__
 		sys.exit(1)
+	else:
+		islands = [ (str(native), min_iden, max_iden, min_div, max_div) ]
 
 	main()
 
@@ -12,8 +12,31 @@ This script uses an iterative phylogenetic analysis to find sequences related
       next iteration. The algorithm is considered to have converged when 95%
       of the input sequences in a round are in the minimum sub-tree.
 
-This script has an option to run the analysis as a cluster job. If run locally,
-      can be multithreaded with use of the -threads parameter.
+By default, trees are built in-process (see sonar/lineage/njTree.py) from
+      distances between sequences aligned to the germline, which is much
+      faster than building a full MUSCLE alignment of each split just to get
+      its guide tree, and makes larger splits (-npf) practical. Each read is
+      only aligned once, in the first round it appears in: the alignments
+      are kept in work/lineage/projections/ (a subfolder for each set of
+      germline and natives) and reused in later rounds (and when an
+      analysis is restarted), so the reads that are retained from
+      one round to the next cost only their share of the distance matrix.
+      The number of reads found there each round is written to the log.
+      MUSCLE can still be used instead with "-engine muscle".
+
+The first round, which uses every read assigned to the right V gene, can be
+      made much cheaper by leaving out reads that are obviously unrelated to
+      the natives before building any trees, with the -minKmer, -cdr3Diff
+      and/or -cdr3Id cutoffs below (see sonar/lineage/candidateFilter.py).
+      The number of reads dropped is written to the log and the dropped
+      reads themselves, with their scores, to
+      work/lineage/prefilter_dropped.tab, so that it is easy to check that
+      none of them would have been among the positives.
+
+This script has an option to submit the tree-building jobs of each round to a
+      cluster (the script itself keeps running to collect them and start the
+      next round); these always use MUSCLE. If run locally, can be
+      multithreaded with use of the -threads parameter.
 
 This algorithm is generally intended to find somatically related antibodies
       from a single lineage within a single donor. However, in the special
@@ -30,7 +53,8 @@ This algorithm is generally intended to find somatically related antibodies
 Usage: 2.3-intradonor_analysis.py -n native.fa -v germline_V
                                  [-locus <H|K|L|C> -lib path/to/library.fa
 				  -i custom/input.fa -maxIters 15
-				  -cluster -npf 250 -threads 1
+				  -cluster -npf 250 -threads 1 -engine native
+				  -minKmer 0.5 -cdr3Diff 3 -cdr3Id 50
 				  -nofilter -a -h -f]
 
     Invoke with -h or --help to print this documentation.
@@ -58,9 +82,23 @@ Usage: 2.3-intradonor_analysis.py -n native.fa -v germline_V
 		   the MSA but fewer iterations to convergence. Default = 250
 		   when running locally and 1,000 on a cluster.
     threads     Number of threads to use when running locally. Default = 1.
+    engine      How to build the trees when running locally. "native" builds
+                   neighbor-joining trees in-process; "muscle" uses the guide
+                   tree of a MUSCLE alignment of each split. Default = native.
+    minKmer     Pre-filter: minimum fraction of the 12-mers of a read that
+                   must also be found in a native for the read to be used.
+                   Default = 0 (off).
+    cdr3Diff    Pre-filter: maximum difference in length (in amino acids)
+                   between the CDR3 of a read, as annotated by 1.3, and the
+                   closest native CDR3. Default = off.
+    cdr3Id      Pre-filter: minimum percent identity of the CDR3 of a read to
+                   any native CDR3. Default = 0 (off).
+                   Reads without a CDR3 annotation are only checked against
+                   -minKmer.
 
     Optional flags:
-    cluster	Submit tree-building jobs to the cluster.
+    cluster	Submit tree-building jobs to the cluster (SGE or Slurm, as set up
+                   by setup.sh). Failed jobs are resubmitted.
     nofilter	Do NOT filter NGS sequences for correct germline V gene
                    assignment. Default = OFF (DO filter).
     a		Use all NGS sequences with an assigned V, even those with
@@ -87,9 +125,7 @@ Copyright (c) 2011-2016 Columbia University Vaccine Research Center, National
 import time, sys
 from multiprocessing import Pool
 from functools import partial
-from cStringIO import StringIO
 from sonar.lineage import *
-from Bio import Phylo
 from Bio.Align.Applications import MuscleCommandline
 
 try:
@@ -99,6 +135,11 @@ except ImportError:
 	sys.path.append(find_SONAR[0])
 	from sonar.lineage import *
 
+import numpy
+from sonar.lineage.njTree import anchor_frame, project, projected_distances, ProjectionCache, neighbor_joining, to_newick, ALIGN_BATCH
+from sonar.lineage.compactTree import CompactTree
+from sonar.lineage.candidateFilter import CandidateScorer, KMER
+from sonar.annotate.germlineCache import find_cys
 
 
 def muscleProcess (threadID, filebase, outbase, treebase):
@@ -116,6 +157,80 @@ def muscleProcess (threadID, filebase, outbase, treebase):
 	thisVarHidesTheOutput = run_muscle()
 
 
+def njProcess (threadID, filebase, treebase, cacheFolder, frame):
+
+	fasta    = filebase % threadID
+	treeFile = treebase % threadID
+
+	print "Building NJ tree from %s" % fasta
+
+	names, seqs = zip( *read_sequences(fasta) )
+	cache = ProjectionCache(cacheFolder, frame)
+	keys  = [ ProjectionCache.key(name, seq) for name, seq in zip(names, seqs) ]
+	if all(k in cache for k in keys):
+		proj = cache.fetch(keys)
+	else:
+		proj = project(seqs, frame)
+	tree = neighbor_joining( names, projected_distances(proj) )
+	with open(treeFile, "w") as handle:
+		handle.write( to_newick(tree) + "\n" )
+
+
+def alignNewReads (records, cacheFolder, frame):
+	"""add the projections of any reads not in the cache yet; returns the number that were there already"""
+
+	cache   = ProjectionCache(cacheFolder, frame)
+	missing = dict()
+	for r in records:
+		key = ProjectionCache.key(r.id, r.seq)
+		if key not in cache:
+			missing[key] = str(r.seq)
+	keys = missing.keys()
+
+	if len(keys) > 0:
+		chunks = [ [ missing[k] for k in keys[start : start + ALIGN_BATCH] ] for start in range(0, len(keys), ALIGN_BATCH) ]
+		if numThreads > 1 and len(chunks) > 1:
+			align_pool = Pool(numThreads)
+			projections = align_pool.map( partial(project, frame=frame), chunks )
+			align_pool.close()
+			align_pool.join()
+		else:
+			projections = [ project(chunk, frame) for chunk in chunks ]
+		cache.add( keys, numpy.vstack(projections) )
+
+	return len(records) - len(keys)
+
+
+def prefilterReads (read_dict, log):
+	"""drop reads that fail any of the pre-filter cutoffs, saving their scores to prefilter_dropped.tab"""
+
+	scorer = CandidateScorer( natives.values(), germ_seq.seq, find_cys(germlineV, str(germ_seq.seq).upper()), jMotif )
+	if (cdr3Diff is not None or cdr3Id > 0) and len(scorer.cdr3s) == 0:
+		print "Couldn't find the CDR3 of any native antibody, so reads will only be pre-filtered on k-mers."
+
+	ids = read_dict.keys()
+	kmers, lenDiff, identity = scorer.score( [ read_dict[i] for i in ids ] )
+
+	#comparisons with NaN (no CDR3) are always false, so those reads never fail
+	with numpy.errstate(invalid="ignore"):
+		failKmer = kmers < minKmer
+		failLen  = lenDiff > cdr3Diff if cdr3Diff is not None else numpy.zeros(len(ids), dtype=bool)
+		failId   = identity < cdr3Id
+	drop = failKmer | failLen | failId
+
+	reportFile = "%s/prefilter_dropped.tab" % prj_tree.lineage
+	with open(reportFile, "w") as report:
+		report.write( "ID\tkmer_containment\tcdr3_len_diff\tcdr3_identity\n" )
+		for n in numpy.flatnonzero(drop):
+			report.write( "%s\t%.3f\t%s\t%s\n" % (ids[n], kmers[n], "NA" if numpy.isnan(lenDiff[n]) else "%d" % lenDiff[n],
+								"NA" if numpy.isnan(identity[n]) else "%.2f" % identity[n]) )
+
+	message = "Pre-filter kept %d of %d reads (dropped %d: %d on %d-mers, %d on CDR3 length, %d on CDR3 identity; see %s)" % \
+		  ( len(ids) - drop.sum(), len(ids), drop.sum(), failKmer.sum(), KMER, failLen.sum(), failId.sum(), reportFile )
+	log.write( "%s - %s\n" % (time.strftime("%H:%M:%S"), message) )
+	print "%s - %s" % (time.strftime("%H:%M:%S"), message)
+
+	return dict( (ids[n], read_dict[ids[n]]) for n in numpy.flatnonzero(~drop) )
 
 
 def main():
@@ -138,50 +253,21 @@ def main():
 	        #this gets skipped in the first round
 		for idx, tf in enumerate(tree_files):
 			
-		        #read in the tree as a string
-			tree_string = open(tf, "rU").read().strip()
-			
-			#get rid of possible negative branch lengths and then parse
-			tree_string, num = re.subn(":-\d+\.\d+",":0", tree_string)
-			tree_string, num = re.subn("\n","", tree_string)
-
-			#need to supply comments_are_confidence=True to prevent Phylo from interpreting numeric sequence IDs as bootstrap support
-			tree = Phylo.read(StringIO(tree_string), "newick", comments_are_confidence=True)
+			tree = CompactTree.read(tf)
 
-			
-			#outgroup root the tree on the germline
-			try:
-				germ_node = tree.find_clades(germlineV).next()
-			except StopIteration:
+			#the subtree with all natives, once the tree is rooted on the germline
+			if tree.find(germlineV) < 0:
 				sys.exit( "Can't find germline gene %s in file %s" % (germlineV, tf) )
-			tree.root_with_outgroup(germ_node)
-
-
-			# start by finding one of the natives
-			try:
-				nat1 = tree.find_clades(natives_list[0]).next()
-			except StopIteration:
+			if tree.find(natives_list[0]) < 0:
 				sys.exit( "Can't find native antibody %s in file %s" % (natives_list[0], tf) )
-
-				
-			#walk up the tree from this starting point until we find the minimum sub-tree with all natives
-			path_to_nat1 = tree.get_path(nat1)
-			level = -2
-			subtree = path_to_nat1[level]
-			all_leaves = [node.name for node in subtree.get_terminals()]
-			try:
-				while not all( [ nat in all_leaves for nat in natives_list ] ):
-					level -= 1
-					subtree = path_to_nat1[level]
-					all_leaves = [node.name for node in subtree.get_terminals()]
-			except IndexError:
+			all_leaves = tree.native_subtree(germlineV, natives_list)
+			if all_leaves is None:
 				sys.exit( "Can't find a subtree with all native sequences in file %s" % tf )
-		
-				
+
 			# save sequences in subtree and print progress message
 			retained_reads += all_leaves
 			good += len(all_leaves) - num_nats
-			total += len(tree.get_terminals()) - num_nats - 1 #also don't count germline
+			total += len(tree.leaves()) - num_nats - 1 #also don't count germline
 			if idx % 25 == 0 and not cluster:
 				print "Found %d reads in subtree #%d. Total saved so far: %d / %d" % ( len(all_leaves)-num_nats, idx+1, good, total-1)
 
@@ -203,6 +289,8 @@ def main():
 				read_dict = load_fastas_with_Vgene( inFile, germlineV.split("*")[0] )
 			else:
 				read_dict = load_fastas( inFile )
+			if prefilter:
+				read_dict = prefilterReads( read_dict, log )
 		else:
 			read_dict = load_seqs_in_dict( inFile, set(retained_reads) )
 
@@ -273,43 +361,41 @@ def main():
 				f_ind -= 1 #don't submit an empty file to the cluster
 
 				
-			# At this point, if we are running on the cluster, submit this round and quit loop
+			# At this point, if we are running on the cluster, submit this round and wait for it
 			if cluster:
-				# write pbs files and auto submit shell script
-				command = "NUM=`printf \"%%05d\" $SGE_TASK_ID`\n%s -in %s/NJ$NUM.fa -out %s/NJ$NUM.aln -cluster1 neighborjoining -maxiters 1 -tree1 %s/NJ$NUM.tree" % \
-				    (cluster_muscle, prj_tree.lineage, prj_tree.lineage, prj_tree.lineage)
-				pbs = open("%s/intradonor.sh" % prj_tree.lineage, 'w')
-				pbs.write( PBS_STRING%("%s-intradonor"%prj_name, "500M", "1:00:00", "%s > %s/NJ$NUM.out 2> %s/NJ$NUM.err"%(command, prj_tree.lineage, prj_tree.lineage)) )
-				pbs.close()
-
-				# write a second PBS job to restart this script once muscle has finished
-				next_round = open("%s/nextround.sh" % prj_tree.lineage, 'w')
-				next_round.write( "\
-#!/bin/bash\n\
-#$ -hold_jid %s-intradonor\t\t# run once previous round has completed\n\
-#$ -N restart-intradonor\t\t# job name\n\
-#$ -l mem=1G,time=1:00:00\t\t# resource requests\n\
-#$ -cwd\t\t\t\t\t# use current directory\n\
-#$ -o %s/restart-intradonor.out\t#output\n\
-#$ -e %s/restart-intradonor.err\t#error\n\
-%s/lineage/2.3-intradonor_analysis.py -n %s -v %s -locus %s -lib %s -i %s -maxIters %d -cluster\n" % 
-						  (prj_name, prj_tree.lineage, prj_tree.lineage, SCRIPT_FOLDER, natFile, germlineV, locus, library, inFile, maxIters-1) )
-				next_round.close()
-
-				os.system( "%s -t 1-%d %s/intradonor.sh" % (qsub, f_ind, prj_tree.lineage) )
-				os.system( "%s %s/nextround.sh"  % (qsub, prj_tree.lineage) )
+				graph = TaskGraph("%s/tasks" % prj_tree.lineage, get_cluster_backend(numThreads), prefix=prj_name)
+				for ind in range(1, f_ind+1):
+					base = "%s/NJ%05d" % (prj_tree.lineage, ind)
+					graph.add( "NJ%05d" % ind, "%s -in %s.fa -out %s.aln -cluster1 neighborjoining -maxiters 1 -tree1 %s.tree > %s.out 2> %s.err" % (cluster_muscle, base, base, base, base, base),
+						   outputs=[base+".tree"], mem="500M", time="1:00:00" )
+
 				log.write( "%s - Submitted current round to cluster\n" % time.strftime("%H:%M:%S") )
-				log.close()
-				break #exits "while not converged" loop
+				log.flush()
+				if not graph.run():
+					log.write( "%s - Error: some tree-building jobs failed, stopped\n" % time.strftime("%H:%M:%S") )
+					log.close()
+					sys.exit( "Error: some tree-building jobs failed; see %s/tasks for the job scripts" % prj_tree.lineage )
 
 			else:
 				#run locally
-				partial_muscle = partial( muscleProcess, filebase="%s/NJ%%05d.fa"%prj_tree.lineage, 
-							  outbase="%s/NJ%%05d.aln"%prj_tree.lineage, treebase="%s/NJ%%05d.tree"%prj_tree.lineage )
-				muscle_pool = Pool(numThreads)
-				muscle_pool.map(partial_muscle, range(1,f_ind+1))
-				muscle_pool.close()
-				muscle_pool.join()
+				if engine == "native":
+					#align only the reads that weren't in a previous round
+					cacheFolder = "%s/projections" % prj_tree.lineage
+					records     = shuffled_reads + [ germ_seq ] + natives.values()
+					hits        = alignNewReads( records, cacheFolder, frame )
+					log.write( "%s - Round %d: %d of %d sequences already aligned (%5.2f%% cache hits)\n" % (time.strftime("%H:%M:%S"), currentIter, hits, len(records), 100.0*hits/len(records)) )
+					log.flush()
+					print "%s - Round %d: %d of %d sequences already aligned (%5.2f%% cache hits)" % (time.strftime("%H:%M:%S"), currentIter, hits, len(records), 100.0*hits/len(records))
+
+					partial_tree = partial( njProcess, filebase="%s/NJ%%05d.fa"%prj_tree.lineage,
+								treebase="%s/NJ%%05d.tree"%prj_tree.lineage, cacheFolder=cacheFolder, frame=frame )
+				else:
+					partial_tree = partial( muscleProcess, filebase="%s/NJ%%05d.fa"%prj_tree.lineage, 
+								outbase="%s/NJ%%05d.aln"%prj_tree.lineage, treebase="%s/NJ%%05d.tree"%prj_tree.lineage )
+				tree_pool = Pool(numThreads)
+				tree_pool.map(partial_tree, range(1,f_ind+1))
+				tree_pool.close()
+				tree_pool.join()
 				
 
 		
@@ -318,7 +404,7 @@ def main():
 			out_nt   = open("%s/%s_intradonor_positives.fa"  % (prj_tree.nt, prj_name),     "w")
 			out_aa   = open("%s/%s_intradonor_positives.fa"  % (prj_tree.aa, prj_name),     "w")
 			SeqIO.write(read_dict.values(), out_nt, "fasta")
-			SeqIO.write( [SeqRecord(r.seq.translate(),id=r.id, description=r.description) for r in read_dict.values()], out_aa, "fasta" )
+			SeqIO.write( [SeqRecord(Seq.Seq(aa),id=r.id, description=r.description) for r, aa in zip(read_dict.values(), translate_batch([r.seq for r in read_dict.values()]))], out_aa, "fasta" )
 			out_nt.close()
 			out_aa.close()
 
@@ -382,14 +468,27 @@ if __name__ == '__main__':
 		default_npf = 1000
 
 	#get the parameters from the command line
-	dict_args = processParas(sys.argv, n="natFile", v="germlineV", locus="locus", lib="library", i="inFile", maxIters="maxIters", npf="npf", threads="numThreads")
-	defaults = dict(locus="H", library="", inFile=selectedFile, maxIters=15, npf=default_npf, numThreads=1)
-	natFile, germlineV, locus, library, inFile, maxIters, npf, numThreads = getParasWithDefaults(dict_args, defaults, "natFile", "germlineV", "locus", "library", "inFile", "maxIters", "npf", "numThreads")
+	dict_args = processParas(sys.argv, n="natFile", v="germlineV", locus="locus", lib="library", i="inFile", maxIters="maxIters", npf="npf", threads="numThreads", engine="engine",
+				 minKmer="minKmer", cdr3Diff="cdr3Diff", cdr3Id="cdr3Id")
+	defaults = dict(locus="H", library="", inFile=selectedFile, maxIters=15, npf=default_npf, numThreads=1, engine="native", minKmer=0, cdr3Diff=None, cdr3Id=0)
+	natFile, germlineV, locus, library, inFile, maxIters, npf, numThreads, engine, minKmer, cdr3Diff, cdr3Id = getParasWithDefaults(dict_args, defaults, "natFile", "germlineV", "locus", "library", "inFile", "maxIters", "npf", "numThreads", "engine", "minKmer", "cdr3Diff", "cdr3Id")
+
+	if engine not in ["native", "muscle"]:
+		sys.exit("Unrecognized engine %s (options are native and muscle)." % engine)
 
 	if natFile is None or germlineV is None:
 		print __doc__
 		sys.exit(0)
 
+	prefilter = minKmer > 0 or cdr3Diff is not None or cdr3Id > 0
+
+	#J motif at the end of CDR3, as in 1.3
+	jMotif = "TGGGG"
+	if "K" in locus or "L" in locus:
+		jMotif = "TT[C|T][G|A]G"
+	elif locus == "C":
+		jMotif = "(TGGGG|TT[C|T][G|A]G)"
+
 	#load native sequences
 	natives       =  load_fastas(natFile)
 	natives_list  =  natives.keys()
@@ -417,6 +516,9 @@ if __name__ == '__main__':
 	except:
 		print "Specified germline gene (%s) is not present in the %s library!\n" % (germlineV, library)
 		sys.exit(1)
+
+	#positions used for the distances of the native engine: the germline, extended through CDR3 and J by a native
+	frame = anchor_frame( germ_seq.seq, natives[natives_list[0]].seq )
 		
 
 	main()
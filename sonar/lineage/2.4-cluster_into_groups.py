@@ -9,10 +9,13 @@ This script uses CDR3 identity to group unique sequences from a given data set
       for most cases, but more stringent or lenient criteria may be
       more appropriate in many cases.
       Sequences are first grouped by unique V and J gene assignments and then
-      USearch is used to cluster the CDR3 sequences.
+      the CDR3 sequences in each group are clustered, either in-process (see
+      sonar/lineage/cdr3Cluster.py) or with USearch.
 
-Usage: 2.4-cluster_into_groups.py [ -id 90 -gaps 0
-                                    -n natives.fa -v nat_v_gene -j nat_j_gene ]
+Usage: 2.4-cluster_into_groups.py [ -id 90 -gaps 0 -engine native -t 1
+                                    -n natives.fa -v nat_v_gene -j nat_j_gene
+                                    -update -cdr3 new_goodCDR3_unique.fa
+                                    -vj new_goodVJ_unique.fa ]
 
     All options are optional, see below for defaults.
     Invoke with -h or --help to print this documentation.
@@ -26,7 +29,27 @@ Usage: 2.4-cluster_into_groups.py [ -id 90 -gaps 0
                    alignment used for clustering! Also, usearch will still count
                    gaps as mismatches, so a CDR3 of 20AA will be counted as 95%
                    id to an identical-other-than-deletion 19AA CDR3. Set your
-                   thresholds accordingly.
+                   thresholds accordingly. The native engine follows the same
+                   conventions, treating an in-del as a single block of up to
+                   3*gaps nucleotides.
+    engine      Clustering engine to use. "native" clusters in-process, with
+                   V/J groups spread over several processes (see -t); "usearch"
+                   runs usearch -cluster_fast once per V/J group.
+                   Default = native.
+    t           Number of processes for the native engine. Default = 1.
+    update      Flag to add sequences (eg from a new time point) to the lineages
+                   found by an earlier run, instead of clustering everything
+                   again. Sequences are assigned to the existing lineages or
+                   start new ones; lineage numbers and sizes in the outputs
+                   are updated and the new sequences are added to them.
+                   Requires the native engine and the same -id and -gaps
+                   as before. Sequence IDs must not repeat those of
+                   earlier time points.
+    cdr3        CDR3 sequences to cluster (or, with -update, to add).
+                   Default = output/sequences/nucleotide/<project>_goodCDR3_unique.fa
+    vj          Full-length sequences matching the CDR3s above, for the
+                   sequence outputs.
+                   Default = output/sequences/nucleotide/<project>_goodVJ_unique.fa
     natives.fa  Fasta file of known antibody sequences to be clustered together
                    with the NGS data. Useful for focusing on a known lineage.
     nat_v_gene  V gene used by the known antibodies (no allele, eg: "HV1-2")
@@ -49,139 +72,202 @@ except ImportError:
 	sys.path.append(find_SONAR[0])
 	from sonar.lineage import *
 
+import itertools
+from sonar.lineage.cdr3Cluster import cluster_partitions
+from sonar.lineage.lineageDB import LineageDB
+
+
+LINEAGE_NOTE = re.compile(" lineage_num=\d+ lineage_rep=(\S+) lineage_size=\d+")
+
+
+def cluster_with_usearch(group, ids, seqs, sizes, log):
+    """cluster one V/J partition with usearch; returns (id, centroid id) for each sequence"""
+
+    #only one partition file exists at a time
+    temp = "%s/%s.fa" % (prj_tree.lineage, group)
+    with open(temp, "w") as handle:
+        for seq_id, seq, size in zip(ids, seqs, sizes):
+            handle.write(">%s;size=%d;\n%s\n" % (seq_id, size, seq))
+
+    subprocess.call([usearch, "-cluster_fast", temp, 
+                     "-id", str(idLevel/100.0), "-maxgaps", str(maxgaps*3), "-sizein",
+                     "-sort", "size", "-uc", "%s/%s.uc"%(prj_tree.lineage, group),
+                     "-leftjust", "-rightjust"], #left/right forces our pre-determined CDR3 borders to match 
+                    stdout=log, stderr=subprocess.STDOUT)
+
+    members = []
+    with open("%s/%s.uc"%(prj_tree.lineage, group), "rU") as handle:
+        uc = csv.reader( handle, delimiter=sep )
+        for row in uc:
+            #first get rid of size annotations and fasta def line (which is included as of usearch9)
+            hit  = re.sub(";size=\d+;.*","",row[8])
+            cent = re.sub(";size=\d+;.*","",row[9]) # just a * for S rows, use hit as cent
+            if row[0] == "S":
+                members.append( (hit, hit) )
+            elif row[0] == "H":
+                members.append( (hit, cent) )
+            else:
+                break #skip "C" lines
+    return members
+
+
+def cluster_groups(partitions, log, known):
+    """generate (group, [ (id, centroid id), ... ]) for each V/J partition"""
+
+    if engine == "native":
+        for result in cluster_partitions(partitions, idLevel, maxgaps*3, numThreads, known):
+            yield result
+    else:
+        for group, (ids, seqs, sizes) in partitions.items():
+            yield group, cluster_with_usearch(group, ids, seqs, sizes, log)
+
 
 def main():
 
-    #need both CDR3 and full length - infile maybe not parameter
-    global natFile, nat_genes, gene_pat, idLevel, maxgaps
+    #need both CDR3 and full length
+    global natFile, nat_genes, gene_pat, idLevel, maxgaps, db
 
     #open logfile
     log = open("%s/cluster_into_groups.txt" % prj_tree.logs, "w")
 
     clusterLookup = dict()
-    centroidData = dict()
 
     #first, open the input file and parse into groups with same V/J
     vj_partition = dict()
     cdr3_info = dict()
     seqSize = Counter()
-    for sequence in SeqIO.parse(open("%s/%s_goodCDR3_unique.fa" % (prj_tree.nt, prj_name), "rU"), "fasta"):
+    for sequence in SeqIO.parse(open(cdr3File, "rU"), "fasta"):
         genes = re.search(gene_pat, sequence.description)
         if genes:
             key = genes.group(1) + "_" + genes.group(2)
             if key not in vj_partition:
-		temp = "%s/%s.fa"%(prj_tree.lineage, key) 
-                vj_partition[key] = { 'handle':open(temp, "w"), 'file':temp, 'count':0, 'ids':[] }
+                vj_partition[key] = { 'ids':[], 'seqs':[], 'sizes':[] }
 
-	    vj_partition[key]['count'] += 1
-	    vj_partition[key]['ids'].append(sequence.id)
-	    cdr3_info[sequence.id] = { 'cdr3_len' : len(sequence.seq)/3 - 2, 'cdr3_seq' : sequence.seq.translate() }
+	    cdr3_info[sequence.id] = { 'cdr3_len' : len(sequence.seq)/3 - 2, 'cdr3_seq' : translate(sequence.seq), 'cdr3_nt' : str(sequence.seq) }
 
 	    #add sizes
 	    seqSize[sequence.id] = 1	
 	    check = re.search( " size=(\d+)", sequence.description)
 	    if check:
 		    seqSize[sequence.id] = int(check.group(1))
-	    #make available to usearch
-	    sequence.id += ";size=%d;" % seqSize[sequence.id] #do this even if there's no label
-	                                                      #so I don't need to divide the cases for usearch
 
-	    #and write
-	    SeqIO.write([sequence], vj_partition[key]['handle'], 'fasta')
+	    vj_partition[key]['ids'].append(sequence.id)
+	    vj_partition[key]['seqs'].append(str(sequence.seq))
+	    vj_partition[key]['sizes'].append(seqSize[sequence.id])
+
 
+    #with -update, db holds the existing lineages (loaded when checking the input)
+    if not update:
+        db = LineageDB(dbFolder, idLevel, maxgaps)
 
+    #natives added at an earlier time point are already in their lineages
     natives = dict()
     try:
         natives = load_fastas(natFile)
+        for n in db.natives():
+            natives.pop(n, None)
         for n, s in natives.items():
 		if nat_genes not in vj_partition:
-			temp = "%s/%s.fa"%(prj_tree.lineage, nat_genes)
-			vj_partition[nat_genes] = { 'handle':open(temp, "w"), 'file':temp, 'count':0, 'ids':[] }
+			vj_partition[nat_genes] = { 'ids':[], 'seqs':[], 'sizes':[] }
 		seqSize[ n ] = 1
-		s.id += ";size=1;"
-		vj_partition[nat_genes]['count'] += 1
 		vj_partition[nat_genes]['ids'].append( n )
-		cdr3_info[ n ] = { 'cdr3_len' : len(s.seq)/3 - 2, 'cdr3_seq' : s.seq.translate() }
-		SeqIO.write([ s ], vj_partition[nat_genes]['handle'], 'fasta')
+		vj_partition[nat_genes]['seqs'].append( str(s.seq) )
+		vj_partition[nat_genes]['sizes'].append( 1 )
+		cdr3_info[ n ] = { 'cdr3_len' : len(s.seq)/3 - 2, 'cdr3_seq' : translate(s.seq), 'cdr3_nt' : str(s.seq) }
     except IOError:
         pass
 
 
-    #now go through and cluster each V/J grouping
-    clusterSizes = Counter()
+    #save a bit of time for obvious singletons
+    singles = []
+    toCluster = dict()
     for group in vj_partition:
+        ids = vj_partition[group]['ids']
+        if len(ids) == 1 and group not in db.groups:
+            singles.append( (group, [ (ids[0], ids[0]) ]) )
+        else:
+            toCluster[group] = ( ids, vj_partition[group]['seqs'], vj_partition[group]['sizes'] )
+
+    known = dict( (group, db.known(group)) for group in toCluster if group in db.groups )
+
+    #now go through and cluster each V/J grouping
+    #   (a sequence with the ID of an existing centroid joins that lineage
+    #   rather than starting it over)
+    existing   = set(db.lineages)
+    newMembers = []
+    for group, members in itertools.chain( singles, cluster_groups(toCluster, log, known) ):
 
-	#close the file handle
-        vj_partition[group]['handle'].close()
-
-        #save a bit of time for obvious singletons
-        if vj_partition[group]['count'] == 1:
-            single = vj_partition[group]['ids'][0]
-            myGenes = group.split("_")
-            clusterLookup[ single ] = single
-            centroidData[ single ] = dict( vgene = myGenes[0], jgene = myGenes[1], nats=[] )
-	    if single in natives: centroidData[single]['nats'] = [single]
-	    clusterSizes[ single ] = seqSize[ single ]
-            continue
-
-        #cluster with usearch
-        subprocess.call([usearch, "-cluster_fast", vj_partition[group]['file'], 
-                         "-id", str(idLevel/100.0), "-maxgaps", str(maxgaps*3), "-sizein",
-                         "-sort", "size", "-uc", "%s/%s.uc"%(prj_tree.lineage, group),
-                         "-leftjust", "-rightjust"], #left/right forces our pre-determined CDR3 borders to match 
-                        stdout=log, stderr=subprocess.STDOUT)
-
-        #now reconstruct pseudo-lineages
+        #reconstruct pseudo-lineages, starting with the centroids
         myGenes = group.split("_")
-	with open("%s/%s.uc"%(prj_tree.lineage, group), "rU") as handle:
-		uc = csv.reader( handle, delimiter=sep )
-		for row in uc:
-			#first get rid of size annotations and fasta def line (which is included as of usearch9)
-			hit  = re.sub(";size=\d+;.*","",row[8])
-			cent = re.sub(";size=\d+;.*","",row[9]) # just a * for S rows, use hit as cent
-			if row[0] == "S":
-				centroidData[ hit ] = dict( vgene = myGenes[0], jgene = myGenes[1], nats=[] )
-			        clusterLookup[ hit ] = hit
-				clusterSizes[ hit ] = seqSize[ hit ]
-				if hit in natives:
-					centroidData[ hit ][ 'nats' ].append( hit )
-			elif row[0] == "H":
-				clusterLookup[ hit ] = cent
-				clusterSizes[ cent ] += seqSize[ hit ]
-				if hit in natives:
-					centroidData[ cent ][ 'nats' ].append( hit )
-			else:
-				break #skip "C" lines
-        
+        for hit, cent in members:
+            if hit == cent and hit not in existing:
+                db.add_lineage( group, hit, cdr3_info[hit]['cdr3_nt'], dict( vgene = myGenes[0], jgene = myGenes[1], cdr3_len = cdr3_info[hit]['cdr3_len'],
+                                                                          cdr3_seq = cdr3_info[hit]['cdr3_seq'], size = seqSize[hit], nats = [] ) )
+                if hit in natives:
+                    db.lineages[ hit ][ 'nats' ].append( hit )
+        for hit, cent in members:
+            clusterLookup[ hit ] = cent
+            if hit != cent or hit in existing:
+                db.lineages[ cent ][ 'size' ] += seqSize[ hit ]
+                if hit in natives:
+                    db.lineages[ cent ][ 'nats' ].append( hit )
+        newMembers += members
 
     #now process all clusters and do tabular output
+    rank = dict()
     with open( "%s/%s_lineages.txt" % (prj_tree.tables, prj_name), "w" ) as handle:
         writer = csv.writer(handle, delimiter=sep)
         writer.writerow([ "lineage_ID", "rep_seq_ID", "V_gene", "J_gene", "cdr3_len", 
                        "cdr3_aa_seq", "size", "included_mAbs" ])
-        for rank, (centroid, size) in enumerate(clusterSizes.most_common()):
-            centroidData[centroid]['rank'] = rank+1
-            writer.writerow([ "%05d"%(rank+1), centroid, centroidData[centroid]['vgene'], centroidData[centroid]['jgene'], 
-                              cdr3_info[centroid]['cdr3_len'], cdr3_info[centroid]['cdr3_seq'], size, ",".join(centroidData[centroid]['nats']) ])
-
-    #do sequence output
-    rep_seqs = []
-    with open( "%s/%s_goodVJ_unique_lineageNotations.fa" % (prj_tree.nt, prj_name), "w" ) as handle:
-        for read in generate_read_fasta("%s/%s_goodVJ_unique.fa" % (prj_tree.nt, prj_name)):
+        for r, centroid in enumerate(db.ranking()):
+            rank[centroid] = r+1
+            info = db.lineages[centroid]
+            writer.writerow([ "%05d"%(r+1), centroid, info['vgene'], info['jgene'], 
+                              info['cdr3_len'], info['cdr3_seq'], info['size'], ",".join(info['nats']) ])
+
+    #renumber sequences from earlier time points, as lineage numbers and sizes change
+    def renumber(match):
+        rep = match.group(1)
+        return " lineage_num=%05d lineage_rep=%s lineage_size=%d" % ( rank[rep], rep, db.lineages[rep]['size'] )
+
+    notations = "%s/%s_goodVJ_unique_lineageNotations.fa" % (prj_tree.nt, prj_name)
+    rep_seqs  = []
+    with open( notations + ".tmp", "w" ) as handle:
+        if update and os.path.isfile(notations):
+            with open(notations, "rU") as old:
+                for line in old:
+                    if line.startswith(">"):
+                        line = LINEAGE_NOTE.sub(renumber, line)
+                    handle.write(line)
+            with open("%s/%s_lineageRepresentatives.fa" % (prj_tree.nt, prj_name), "rU") as old:
+                for read in SeqIO.parse(old, "fasta"):
+                    read.description = LINEAGE_NOTE.sub(renumber, read.description)
+                    rep_seqs.append(read)
+
+        #do sequence output
+        for read in generate_read_fasta(vjFile):
             if ";" in read.id:
                 read.id = read.id[0,8] #this is for raw USearch output with size annotations
                                        #shouldn't be relevant in pipeline context
 	    if read.id not in clusterLookup: continue
-            read.description += " lineage_num=%05d lineage_rep=%s lineage_size=%d" % ( centroidData[clusterLookup[read.id]]['rank'], 
-                                                                                       clusterLookup[read.id], clusterSizes[clusterLookup[read.id]] )
+            read.description += " lineage_num=%05d lineage_rep=%s lineage_size=%d" % ( rank[clusterLookup[read.id]], 
+                                                                                       clusterLookup[read.id], db.lineages[clusterLookup[read.id]]['size'] )
             SeqIO.write([read],handle,"fasta")
-            if read.id in centroidData:
+            if clusterLookup[read.id] == read.id and read.id not in existing:
                 rep_seqs.append(read)
+    os.rename(notations + ".tmp", notations)
 
-    with open( "%s/%s_lineageRepresentatives.fa" % (prj_tree.nt, prj_name), "w" ) as handle:
+    representatives = "%s/%s_lineageRepresentatives.fa" % (prj_tree.nt, prj_name)
+    with open( representatives + ".tmp", "w" ) as handle:
         #use a sort to put them out in order of lineage rank (ie size)
-        SeqIO.write( sorted(rep_seqs, key=lambda cent: centroidData[cent.id]['rank']), handle, "fasta" )
+        SeqIO.write( sorted(rep_seqs, key=lambda cent: rank[cent.id]), handle, "fasta" )
+    os.rename(representatives + ".tmp", representatives)
 
+    #only record the new sequences once the outputs include them, so that
+    #   the database never describes lineages the outputs don't have
+    db.add_members(newMembers, fresh=not update)
+    db.add_input(cdr3File)
+    db.save()
 
     log.close()
 
@@ -196,10 +282,35 @@ if __name__ == '__main__':
 	#log command line
 	logCmdLine(sys.argv)
 
+	update = False
+	if q("-update"):
+		sys.argv.remove("-update")
+		update = True
+
+        prj_tree = ProjectFolders(os.getcwd())
+        prj_name = fullpath2last_folder(prj_tree.home)
+
 	# get parameters from input
-	dict_args = processParas(sys.argv, id="idLevel", gaps="maxgaps", n="natFile", v="natV", j="natJ")
-	idLevel, maxgaps, natFile, natV, natJ = getParasWithDefaults(dict_args, dict(idLevel=90, maxgaps=0, natFile="", natV="", natJ=""),
-                                                                     "idLevel", "maxgaps", "natFile", "natV", "natJ")
+	dict_args = processParas(sys.argv, id="idLevel", gaps="maxgaps", n="natFile", v="natV", j="natJ", engine="engine", t="numThreads", cdr3="cdr3File", vj="vjFile")
+	defaults = dict(idLevel=90, maxgaps=0, natFile="", natV="", natJ="", engine="native", numThreads=1,
+			cdr3File="%s/%s_goodCDR3_unique.fa" % (prj_tree.nt, prj_name), vjFile="%s/%s_goodVJ_unique.fa" % (prj_tree.nt, prj_name))
+	idLevel, maxgaps, natFile, natV, natJ, engine, numThreads, cdr3File, vjFile = getParasWithDefaults(dict_args, defaults,
+                                                                     "idLevel", "maxgaps", "natFile", "natV", "natJ", "engine", "numThreads", "cdr3File", "vjFile")
+
+        if engine not in ["native", "usearch"]:
+            sys.exit("Unknown engine %s (options are native, usearch)" % engine)
+
+        dbFolder = LineageDB.folder_for(prj_tree)
+        if update:
+            if engine != "native":
+                sys.exit("Only the native engine can add sequences to existing lineages; please use -engine native with -update")
+            db = LineageDB.load(dbFolder)
+            if db is None:
+                sys.exit("Cannot find a lineage database in %s; please run once without -update first" % dbFolder)
+            elif (db.idLevel, db.maxgaps) != (idLevel, maxgaps):
+                sys.exit("Existing lineages were found with -id %s -gaps %s; please use the same settings with -update" % (db.idLevel, db.maxgaps))
+            elif db.has_input(cdr3File):
+                sys.exit("%s has already been added to the existing lineages" % cdr3File)
 
         if os.path.isfile(natFile):
             #ok working with known sequences, make sure V and J were input properly
@@ -213,9 +324,5 @@ if __name__ == '__main__':
         gene_pat = re.compile("V_gene=IG([HKL]V\d[^*]+).*J_gene=IG([HKL]J\d)")
 
 
-        prj_tree = ProjectFolders(os.getcwd())
-        prj_name = fullpath2last_folder(prj_tree.home)
-
-
 	main()
 
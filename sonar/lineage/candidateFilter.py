@@ -0,0 +1,176 @@
+#!/usr/bin/env python
+
+"""
+candidateFilter.py
+
+Quick scoring of reads against the native antibodies, used by
+      2.3-intradonor_analysis.py to leave reads that are obviously unrelated
+      out of the first round, which would otherwise build trees from every
+      read assigned to the right V gene.
+
+There are two kinds of evidence, each with its own cutoff:
+   k-mers   the fraction of the k-mers of a read that are found in at least
+               one native. k-mers are packed into integers, so that a whole
+               batch of reads is looked up at once.
+   CDR3     the difference in length (in amino acids) from the closest
+               native CDR3, and the best identity to any native CDR3, with
+               a single gap block making up for any difference in length (as
+               in cdr3Cluster.py). The CDR3s of the reads come from the
+               cdr3_aa_seq field added to their titles by 1.3; those of the
+               natives from the same field, if the natives were run through
+               the pipeline, or else from the conserved cysteine of the
+               germline V gene and the last in-frame J motif. Reads without
+               a CDR3 annotation are judged on k-mers only.
+
+    scorer = CandidateScorer(natives, germline, cys, "TGGGG")
+    kmers, lenDiff, identity = scorer.score(reads)
+
+Copyright (c) 2011-2017 Columbia University and Vaccine Research Center, National
+                         Institutes of Health, USA. All rights reserved.
+
+"""
+
+import re
+
+import numpy
+
+from sonar.translation import translate
+from sonar.align import encode_seq, seed_diagonals, banded_semiglobal_align
+from sonar.lineage.cdr3Cluster import LengthBucket
+
+
+KMER = 12
+
+#reads whose k-mers are looked up together
+BATCH_SIZE = 10000
+
+CDR3_FIELD = re.compile("cdr3_aa_seq=(\S+)")
+
+
+def kmer_codes(seqs, k=KMER):
+	"""
+	packed k-mers of a list of nucleotide sequences, with the index of the
+	   sequence each one comes from (k-mers with anything but A, C, G or T
+	   are left out)
+	"""
+
+	codes   = [ encode_seq(str(s).upper()) for s in seqs ]
+	lengths = [ len(c) for c in codes ]
+	n       = sum(lengths) - k + 1
+	if n <= 0:
+		return numpy.zeros(0, dtype=numpy.int64), numpy.zeros(0, dtype=numpy.int64)
+
+	bases  = numpy.concatenate(codes).astype(numpy.int64)
+	owner  = numpy.repeat( numpy.arange(len(seqs)), lengths )
+	packed = numpy.zeros(n, dtype=numpy.int64)
+	bad    = owner[ : n ] != owner[ k - 1 : ]	#runs into the next sequence
+	for p in range(k):
+		window  = bases[ p : p + n ]
+		packed  = packed * 4 + numpy.minimum(window, 3)
+		bad    |= window > 3
+	return packed[~bad], owner[ : n ][~bad]
+
+
+def annotated_cdr3(title):
+	"""CDR3 from the cdr3_aa_seq field of a title written by 1.3, or None"""
+	found = CDR3_FIELD.search(title)
+	return found.group(1) if found else None
+
+
+def native_cdr3(native, germline, cys, jMotif):
+	"""
+	CDR3 of a native antibody as 1.3 defines it (amino acids from the
+	   conserved cysteine through the W/F of the J motif), found from the
+	   position of the cysteine on its germline V gene; None if it can't be
+	   found
+	"""
+
+	if cys < 0:
+		return None
+	native = str(native).upper()
+	n, g   = encode_seq(native), encode_seq(str(germline).upper())
+	hit    = banded_semiglobal_align( [n], [g], seed_diagonals([n], g) )[0]
+	if hit is None:
+		return None
+
+	start = [ q + cys - s for s, q, length in hit.blocks if s <= cys < s + length ]
+	if len(start) == 0:
+		return None
+	start = start[0]
+
+	#the last in-frame motif, since one can turn up inside a long CDR3 too
+	#   (skipping the CAR/CAK, where part of one might)
+	ends = [ start + 9 + m.start() for m in re.finditer( "(?=%s)" % jMotif, native[ start + 9 : ] ) ]
+	ends = [ e for e in ends if (e - start) % 3 == 0 ]
+	if len(ends) == 0:
+		return None
+	return str( translate(native[ start : ends[-1] + 3 ]) )
+
+
+class CandidateScorer:
+
+	def __init__(self, natives, germline, cys, jMotif, k=KMER):
+		"""natives are SeqRecords; germline is the sequence of their V gene, with the conserved cysteine at cys"""
+
+		self.k     = k
+		self.known = numpy.unique( kmer_codes( [ n.seq for n in natives ], k )[0] )
+
+		self.cdr3s = []
+		for n in natives:
+			cdr3 = annotated_cdr3(n.description) or native_cdr3(n.seq, germline, cys, jMotif)
+			if cdr3 is not None:
+				self.cdr3s.append(cdr3)
+
+		self.buckets = dict()
+		for i, cdr3 in enumerate(self.cdr3s):
+			codes = numpy.frombuffer(cdr3, dtype=numpy.uint8)
+			self.buckets.setdefault( len(codes), LengthBucket(len(codes)) ).add(codes, i)
+
+
+	def kmer_containment(self, seqs):
+		"""fraction of the k-mers of each sequence that are in a native (0 if it has none)"""
+		result = numpy.zeros(len(seqs))
+		for start in range(0, len(seqs), BATCH_SIZE):
+			batch = seqs[ start : start + BATCH_SIZE ]
+			codes, owner = kmer_codes(batch, self.k)
+			total = numpy.bincount( owner, minlength=len(batch) )
+			#binary search in the (small, sorted) set of native k-mers
+			where = numpy.minimum( numpy.searchsorted(self.known, codes), max(len(self.known) - 1, 0) )
+			hits  = self.known[where] == codes if len(self.known) > 0 else numpy.zeros(len(codes), dtype=bool)
+			found = numpy.bincount( owner, weights=hits, minlength=len(batch) )
+			result[ start : start + len(batch) ] = found / numpy.maximum(total, 1)
+		return result
+
+
+	def cdr3_match(self, cdr3):
+		"""difference in length from the closest native CDR3 and best percent identity to any of them"""
+		codes    = numpy.frombuffer(cdr3, dtype=numpy.uint8)
+		lenDiff  = min( abs(length - len(codes)) for length in self.buckets )
+		identity = max( bucket.matches(codes).max() / float( max(length, len(codes)) ) for length, bucket in self.buckets.items() )
+		return lenDiff, 100 * identity
+
+
+	def score(self, reads):
+		"""
+		k-mer containment, CDR3 length difference and CDR3 identity of each
+		   read (SeqRecords); the CDR3 scores are NaN for reads without a
+		   CDR3 annotation, or if no native CDR3 could be found
+		"""
+
+		kmers    = self.kmer_containment( [ r.seq for r in reads ] )
+		lenDiff  = numpy.empty(len(reads))
+		identity = numpy.empty(len(reads))
+		lenDiff.fill(numpy.nan)
+		identity.fill(numpy.nan)
+
+		if len(self.buckets) > 0:
+			#many reads share a CDR3
+			seen = dict()
+			for i, r in enumerate(reads):
+				cdr3 = annotated_cdr3(r.description)
+				if cdr3 is not None:
+					if cdr3 not in seen:
+						seen[cdr3] = self.cdr3_match(cdr3)
+					lenDiff[i], identity[i] = seen[cdr3]
+
+		return kmers, lenDiff, identity
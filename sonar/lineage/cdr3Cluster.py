@@ -0,0 +1,145 @@
+#!/usr/bin/env python
+
+"""
+cdr3Cluster.py
+
+In-process greedy clustering of CDR3 sequences, used by 2.4 as an alternative
+      to running "usearch -cluster_fast" once per V/J partition ("-engine
+      native"). Partitions are clustered independently, so they are spread
+      over a pool of worker processes.
+
+Within a partition, CDR3s are taken in order of decreasing size (ties in input
+      order) and each one joins the most similar existing centroid (the
+      earliest one, if several are equally similar) if their identity is at
+      least the threshold; otherwise it becomes a new centroid. Alignments
+      are global (as with usearch -leftjust -rightjust): identity is the
+      number of matching positions over the length of the alignment, so gaps
+      count as mismatches. Any in-del is treated as a single block of up to
+      maxgaps nucleotides, placed wherever it gives the most matches.
+
+Centroids are kept in NumPy arrays bucketed by length, so each CDR3 is
+      compared with all centroids of a compatible length at once. Existing
+      centroids (eg from the lineage database, with 2.4 -update) can be
+      loaded first, so that new CDR3s join them or start new clusters.
+
+Copyright (c) 2011-2017 Columbia University and Vaccine Research Center, National
+                         Institutes of Health, USA. All rights reserved.
+
+"""
+
+from multiprocessing import Pool
+
+import numpy
+
+
+class LengthBucket:
+	"""encoded centroids of one length, in a matrix that grows by doubling"""
+
+	def __init__(self, length):
+		self.length = length
+		self.seqs   = numpy.zeros( (16, length), dtype=numpy.uint8 )
+		self.ranks  = []
+
+	def add(self, codes, rank):
+		if len(self.ranks) == self.seqs.shape[0]:
+			self.seqs = numpy.concatenate( [self.seqs, numpy.zeros_like(self.seqs)] )
+		self.seqs[ len(self.ranks) ] = codes
+		self.ranks.append(rank)
+
+	def matches(self, query):
+		"""
+		most matching positions of each centroid with query, allowing a single
+		   gap block to make up for the difference in length
+		"""
+		cents = self.seqs[ : len(self.ranks) ]
+		diff  = self.length - len(query)
+		if diff == 0:
+			return (cents == query).sum(axis=1)
+
+		#line up the shorter sequence with the start of the longer one up to
+		#   position k and with its end after that, for all k
+		if diff > 0:
+			front = cents[:, : len(query)] == query
+			back  = cents[:, diff :] == query
+		else:
+			front = cents == query[ : self.length ]
+			back  = cents == query[ -diff : ]
+		n      = front.shape[1]
+		prefix = numpy.zeros( (len(cents), n + 1), dtype=numpy.int32 )
+		suffix = numpy.zeros( (len(cents), n + 1), dtype=numpy.int32 )
+		prefix[:, 1:]  = numpy.cumsum(front, axis=1)
+		suffix[:, :-1] = numpy.cumsum(back[:, ::-1], axis=1)[:, ::-1]
+		return (prefix + suffix).max(axis=1)
+
+
+def cluster_cdr3s(seqs, sizes, idLevel, maxgaps=0, known=[]):
+	"""
+	greedy clustering of a list of CDR3 sequences (with their sizes) at
+	   idLevel percent identity, on top of the CDR3s of any known
+	   centroids; returns the centroid of each sequence as an index into
+	   known + seqs
+	"""
+
+	order     = sorted( range(len(seqs)), key=lambda i: -sizes[i] )
+	centroids = [ None ] * len(seqs)
+	created   = []		# centroids in the order they were found
+	buckets   = dict()
+	threshold = idLevel / 100.0
+
+	for k, seq in enumerate(known):
+		codes = numpy.frombuffer(seq.upper(), dtype=numpy.uint8)
+		buckets.setdefault( len(codes), LengthBucket(len(codes)) ).add(codes, len(created))
+		created.append(k)
+
+	for i in order:
+		codes = numpy.frombuffer(seqs[i].upper(), dtype=numpy.uint8)
+		best, bestRank = None, None
+
+		for length in range( max(1, len(codes) - maxgaps), len(codes) + maxgaps + 1 ):
+			if length not in buckets:
+				continue
+			bucket = buckets[length]
+			score  = bucket.matches(codes) / float( max(length, len(codes)) )
+			top    = score.max()
+			if top < threshold:
+				continue
+			#earliest centroid among the best in this bucket
+			rank = bucket.ranks[ numpy.flatnonzero(score == top)[0] ]
+			if best is None or top > best or (top == best and rank < bestRank):
+				best, bestRank = top, rank
+
+		if best is None:
+			centroids[i] = len(known) + i
+			buckets.setdefault( len(codes), LengthBucket(len(codes)) ).add(codes, len(created))
+			created.append(len(known) + i)
+		else:
+			centroids[i] = created[bestRank]
+
+	return centroids
+
+
+def _cluster_partition(args):
+	group, ids, seqs, sizes, knownIds, knownSeqs, idLevel, maxgaps = args
+	centroids = cluster_cdr3s(seqs, sizes, idLevel, maxgaps, knownSeqs)
+	allIds    = knownIds + ids
+	return group, [ (ids[i], allIds[c]) for i, c in enumerate(centroids) ]
+
+
+def cluster_partitions(partitions, idLevel, maxgaps=0, threads=1, known=dict()):
+	"""
+	cluster each partition, given as group -> (ids, seqs, sizes), on top of
+	   any known centroids, given as group -> (ids, seqs); generates
+	   (group, [ (id, centroid id), ... ]) in input order of the reads,
+	   as the partitions are finished
+	"""
+
+	jobs = ( (group, ids, seqs, sizes) + tuple(known.get(group, ([], []))) + (idLevel, maxgaps) for group, (ids, seqs, sizes) in partitions.items() )
+	if threads > 1:
+		pool = Pool(threads)
+		for result in pool.imap_unordered(_cluster_partition, jobs):
+			yield result
+		pool.close()
+		pool.join()
+	else:
+		for job in jobs:
+			yield _cluster_partition(job)
@@ -0,0 +1,156 @@
+#!/usr/bin/env python
+
+"""
+compactTree.py
+
+Lightweight trees for 2.3-intradonor_analysis.py, which only needs to know
+      which leaves of each split tree fall in the smallest subtree containing
+      all of the natives once the tree is rooted on the germline.
+
+A Newick string is read in one pass over its tokens into flat lists (parent,
+      name and branch length of each node), so there is no need to clean it
+      up first: whitespace and line breaks (as MUSCLE writes them), negative
+      branch lengths, comments in [] and quoted names are all fine. Rooting
+      on the germline is just a traversal outward from the germline leaf,
+      and the minimal native subtree is found from the number of natives
+      below each node, counted in a single post-order pass: it is the
+      lowest node that has all of them.
+
+    tree   = CompactTree.read("NJ00001.tree")
+    leaves = tree.native_subtree("IGHV1-2*02", ["VRC01", "VRC03"])
+
+Copyright (c) 2011-2017 Columbia University and Vaccine Research Center, National
+                         Institutes of Health, USA. All rights reserved.
+
+"""
+
+import re
+
+
+TOKEN = re.compile(r"\s*(\[[^\]]*\]|'(?:[^']|'')*'|[(),:;]|[^\s(),:;\[\]']+)")
+
+
+class CompactTree:
+
+	def __init__(self):
+		self.parent   = []		# index of the parent of each node (-1 for the root)
+		self.names    = []		# leaf names (labels of internal nodes, if any)
+		self.lengths  = []		# branch lengths (None if not given)
+		self.children = []
+
+
+	@classmethod
+	def read(cls, path):
+		with open(path, "rU") as handle:
+			return cls.parse(handle.read())
+
+
+	@classmethod
+	def parse(cls, text):
+
+		tree    = cls()
+		current = tree._add(-1)
+		afterColon = False
+
+		for token in TOKEN.findall(text):
+			if token.startswith("["):
+				continue
+			elif token == "(":
+				current = tree._add(current)
+			elif token == ",":
+				current = tree._add( tree.parent[current] )
+			elif token == ")":
+				current = tree.parent[current]
+			elif token == ":":
+				afterColon = True
+				continue
+			elif token == ";":
+				break
+			elif afterColon:
+				tree.lengths[current] = float(token)
+			else:
+				if token.startswith("'"):
+					token = token[1:-1].replace("''", "'")
+				tree.names[current] = token
+			afterColon = False
+
+		return tree
+
+
+	def _add(self, parent):
+		node = len(self.parent)
+		self.parent.append(parent)
+		self.names.append(None)
+		self.lengths.append(None)
+		self.children.append([])
+		if parent >= 0:
+			self.children[parent].append(node)
+		return node
+
+
+	def leaves(self):
+		return [ n for n, kids in enumerate(self.children) if len(kids) == 0 ]
+
+
+	def find(self, name):
+		"""the first leaf with this name, or -1"""
+		for n in self.leaves():
+			if self.names[n] == name:
+				return n
+		return -1
+
+
+	def native_subtree(self, outgroup, natives):
+		"""
+		names of the leaves in the smallest subtree that contains all of the
+		   natives when the tree is rooted on the outgroup leaf (with a single
+		   native, the subtree rooted at its parent); None if there is no
+		   such subtree
+		"""
+
+		root = self.find(outgroup)
+		if root < 0:
+			return None
+
+		#walk outward from the outgroup to orient every edge away from it
+		up    = [ -1 ] * len(self.parent)
+		order = [ root ]
+		seen  = set(order)
+		for node in order:
+			neighbors = self.children[node] + ( [self.parent[node]] if self.parent[node] >= 0 else [] )
+			for other in neighbors:
+				if other not in seen:
+					seen.add(other)
+					up[other] = node
+					order.append(other)
+
+		#count the natives below each node, children before parents
+		wanted = set(natives)
+		below  = [ 0 ] * len(self.parent)
+		for node in reversed(order):
+			if len(self.children[node]) == 0 and self.names[node] in wanted:
+				below[node] += 1
+			if up[node] >= 0:
+				below[ up[node] ] += below[node]
+
+		#the lowest branching node with all of them is the last one in the walk
+		#   outward (so a single native gives the subtree rooted at its parent;
+		#   a bifurcating old root is just a bend in a branch once the tree is
+		#   rooted on the outgroup, so it doesn't count)
+		best = -1
+		for node in order:
+			degree = len(self.children[node]) + (self.parent[node] >= 0)
+			if below[node] == len(wanted) and degree > 2:
+				best = node
+		if best < 0:
+			return None
+
+		leaves = []
+		stack  = [ best ]
+		while stack:
+			node = stack.pop()
+			kids = [ n for n in self.children[node] + [ self.parent[node] ] if n >= 0 and up[n] == node ]
+			if len(kids) == 0:
+				leaves.append(self.names[node])
+			stack.extend(kids)
+		return leaves
@@ -0,0 +1,161 @@
+#!/usr/bin/env python
+
+"""
+idDiv.py
+
+In-process engine for the identity/divergence table (<file>_id-div.tab and
+      <file>_coverage.tab), used by 2.1-calculate_id-div.py as an
+      alternative to aligning every read with MUSCLE/clustalo/mafft as
+      2.1-calculate_id-div.pl does.
+
+Each batch of reads is grouped by assigned V gene and aligned against that
+      germline (and, as a whole, against each native antibody) with the
+      banded aligner in sonar/align.py: gaps at the ends of either sequence
+      are free, and the band is centered on the diagonal shared by most
+      k-mers. With the default gap open cost for nucleotides (1000), no gaps
+      are opened inside the alignment, which is what the "-gapopen -1000"
+      that the Perl script gives MUSCLE amounts to.
+
+Identity and coverage are then worked out exactly as in the Perl script: end
+      gaps are ignored, gaps inside the alignment count as mismatches (unless
+      ignoreGap is set), columns with an X are skipped, and coverage is the
+      ratio of the lengths of the reference and of the part of the read that
+      lines up with it.
+
+Copyright (c) 2011-2017 Columbia University and Vaccine Research Center, National
+                         Institutes of Health, USA. All rights reserved.
+
+"""
+
+import re, sys
+
+import numpy
+
+from sonar.align import encode_seq, encode_protein, seed_diagonals, banded_semiglobal_align
+from sonar.seqReader import read_sequences
+
+
+X = ord("X")
+
+#set in each worker process by init_worker
+_settings = dict()
+
+
+def read_references(fasta):
+	"""dict ID -> uppercase sequence (empty if the file can't be read, as in the Perl script)"""
+	try:
+		return dict( (seq_id, seq.upper()) for seq_id, seq in read_sequences(fasta) )
+	except IOError:
+		sys.stderr.write("Sequence file %s does not exist\n" % fasta)
+		return dict()
+
+
+def read_batches(fasta, size):
+	"""generate lists of (ID, assigned V gene or None, sequence) from a FASTA file with SONAR-style titles"""
+	batch = []
+	for title, seq in read_sequences(fasta, titles=True):
+		fields = re.split("[ \t,]+", title)
+		vgene  = None
+		for field in fields:
+			if "V_gene=" in field:
+				vgene = field.replace("V_gene=", "")
+		batch.append( (fields[0], vgene, seq.upper()) )
+		if len(batch) == size:
+			yield batch
+			batch = []
+	if len(batch) > 0:
+		yield batch
+
+
+def identity(ref, read, hit, ignoreGap=False):
+	"""percent identity (as a formatted string) of an alignment, or 0 if there isn't one"""
+
+	if hit is None:
+		return 0
+
+	r = numpy.frombuffer(ref, dtype=numpy.uint8)
+	q = numpy.frombuffer(read, dtype=numpy.uint8)
+	aligned = matches = skipped = skippedRef = skippedRead = 0
+	for s, p, length in hit.blocks:
+		rs, qs = r[s : s + length], q[p : p + length]
+		hasX   = (rs == X) | (qs == X)
+		aligned     += length
+		matches     += int( ((rs == qs) & ~hasX).sum() )
+		skipped     += int( hasX.sum() )
+		skippedRef  += int( (rs == X).sum() )
+		skippedRead += int( (qs == X).sum() )
+
+	#X's in gapped columns are skipped too
+	gapX   = int( (r[hit.sstart : hit.send + 1] == X).sum() ) - skippedRef + int( (q[hit.qstart : hit.qend + 1] == X).sum() ) - skippedRead
+	length = aligned - skipped
+	if not ignoreGap:
+		length += hit.gaps - gapX
+	if length == 0:
+		return "NA"
+	return "%.2f" % (100.0 * matches / length)
+
+
+def coverage(ref, read, hit):
+	"""length of the part of the read aligned to ref relative to the length of ref (or the inverse, if > 1)"""
+
+	if hit is None or len(ref) == 0:
+		return "NA"
+	c = (hit.qend - hit.qstart + 1) / float(len(ref))
+	if c > 1:
+		c = 1 / c
+	return "%3.2f" % (100 * c)
+
+
+def init_worker(germlines, natives, protein, gapopen, band, ignoreGap):
+	_settings.update( germlines=germlines, natives=natives, protein=protein, gapopen=gapopen, band=band, ignoreGap=ignoreGap,
+			  encode=encode_protein if protein else encode_seq, nReal=20 if protein else 4, k=3 if protein else 8 )
+
+
+def align_all(reads, ref):
+	"""align a list of sequences against one reference; returns a GlobalHit (or None) for each"""
+	encode  = _settings["encode"]
+	queries = [ encode(s) for s in reads ]
+	subject = encode(ref)
+	diags   = seed_diagonals(queries, subject, _settings["k"], _settings["nReal"])
+	return banded_semiglobal_align( queries, [subject] * len(queries), diags, band=_settings["band"],
+					gapopen=_settings["gapopen"], nReal=_settings["nReal"] )
+
+
+def process_batch(batch):
+	"""
+	compute the rows of the id-div and coverage tables for a batch of reads
+	   (see read_batches); returns the two lists of rows, in input order
+	"""
+
+	germlines, natives = _settings["germlines"], _settings["natives"]
+	useGermline = _settings["germlines"] is not None
+	ignoreGap   = _settings["ignoreGap"]
+
+	idRows  = [ [seq_id] for seq_id, vgene, seq in batch ]
+	covRows = [ [seq_id] for seq_id, vgene, seq in batch ]
+
+	if useGermline:
+		#reads assigned to each germline gene (or all of them, if there's only one)
+		byGene = dict()
+		for n, (seq_id, vgene, seq) in enumerate(batch):
+			gene = germlines.keys()[0] if len(germlines) == 1 else vgene
+			if gene in germlines and len(seq) > 0:
+				byGene.setdefault(gene, []).append(n)
+			else:
+				sys.stderr.write("Could not find germline gene for %s\n" % seq_id)
+				idRows[n].append("NA")
+				covRows[n].append("NA")
+
+		for gene, members in byGene.items():
+			hits = align_all( [ batch[n][2] for n in members ], germlines[gene] )
+			for n, hit in zip(members, hits):
+				idRows[n].append( "%.2f" % (100 - float(identity(germlines[gene], batch[n][2], hit, ignoreGap))) )
+				covRows[n].append( coverage(germlines[gene], batch[n][2], hit) )
+
+	for name in sorted(natives):
+		hits = align_all( [ seq for seq_id, vgene, seq in batch ], natives[name] )
+		for n, hit in enumerate(hits):
+			idRows[n].append( str(identity(natives[name], batch[n][2], hit, ignoreGap)) )
+			covRows[n].append( coverage(natives[name], batch[n][2], hit) )
+
+	return [ "\t".join(row) for row in idRows ], [ "\t".join(row) for row in covRows ]
@@ -0,0 +1,161 @@
+#!/usr/bin/env python
+
+"""
+idDivIndex.py
+
+Binary, range-searchable copy of an identity/divergence table (the
+      <file>_id-div.tab written by 2.1-calculate_id-div), so that islands
+      can be pulled out of the identity-divergence plot without parsing the
+      whole table again for every query.
+
+The first time a table is opened, its columns are saved as NumPy arrays in a
+      folder next to it (<file>_id-div.tab.sdi/), which are memory-mapped
+      when it is opened again:
+         ids.data.npy, ids.offsets.npy   read IDs, in table order
+         div.npy                         germline divergence (NA is nan)
+         identity.npy                    identity to each native, one row per
+                                            native (NA is nan)
+         order.npy                       for each native, the rows with both
+                                            values, sorted by divergence
+         sorted_div.npy                  the divergence of those rows, in
+                                            the same order
+      so each island is a binary search on divergence followed by a check of
+      identity over just the rows in range. As with FastaIndex, the size and
+      modification time of the table are saved too, so the index is rebuilt
+      whenever the table changes, and it is simply kept in memory if it
+      can't be saved.
+
+    index = IdDivIndex("output/tables/myproject_goodVJ_unique_id-div.tab")
+    index.ids( index.island("VRC01", 85, 100, 0, 40) )
+
+Copyright (c) 2011-2017 Columbia University and Vaccine Research Center, National
+                         Institutes of Health, USA. All rights reserved.
+
+"""
+
+import os, json
+
+import numpy
+
+from sonar.annotationStore import StringColumn, _save_array, _save_strings
+
+
+SDI_FORMAT = 1
+
+
+class IdDivIndex:
+
+	def __init__(self, table, save=True):
+
+		self.table  = table
+		self.folder = table + ".sdi"
+
+		stat = os.stat(table)
+		self.stamp = "%d\t%.6f" % (stat.st_size, stat.st_mtime)
+
+		if not self.load():
+			self.build()
+			if save:
+				self.save()
+
+
+	def load(self):
+		"""open a saved index, if there is one that matches the current table"""
+		try:
+			with open("%s/meta.json" % self.folder, "rU") as handle:
+				meta = json.load(handle)
+		except (IOError, ValueError):
+			return False
+		if meta.get("format") != SDI_FORMAT or meta.get("stamp") != self.stamp:
+			return False
+
+		self.natives  = [ str(n) for n in meta["natives"] ]
+		self.valid    = meta["valid"]
+		self.readIds  = StringColumn(self.folder, "ids")
+		self.idData   = None
+		self.div      = numpy.load("%s/div.npy" % self.folder, mmap_mode="r")
+		self.identity = numpy.load("%s/identity.npy" % self.folder, mmap_mode="r")
+		self.order    = numpy.load("%s/order.npy" % self.folder, mmap_mode="r")
+		self.sortedDiv = numpy.load("%s/sorted_div.npy" % self.folder, mmap_mode="r")
+		return True
+
+
+	def build(self):
+		"""parse the table (header: ID, germ_div, then one column per native)"""
+
+		with open(self.table, "rU") as handle:
+			self.natives = handle.readline().rstrip("\n").split("\t")[2:]
+			ids, div, identity = [], [], [ [] for n in self.natives ]
+			for line in handle:
+				row = line.rstrip("\n").split("\t")
+				ids.append(row[0])
+				div.append( float(row[1]) if len(row) > 1 and row[1] != "NA" else numpy.nan )
+				for k, column in enumerate(identity):
+					#short rows are left out altogether, as they always were
+					value = row[2 + k] if len(row) - 2 >= len(self.natives) else "NA"
+					column.append( float(value) if value != "NA" else numpy.nan )
+
+		self.readIds  = ids
+		self.div      = numpy.array(div, dtype=numpy.float64)
+		self.identity = numpy.array(identity, dtype=numpy.float64).reshape(len(self.natives), len(ids))
+
+		#rows missing either value go to the end of each native's order
+		self.order     = numpy.zeros( (len(self.natives), len(ids)), dtype=numpy.int64 )
+		self.sortedDiv = numpy.zeros( (len(self.natives), len(ids)), dtype=numpy.float64 )
+		self.valid     = []
+		for k in range(len(self.natives)):
+			usable = ~numpy.isnan(self.div) & ~numpy.isnan(self.identity[k])
+			key    = numpy.where(usable, self.div, numpy.inf)
+			self.order[k]     = numpy.argsort(key, kind="mergesort")
+			self.sortedDiv[k] = key[ self.order[k] ]
+			self.valid.append( int(usable.sum()) )
+		self.idData = None
+
+
+	def save(self):
+		"""
+		as in FastaIndex.save, every file goes through a temp file, with
+		   meta.json taken away first and put back last, so that another
+		   2.2 run on the same table never maps a partial index
+		"""
+		try:
+			if not os.path.isdir(self.folder):
+				os.makedirs(self.folder)
+			if os.path.isfile("%s/meta.json" % self.folder):
+				os.remove("%s/meta.json" % self.folder)
+			_save_strings(self.folder, "ids", self.readIds)
+			_save_array("%s/div.npy" % self.folder, self.div)
+			_save_array("%s/identity.npy" % self.folder, self.identity)
+			_save_array("%s/order.npy" % self.folder, self.order)
+			_save_array("%s/sorted_div.npy" % self.folder, self.sortedDiv)
+			temp = "%s/meta.json.%d.tmp" % (self.folder, os.getpid())
+			with open(temp, "w") as handle:
+				json.dump( dict(format=SDI_FORMAT, stamp=self.stamp, natives=self.natives, valid=self.valid), handle )
+			os.rename(temp, "%s/meta.json" % self.folder)
+		except (IOError, OSError):
+			pass
+
+
+	def __len__(self):
+		return len(self.div)
+
+
+	def island(self, native, min_iden, max_iden, min_div, max_div):
+		"""sorted rows within the given (inclusive) ranges of identity to native and germline divergence"""
+		k    = self.natives.index(native)
+		divs = self.sortedDiv[k][ : self.valid[k] ]
+		rows = self.order[k][ numpy.searchsorted(divs, min_div, "left") : numpy.searchsorted(divs, max_div, "right") ]
+		iden = self.identity[k][rows]
+		return numpy.sort( rows[ (iden >= min_iden) & (iden <= max_iden) ] )
+
+
+	def ids(self, rows):
+		if isinstance(self.readIds, list):
+			return [ self.readIds[i] for i in rows ]
+		#a single copy of all the ID bytes is much quicker to slice than the memory map
+		if self.idData is None:
+			self.idData = self.readIds.data[:].tostring()
+		rows   = numpy.asarray(rows, dtype=numpy.int64)
+		starts = self.readIds.offsets[rows].tolist()
+		ends   = self.readIds.offsets[rows + 1].tolist()
+		return [ self.idData[a:b] for a, b in zip(starts, ends) ]
@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+
+"""
+lineageDB.py
+
+Persistent record of the pseudo-lineages found by 2.4-cluster_into_groups.py,
+      so that sequences from a new time point can be added to the existing
+      lineages (with "-update") instead of clustering everything again.
+
+The database is a folder, output/tables/<project>_lineageDB/, holding:
+         centroids.pkl  the settings used for clustering, the CDR3 of each
+                        centroid (by V/J group, in the order they were
+                        found), the size, genes, CDR3 info and included
+                        mAbs of each lineage, and checksums of the CDR3
+                        files that have already been added
+         members.txt    sequence ID and lineage representative of every
+                        sequence, appended to as sequences are added
+      Only the centroids are loaded, so adding new sequences takes time in
+      proportion to the new data and the number of lineages, not the total
+      number of sequences.
+
+Copyright (c) 2011-2017 Columbia University and Vaccine Research Center, National
+                         Institutes of Health, USA. All rights reserved.
+
+"""
+
+import os, cPickle
+
+from sonar.annotate.annotationCache import library_checksum
+
+
+# bump if the contents of centroids.pkl change
+LINEAGE_DB_FORMAT = 1
+
+
+
+class LineageDB:
+
+	def __init__(self, folder, idLevel, maxgaps):
+		self.folder    = folder
+		self.idLevel   = idLevel
+		self.maxgaps   = maxgaps
+		self.groups    = dict()		# V_J group -> dict(ids=[ centroid IDs ], seqs=[ CDR3s ])
+		self.lineages  = dict()		# centroid ID -> dict(vgene, jgene, cdr3_len, cdr3_seq, size, nats)
+		self.inputs    = []		# checksums of the CDR3 files that have been added
+
+
+	@classmethod
+	def folder_for(cls, prj_tree):
+		prj_name = prj_tree.home[prj_tree.home.rindex("/") + 1 :]
+		return "%s/%s_lineageDB" % (prj_tree.tables, prj_name)
+
+
+	@classmethod
+	def load(cls, folder):
+		"""open an existing database, or return None if there isn't a usable one"""
+		try:
+			with open("%s/centroids.pkl" % folder, "rb") as handle:
+				saved = cPickle.load(handle)
+		except (IOError, EOFError, cPickle.UnpicklingError):
+			return None
+		if saved.get("format") != LINEAGE_DB_FORMAT:
+			return None
+
+		db = cls(folder, saved["idLevel"], saved["maxgaps"])
+		db.groups, db.lineages, db.inputs = saved["groups"], saved["lineages"], saved["inputs"]
+		return db
+
+
+	def has_input(self, cdr3File):
+		return library_checksum(cdr3File) in self.inputs
+
+
+	def add_input(self, cdr3File):
+		self.inputs.append( library_checksum(cdr3File) )
+
+
+	def known(self, group):
+		"""IDs and CDR3s of the existing centroids of a V/J group"""
+		g = self.groups.get(group, dict(ids=[], seqs=[]))
+		return g["ids"], g["seqs"]
+
+
+	def add_lineage(self, group, centroid, seq, info):
+		g = self.groups.setdefault(group, dict(ids=[], seqs=[]))
+		g["ids"].append(centroid)
+		g["seqs"].append(seq)
+		self.lineages[centroid] = info
+
+
+	def natives(self):
+		"""IDs of the known antibodies already included in a lineage"""
+		return set( n for info in self.lineages.values() for n in info["nats"] )
+
+
+	def ranking(self):
+		"""centroids by decreasing size (ties by ID), as used for lineage numbers"""
+		return sorted(self.lineages, key=lambda c: (-self.lineages[c]["size"], c))
+
+
+	def add_members(self, members, fresh=False):
+		"""record (sequence ID, centroid ID) pairs; fresh=True starts the list over"""
+		if not os.path.isdir(self.folder):
+			os.makedirs(self.folder)
+		with open("%s/members.txt" % self.folder, "w" if fresh else "a") as handle:
+			for member, centroid in members:
+				handle.write("%s\t%s\n" % (member, centroid))
+
+
+	def save(self):
+		if not os.path.isdir(self.folder):
+			os.makedirs(self.folder)
+		temp = "%s/centroids.pkl.%d.tmp" % (self.folder, os.getpid())
+		with open(temp, "wb") as handle:
+			cPickle.dump( dict(format=LINEAGE_DB_FORMAT, idLevel=self.idLevel, maxgaps=self.maxgaps,
+					   groups=self.groups, lineages=self.lineages, inputs=self.inputs), handle, cPickle.HIGHEST_PROTOCOL )
+		os.rename(temp, "%s/centroids.pkl" % self.folder)
@@ -0,0 +1,238 @@
+#!/usr/bin/env python
+
+"""
+njTree.py
+
+In-process neighbor-joining trees for 2.3-intradonor_analysis.py, in place of
+      running a full MUSCLE alignment of each split ("-maxiters 1 -tree1")
+      only to keep its guide tree.
+
+Distances are anchored on the germline: every sequence is aligned (banded,
+      with free end gaps; see sonar/align.py) to a single frame made of the
+      germline V gene followed by the rest of the first native antibody
+      (CDR3 and J), and only the positions it covers are kept. Insertions
+      relative to the frame are dropped and deletions leave positions
+      uncovered. The distance between two sequences is then the fraction
+      of mismatches over the positions that both cover, which NumPy computes
+      for all pairs at once as a few matrix products. Since this is cheap
+      once the sequences are aligned, only the alignments (as projections
+      onto the frame) are cached between rounds, in a ProjectionCache.
+
+The tree is built by neighbor-joining on a single n x n matrix that shrinks as
+      nodes are joined (rows of joined nodes are overwritten, so memory
+      stays O(n^2)), with row sums updated incrementally and each search
+      for the closest pair done as one vectorized pass. Negative branch
+      lengths are set to 0.
+
+Copyright (c) 2011-2017 Columbia University and Vaccine Research Center, National
+                         Institutes of Health, USA. All rights reserved.
+
+"""
+
+import os, hashlib
+
+import numpy
+from Bio.Phylo.BaseTree import Tree, Clade
+
+from sonar.align import encode_seq, seed_diagonals, banded_semiglobal_align
+
+
+#upper limit on the number of sequences aligned in one call to the banded aligner, to keep its memory in check
+ALIGN_BATCH = 500
+
+
+def anchor_frame(germline, native):
+	"""germline V gene followed by whatever part of the native extends past its 3' end"""
+	g, n = encode_seq(germline), encode_seq(native)
+	hit  = banded_semiglobal_align( [n], [g], seed_diagonals([n], g) )[0]
+	if hit is None:
+		return str(germline)
+	return str(germline) + str(native)[ hit.qend + 1 : ]
+
+
+def project(seqs, frame):
+	"""codes of each sequence at each position of the frame (255 where it has nothing aligned)"""
+
+	ref  = encode_seq(frame)
+	proj = numpy.empty( (len(seqs), len(ref)), dtype=numpy.uint8 )
+	proj.fill(255)
+	for start in range(0, len(seqs), ALIGN_BATCH):
+		codes = [ encode_seq(s) for s in seqs[start : start + ALIGN_BATCH] ]
+		hits  = banded_semiglobal_align( codes, [ref] * len(codes), seed_diagonals(codes, ref) )
+		for n, (c, hit) in enumerate(zip(codes, hits)):
+			if hit is not None:
+				for s, q, length in hit.blocks:
+					proj[start + n, s : s + length] = c[q : q + length]
+	#anything other than A, C, G or T doesn't count
+	proj[proj > 3] = 255
+	return proj
+
+
+def anchored_distances(seqs, frame):
+	"""matrix of mismatch fractions over shared positions of the frame (1 if there are none)"""
+	return projected_distances( project(seqs, frame) )
+
+
+def projected_distances(proj):
+	"""as anchored_distances, for sequences that have already been projected onto the frame"""
+
+	covered = (proj < 4).astype(numpy.float32)
+	overlap = covered.dot(covered.T)
+	matches = numpy.zeros_like(overlap)
+	for base in range(4):
+		same     = (proj == base).astype(numpy.float32)
+		matches += same.dot(same.T)
+
+	dist = numpy.ones( overlap.shape, dtype=numpy.float64 )
+	shared = overlap > 0
+	dist[shared] = 1 - matches[shared] / overlap[shared]
+	numpy.fill_diagonal(dist, 0)
+	return dist
+
+
+class ProjectionCache:
+	"""
+	projections onto the frame (see project), kept on disk for the whole
+	   analysis so that each sequence is only aligned once, however many
+	   rounds it stays in: keys.txt lists "ID<tab>md5 of sequence" for each
+	   row of the uint8 matrix in proj.bin. Each frame gets its own
+	   subfolder (named for its md5), so analyses with different natives
+	   don't clear each other's projections. Rows past the end of either
+	   file (left by an interrupted add) are dropped when the cache is
+	   opened.
+	"""
+
+	def __init__(self, folder, frame):
+
+		self.frame  = str(frame)
+		self.width  = len(self.frame)
+		self.folder = "%s/%s" % ( folder, hashlib.md5(self.frame).hexdigest() )
+		if not os.path.isdir(self.folder):
+			os.makedirs(self.folder)
+
+		keys = []
+		if os.path.isfile("%s/keys.txt" % self.folder):
+			with open("%s/keys.txt" % self.folder) as handle:
+				keys = [ line.rstrip("\n") for line in handle if line.endswith("\n") ]
+
+		data = "%s/proj.bin" % self.folder
+		rows = os.path.getsize(data) // self.width if os.path.isfile(data) else 0
+		if len(keys) > rows:
+			keys = keys[ : rows ]
+			self._write_keys(keys)
+		if rows > len(keys):
+			with open(data, "r+b") as handle:
+				handle.truncate( len(keys) * self.width )
+
+		self.index = dict( (k, row) for row, k in enumerate(keys) )
+
+
+	def _write_keys(self, keys):
+		temp = "%s/keys.txt.%d.tmp" % (self.folder, os.getpid())
+		with open(temp, "w") as handle:
+			for k in keys:
+				handle.write(k + "\n")
+		os.rename(temp, "%s/keys.txt" % self.folder)
+
+
+	@staticmethod
+	def key(seq_id, seq):
+		return "%s\t%s" % ( seq_id, hashlib.md5(str(seq).upper()).hexdigest() )
+
+
+	def __contains__(self, key):
+		return key in self.index
+
+
+	def add(self, keys, proj):
+		"""append projections (rows of proj) for new keys"""
+		#data before keys, so a key never points past the end of the data
+		with open("%s/proj.bin" % self.folder, "ab") as handle:
+			handle.write( numpy.ascontiguousarray(proj, dtype=numpy.uint8).tostring() )
+		for k in keys:
+			self.index[k] = len(self.index)
+		self._write_keys( sorted(self.index, key=self.index.get) )
+
+
+	def fetch(self, keys):
+		"""projections for a list of keys, which must all be in the cache"""
+		data = numpy.memmap( "%s/proj.bin" % self.folder, dtype=numpy.uint8, mode="r" ).reshape(-1, self.width)
+		return data[ [ self.index[k] for k in keys ] ]
+
+
+def neighbor_joining(names, dist):
+	"""unrooted NJ tree (a Bio.Phylo Tree with a trifurcating root) of the named leaves"""
+
+	m     = len(names)
+	nodes = [ Clade(name=name) for name in names ]
+	if m < 3:
+		return Tree( root=Clade(clades=nodes), rooted=False )
+
+	D     = numpy.array(dist, dtype=numpy.float64)
+	total = D.sum(axis=1)
+	work  = numpy.empty(m * m)
+
+	while m > 3:
+		#Q(i,j) = (m-2) d(i,j) - r(i) - r(j), over the first m rows only, in a reused buffer
+		Q = work[ : m * m ].reshape(m, m)
+		numpy.multiply(D[:m, :m], m - 2, out=Q)
+		Q -= total[:m, None]
+		Q -= total[None, :m]
+		Q.flat[ :: m + 1 ] = numpy.inf
+		i, j = divmod(int(Q.argmin()), m)
+		if i > j:
+			i, j = j, i
+
+		di = 0.5 * D[i, j] + (total[i] - total[j]) / (2.0 * (m - 2))
+		dj = D[i, j] - di
+		nodes[i].branch_length = max(0.0, di)
+		nodes[j].branch_length = max(0.0, dj)
+		joined = Clade(clades=[ nodes[i], nodes[j] ])
+
+		#the new node takes row i and the last row moves into row j (newRow is 0 at both i and j)
+		newRow = 0.5 * (D[i, :m] + D[j, :m] - D[i, j])
+		total[:m] += newRow - D[i, :m] - D[j, :m]
+		D[i, :m]   = newRow
+		D[:m, i]   = newRow
+		total[i]   = newRow.sum()
+		nodes[i]   = joined
+
+		last = m - 1
+		if j != last:
+			D[j, :m]  = D[last, :m]
+			D[:m, j]  = D[:m, last]
+			D[j, j]   = 0
+			total[j]  = total[last]
+			nodes[j]  = nodes[last]
+		m -= 1
+
+	#join the last three at the root
+	for a in range(3):
+		b, c = [ x for x in range(3) if x != a ]
+		nodes[a].branch_length = max(0.0, 0.5 * (D[a, b] + D[a, c] - D[b, c]))
+	return Tree( root=Clade(clades=nodes[:3]), rooted=False )
+
+
+def to_newick(tree):
+	"""Newick string of a tree, with names as they are (as MUSCLE writes them); iterative, so deep trees are fine"""
+
+	out   = []
+	stack = [ (tree.root, False) ]
+	while stack:
+		clade, done = stack.pop()
+		if isinstance(clade, str):
+			out.append(clade)
+		elif done or clade.is_terminal():
+			if clade.is_terminal():
+				out.append(clade.name)
+			if clade.branch_length is not None and clade is not tree.root:
+				out.append(":%.6f" % clade.branch_length)
+		else:
+			stack.append( (clade, True) )
+			stack.append( (")", False) )
+			for n, child in enumerate(reversed(clade.clades)):
+				stack.append( (child, False) )
+				if n < len(clade.clades) - 1:
+					stack.append( (",", False) )
+			stack.append( ("(", False) )
+	return "".join(out) + ";"
@@ -12,8 +12,10 @@ from .. import *
 import csv
 from collections import defaultdict
 from math import log
-from numpy import average, std
-import pandas
+
+#pandas is only needed to compare spectra, so only load it then
+average = LazyObject("numpy", "average")
+pandas  = LazyModule("pandas")
 
 class GSSP:
 	
@@ -12,9 +12,18 @@ This script calls DNAML to generate a maximum likelihood tree for a set
       -v parameter to specify the assigned V gene, which will be added to
       the alignment and used for rooting the tree.
 
+DNAML can also be run several times with different random seeds (-replicates),
+      each in its own temporary folder, so that several searches can run at
+      once (-threads). The tree with the best log likelihood is kept, along
+      with the ancestral sequences inferred on it, and the likelihood of
+      every replicate is saved in dnaml_replicates.txt in the work folder. A
+      majority-rule consensus of all the replicates, with the percentage of
+      replicates supporting each branch, can be saved as well (-consensus).
+
 
 Usage: 3.2-runDNAML.py ( -i custom/input.phy | -v germline_V )
                        [ -locus <H|K|L> -lib path/to/library.fa -n native.fa ]
+                       [ -replicates 1 -threads 1 -consensus consensus.tree ]
 		       [ -f -h ]
 
     Invoke with -h or --help to print this documentation.
@@ -40,6 +49,12 @@ Usage: 3.2-runDNAML.py ( -i custom/input.phy | -v germline_V )
     outtree     Where to save the output tree. Default: output/<project>.tree
     outfile     Where to save DNAML output (text tree and inferred ancestors)
                    Default: output/logs/<project>.dnaml.out
+    replicates  Number of times to run DNAML, each with a different random
+                   seed for jumbling the input order. Default: 1.
+    threads     Number of replicates to run at the same time. Default: 1.
+    consensus   Where to save a majority-rule consensus of the replicates,
+                   with support values. Default: none (only with
+                   -replicates > 1).
 
 
     Optional parameters (only relevant when using the -v option):
@@ -67,9 +82,12 @@ Copyright (c) 2011-2016 Columbia University Vaccine Research Center, National
 
 """
 
-import sys
-from Bio import AlignIO
+import sys, tempfile
+from cStringIO import StringIO
+from multiprocessing.pool import ThreadPool
+from Bio import AlignIO, Phylo
 from Bio.Align.Applications import MuscleCommandline
+from Bio.Phylo.Consensus import majority_consensus
 
 try:
 	from sonar.phylogeny import *
@@ -83,6 +101,80 @@ except ImportError:
 def revertName(match):
     return lookup[ int(match.group(0)) - 1 ] #ids are 1-indexed, list is 0-indexed
 
+
+def runDNAML(folder, germ_pos, seed, quiet=False):
+    """run DNAML on the infile in folder; returns the log likelihood of the tree it found, or None if there isn't one"""
+
+    # J is "jumble" followed by random seed and number of times to repeat
+    # O is outgroup root, followed by position of the germline in the alignment
+    # 5 tells DNAML to do the ancestor inference
+    # Y starts the run
+    with open("%s/dnaml.in" % folder, "w") as handle:
+        handle.write("J\n%d\n5\nG\nO\n%d\n5\nY\n" % (seed, germ_pos))
+
+    # run in the folder so DNAML finds "infile" and puts the output where we expect
+    with open("%s/dnaml.in" % folder, "rU") as pipe:
+        if quiet:
+            with open("%s/dnaml.log" % folder, "w") as log:
+                subprocess.call([dnaml], stdin=pipe, stdout=log, stderr=subprocess.STDOUT, cwd=folder)
+        else:
+            subprocess.call([dnaml], stdin=pipe, cwd=folder)
+
+    try:
+        with open("%s/outfile" % folder, "rU") as handle:
+            found = re.search("Ln Likelihood\s*=\s*(-?[0-9.]+)", handle.read())
+    except IOError:
+        return None
+    if found is None or not os.path.isfile("%s/outtree" % folder):
+        return None
+    return float(found.group(1))
+
+
+def newSeed():
+    return random.randint(0,1e10) * 2 + 1 #seed must be odd
+
+
+def runReplicates(germ_pos):
+    """
+    run the replicates in their own folders and move the output of the best
+       one to the work folder; returns the renamed trees of all of them
+    """
+
+    folders = [ tempfile.mkdtemp(prefix="dnaml%03d_" % (r+1), dir=workDir) for r in range(replicates) ]
+    seeds   = [ newSeed() for r in range(replicates) ]
+    for folder in folders:
+        shutil.copyfile("%s/infile" % workDir, "%s/infile" % folder)
+
+    print "Running %d DNAML replicates, %d at a time..." % (replicates, threads)
+    pool = ThreadPool(threads)
+    likelihoods = pool.map( lambda job: runDNAML(job[0], germ_pos, job[1], quiet=True), zip(folders, seeds) )
+    pool.close()
+    pool.join()
+
+    finished = [ r for r in range(replicates) if likelihoods[r] is not None ]
+    if len(finished) == 0:
+        sys.exit( "DNAML failed for every replicate; see dnaml.log in %s" % " ".join(folders) )
+    best = max( finished, key=lambda r: likelihoods[r] )
+
+    with open("%s/dnaml_replicates.txt" % workDir, "w") as handle:
+        handle.write("replicate\tseed\tln_likelihood\n")
+        for r in range(replicates):
+            handle.write( "%d\t%d\t%s%s\n" % (r+1, seeds[r], "NA" if likelihoods[r] is None else "%.5f" % likelihoods[r], "\tbest" if r == best else "") )
+    print "Best tree from replicate %d (ln likelihood %.5f); %d of %d replicates finished, see %s/dnaml_replicates.txt" % \
+        (best+1, likelihoods[best], len(finished), replicates, workDir)
+
+    trees = []
+    for r in finished:
+        with open("%s/outtree" % folders[r], "rU") as intree:
+            trees.append( re.sub("\d{10}", revertName, intree.read()) )
+
+    for f in ["outtree", "outfile"]:
+        shutil.move( "%s/%s" % (folders[best], f), "%s/%s" % (workDir, f) )
+    for r in finished:
+        shutil.rmtree(folders[r])
+
+    return trees
+
 def main():
 
     global inFile, lookup, workDir, outTreeFile, outFile, seqFile
@@ -141,22 +233,16 @@ def main():
         AlignIO.write(aln, output, "phylip")
 
 
-    #now generate script for DNAML
-    # J is "jumble" followed by random seed and number of times to repeat
-    # O is outgroup root, followed by position of the germline in the alignment
-    # 5 tells DNAML to do the ancestor inference
-    # Y starts the run
-    with open("%s/dnaml.in"%workDir, "w") as handle:
-        seed = random.randint(0,1e10) * 2 + 1 #seed must be odd
-        handle.write("J\n%d\n5\nG\nO\n%d\n5\nY\n" % (seed, germ_pos))
-
-
-    # change to work directory so DNAML finds "infile" and puts the output where we expect
-    origWD = os.getcwd()
-    os.chdir(workDir)
-    with open("dnaml.in", "rU") as pipe:
-        subprocess.call([dnaml], stdin=pipe)
-    os.chdir(origWD)
+    if replicates > 1:
+        trees = runReplicates(germ_pos)
+        if consensusFile is not None:
+            #DNAML writes several trees if they are equally likely; the first will do
+            cons = majority_consensus( [ Phylo.parse(StringIO(t), "newick").next() for t in trees ], 0.5 )
+            cons.root_with_outgroup( lookup[germ_pos - 1] ) #outgroup-rooted, like the DNAML trees
+            Phylo.write(cons, consensusFile, "newick")
+            print "Majority-rule consensus of %d trees saved to %s" % (len(trees), consensusFile)
+    else:
+        runDNAML(workDir, germ_pos, newSeed())
 
     #revert names in tree
     with open("%s/outtree"%workDir, "rU") as intree:
@@ -201,9 +287,15 @@ if __name__ == '__main__':
 
 
 	#get the parameters from the command line
-	dict_args = processParas(sys.argv, n="natFile", v="germlineV", locus="locus", lib="library", i="inFile", seqs="seqFile", outtree="outTreeFile", outfile="outFile")
-	defaults = dict(locus="H", library="", inFile=None, seqFile=None, outTreeFile=None, outFile=None)
-	natFile, germlineV, locus, library, inFile, seqFile, outTreeFile, outFile = getParasWithDefaults(dict_args, defaults, "natFile", "germlineV", "locus", "library", "inFile", "seqFile", "outTreeFile", "outFile")
+	dict_args = processParas(sys.argv, n="natFile", v="germlineV", locus="locus", lib="library", i="inFile", seqs="seqFile", outtree="outTreeFile", outfile="outFile",
+				 replicates="replicates", threads="threads", consensus="consensusFile")
+	defaults = dict(locus="H", library="", inFile=None, seqFile=None, outTreeFile=None, outFile=None, replicates=1, threads=1, consensusFile=None)
+	natFile, germlineV, locus, library, inFile, seqFile, outTreeFile, outFile, replicates, threads, consensusFile = getParasWithDefaults(dict_args, defaults, "natFile", "germlineV", "locus", "library", "inFile", "seqFile", "outTreeFile", "outFile", "replicates", "threads", "consensusFile")
+
+	if replicates < 1 or threads < 1:
+		sys.exit("-replicates and -threads must be at least 1.")
+	if consensusFile is not None and replicates == 1:
+		sys.exit("A consensus tree needs more than one replicate (use -replicates).")
 
         doAlign = True
 	if germlineV is None:
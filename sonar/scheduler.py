@@ -0,0 +1,294 @@
+#!/usr/bin/env python
+
+"""
+scheduler.py
+
+A small task scheduler for the cluster steps of the pipeline. Each step (eg the
+      BLAST search of one split file, a call to the next script, or one NJ
+      tree in a round of 2.3) is a Task in a TaskGraph, with the tasks it
+      must wait for, the output files it should produce and resource hints
+      for the cluster. TaskGraph.run() submits every task as soon as the
+      tasks it depends on have finished, resubmits tasks that failed or
+      were lost by the cluster (up to a number of retries) and returns once
+      everything is done.
+
+Every task runs as a shell script which leaves a completion marker
+      (<task>.done) in the graph's folder if its command succeeded and all
+      of its outputs exist, or <task>.failed with the exit status otherwise,
+      so the scheduler never has to guess from the state of the queue.
+
+Backends (chosen with cluster_backend in paths.py, see setup.sh):
+    sge     submit each task with qsub (default)
+    slurm   submit each task with sbatch
+    local   run the task scripts on this machine, -threads at a time
+    mock    like local, but with SGE job scripts (and, for testing, jobs that
+               get lost), for trying out the cluster code paths without a
+               cluster
+
+Copyright (c) 2011-2017 Columbia University and Vaccine Research Center, National
+                         Institutes of Health, USA. All rights reserved.
+
+"""
+
+import os, re, sys, time, getpass, subprocess
+from collections import OrderedDict
+
+from sonar.commonVars import PBS_STRING
+import sonar.paths
+
+
+#seconds between checks on running jobs
+CLUSTER_POLL = 15
+LOCAL_POLL   = 0.2
+
+
+class Task:
+
+	def __init__(self, name, command, outputs=[], after=[], mem="2G", time="2:00:00", retries=2, local=False):
+		self.name     = name
+		self.command  = command
+		self.outputs  = list(outputs)
+		self.after    = list(after)		# Tasks that have to finish first
+		self.mem      = mem			# resource hints for the cluster
+		self.time     = time
+		self.retries  = retries
+		self.local    = local			# run on this machine, even when using a cluster
+
+		self.status   = "waiting"		# waiting -> running -> done / failed / skipped
+		self.attempts = 0
+		self.job      = None
+
+
+class LocalBackend:
+	"""run task scripts as subprocesses, up to `threads` at a time"""
+
+	poll = LOCAL_POLL
+
+	def __init__(self, threads=1):
+		self.threads = threads
+		self.running = 0
+
+	def script(self, task, jobName, body):
+		return "#!/bin/bash\n\n%s\n" % body
+
+	def free(self):
+		return self.running < self.threads
+
+	def submit(self, task, script):
+		self.running += 1
+		return subprocess.Popen(["bash", script])
+
+	def finished(self, jobs):
+		"""the jobs (from a list of running ones) that have exited"""
+		done = set( job for job in jobs if job.poll() is not None )
+		self.running -= len(done)
+		return done
+
+
+class MockClusterBackend(LocalBackend):
+	"""
+	a LocalBackend that writes the same job scripts as SGEBackend; `lose` maps
+	   task names to a number of attempts that should vanish without running,
+	   as if their node had crashed
+	"""
+
+	def __init__(self, threads=1, lose=dict()):
+		LocalBackend.__init__(self, threads)
+		self.lose      = dict(lose)
+		self.submitted = []
+
+	def script(self, task, jobName, body):
+		return PBS_STRING % (jobName, task.mem, task.time, body)
+
+	def submit(self, task, script):
+		self.submitted.append(task.name)
+		if self.lose.get(task.name, 0) > 0:
+			self.lose[task.name] -= 1
+			self.running += 1
+			return subprocess.Popen(["true"])
+		return LocalBackend.submit(self, task, script)
+
+
+class ClusterBackend:
+	"""
+	checks on all running jobs with a single listing of the user's jobs per
+	   poll; a job has finished once it is no longer listed. If the listing
+	   fails (eg the scheduler is busy or down) nothing is taken to have
+	   finished, rather than resubmitting jobs that may still be running.
+	"""
+
+	poll = CLUSTER_POLL
+
+	def free(self):
+		return True
+
+	def finished(self, jobs):
+		listing = subprocess.Popen(self.list_command(), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+		output, error = listing.communicate()
+		if listing.returncode != 0:
+			print "%s - Could not check on cluster jobs (%s), will try again..." % (time.strftime("%H:%M:%S"), error.strip())
+			return set()
+		queued = set( self.listed_jobs(output) )
+		return set( job for job in jobs if job not in queued )
+
+
+class SGEBackend(ClusterBackend):
+
+	def __init__(self, qsub="qsub"):
+		self.qsub  = qsub
+		self.qstat = os.path.join(os.path.dirname(qsub), "qstat")
+
+	def script(self, task, jobName, body):
+		return PBS_STRING % (jobName, task.mem, task.time, body)
+
+	def submit(self, task, script):
+		output = subprocess.Popen([self.qsub, script], stdout=subprocess.PIPE).communicate()[0]
+		job = re.search("Your job (\d+)", output)
+		if job is None:
+			raise OSError("Could not submit %s to the cluster: %s" % (script, output))
+		return job.group(1)
+
+	def list_command(self):
+		return [self.qstat, "-u", getpass.getuser()]
+
+	def listed_jobs(self, output):
+		#job ID is the first column, after two lines of headers
+		return [ line.split()[0] for line in output.splitlines()[2:] if line.strip() ]
+
+
+class SlurmBackend(ClusterBackend):
+
+	def __init__(self, sbatch="sbatch"):
+		self.sbatch = sbatch
+		self.squeue = os.path.join(os.path.dirname(sbatch), "squeue")
+
+	def script(self, task, jobName, body):
+		return "#!/bin/bash\n#SBATCH --job-name=%s\n#SBATCH --mem=%s\n#SBATCH --time=%s\n#SBATCH --output=/dev/null\n#SBATCH --error=/dev/null\n\n%s\n" % \
+		    (jobName, task.mem, task.time, body)
+
+	def submit(self, task, script):
+		output = subprocess.Popen([self.sbatch, "--parsable", script], stdout=subprocess.PIPE).communicate()[0]
+		if not re.match("\d+", output):
+			raise OSError("Could not submit %s to the cluster: %s" % (script, output))
+		return output.strip().split(";")[0]
+
+	def list_command(self):
+		return [self.squeue, "-h", "-u", getpass.getuser(), "-o", "%i"]
+
+	def listed_jobs(self, output):
+		return output.split()
+
+
+def get_cluster_backend(threads=1):
+	"""the backend set up in paths.py (SGE unless cluster_backend says otherwise)"""
+
+	kind   = getattr(sonar.paths, "cluster_backend", "sge")
+	submit = getattr(sonar.paths, "qsub", "qsub")
+
+	if kind == "sge":
+		return SGEBackend(submit)
+	elif kind == "slurm":
+		return SlurmBackend(submit if os.path.basename(submit) == "sbatch" else "sbatch")
+	elif kind == "local":
+		return LocalBackend(threads)
+	elif kind == "mock":
+		return MockClusterBackend(threads)
+	else:
+		sys.exit("Unknown cluster_backend %s in paths.py (options are sge, slurm, local and mock)" % kind)
+
+
+
+class TaskGraph:
+
+	def __init__(self, folder, backend, prefix="sonar"):
+		self.folder  = folder		# job scripts and completion markers go here
+		self.backend = backend
+		self.prefix  = prefix		# added to job names to tell projects apart in the queue
+		self.local   = LocalBackend(1)
+		self.tasks   = OrderedDict()
+
+		if not os.path.isdir(folder):
+			os.makedirs(folder)
+
+
+	def add(self, name, command, outputs=[], after=[], **hints):
+		"""add a task; any completion markers left over from an earlier run are removed"""
+		task = Task(name, command, outputs, after, **hints)
+		self.tasks[name] = task
+		for kind in ["done", "failed"]:
+			if os.path.isfile(self.marker(task, kind)):
+				os.remove(self.marker(task, kind))
+		return task
+
+
+	def marker(self, task, kind):
+		return "%s/%s.%s" % (self.folder, task.name, kind)
+
+
+	def backend_for(self, task):
+		return self.local if task.local else self.backend
+
+
+	def complete(self, task):
+		return os.path.isfile(self.marker(task, "done")) and all( os.path.exists(f) for f in task.outputs )
+
+
+	def submit(self, task):
+
+		backend = self.backend_for(task)
+		checks  = "".join( " && [ -e %s ]" % f for f in task.outputs )
+		body    = "rm -f %s %s\n(\n%s\n)\nstatus=$?\nif [ $status -eq 0 ]%s; then touch %s; else echo $status > %s; fi" % \
+		    ( self.marker(task, "done"), self.marker(task, "failed"), task.command, checks,
+		      self.marker(task, "done"), self.marker(task, "failed") )
+
+		script = "%s/%s.sh" % (self.folder, task.name)
+		with open(script, "w") as handle:
+			handle.write( backend.script(task, "%s-%s" % (task.name, self.prefix), body) )
+
+		task.job       = backend.submit(task, script)
+		task.status    = "running"
+		task.attempts += 1
+
+
+	def run(self):
+		"""run everything; returns True if all tasks finished successfully"""
+
+		while any( t.status in ["waiting", "running"] for t in self.tasks.values() ):
+
+			changed = False
+
+			#collect finished jobs, asking each backend about all of its jobs at once
+			finished = set()
+			for backend in [ self.backend, self.local ]:
+				jobs = [ t.job for t in self.tasks.values() if t.status == "running" and self.backend_for(t) is backend ]
+				if len(jobs) > 0:
+					finished |= backend.finished(jobs)
+
+			for task in self.tasks.values():
+				if task.status == "running" and task.job in finished:
+					changed = True
+					if self.complete(task):
+						task.status = "done"
+					elif task.attempts <= task.retries:
+						print "%s - Task %s failed (attempt %d of %d), resubmitting..." % (time.strftime("%H:%M:%S"), task.name, task.attempts, task.retries+1)
+						task.status = "waiting"
+					else:
+						print "%s - Task %s failed after %d attempts" % (time.strftime("%H:%M:%S"), task.name, task.attempts)
+						task.status = "failed"
+
+			#start everything that is ready
+			for task in self.tasks.values():
+				if task.status != "waiting":
+					continue
+				if any( t.status in ["failed", "skipped"] for t in task.after ):
+					task.status = "skipped"
+					changed = True
+				elif all( t.status == "done" for t in task.after ) and self.backend_for(task).free():
+					self.submit(task)
+					changed = True
+
+			if not changed:
+				running = [ self.backend_for(t) for t in self.tasks.values() if t.status == "running" ]
+				time.sleep( min( [ b.poll for b in running ] + [CLUSTER_POLL] ) )
+
+		return all( t.status == "done" for t in self.tasks.values() )
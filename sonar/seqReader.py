@@ -0,0 +1,178 @@
+#!/usr/bin/env python
+
+"""
+seqReader.py
+
+Streaming reader for raw FASTA and FASTQ files (plain or gzip/bgzip
+      compressed), for steps that only need the ID and sequence of each read.
+      Files are read in large blocks and each read comes back as a plain
+      (id, sequence) tuple, without building a SeqRecord for it.
+
+IDs and sequences are the same as Bio.SeqIO would give: the ID is the first
+      word of the title line, multi-line records are joined and any
+      whitespace is removed from the sequence. With titles=True, the whole
+      title line is returned instead of the ID.
+
+With background=True, compressed files are decompressed in a separate thread
+      (zlib releases the GIL), so that decompression overlaps with whatever
+      is done with the reads.
+
+Copyright (c) 2011-2017 Columbia University and Vaccine Research Center, National
+                         Institutes of Health, USA. All rights reserved.
+
+"""
+
+import re, gzip, threading, Queue
+
+
+BLOCK_SIZE  = 4 * 1024 * 1024
+QUEUE_DEPTH = 8
+
+
+def is_fastq(path):
+	return re.search("\.(fq|fastq)(\.gz)?$", path) is not None
+
+
+def is_gzip(path):
+	with open(path, "rb") as handle:
+		return handle.read(2) == "\x1f\x8b"
+
+
+def _read_blocks(handle):
+	block = handle.read(BLOCK_SIZE)
+	while block:
+		yield block
+		block = handle.read(BLOCK_SIZE)
+
+
+def _background_blocks(handle):
+	"""decompress in a helper thread, handing blocks over through a bounded queue"""
+
+	blocks = Queue.Queue(QUEUE_DEPTH)
+	def fill():
+		try:
+			for block in _read_blocks(handle):
+				blocks.put(block)
+			blocks.put(None)
+		except Exception as err:
+			blocks.put(err)
+
+	worker = threading.Thread(target=fill)
+	worker.daemon = True
+	worker.start()
+
+	while True:
+		block = blocks.get()
+		if block is None:
+			break
+		elif isinstance(block, Exception):
+			raise block
+		yield block
+	worker.join()
+
+
+def open_blocks(path, background=False):
+	"""generate the (decompressed) contents of a file in large blocks"""
+
+	if is_gzip(path):
+		#gzip.GzipFile also reads the multiple members of bgzip files
+		handle = gzip.open(path, "rb")
+		blocks = _background_blocks(handle) if background else _read_blocks(handle)
+	else:
+		handle = open(path, "rb")
+		blocks = _read_blocks(handle)
+
+	try:
+		for block in blocks:
+			yield block
+	finally:
+		handle.close()
+
+
+def _lines(blocks):
+	leftover = ""
+	for block in blocks:
+		lines = (leftover + block).split("\n")
+		leftover = lines.pop()
+		for line in lines:
+			yield line
+	if leftover:
+		yield leftover
+
+
+def _fasta_record(record, titles=False):
+	title, newline, body = record.partition("\n")
+	if titles:
+		return ( title.strip(), "".join(body.split()) )
+	words = title.split(None, 1)
+	return ( words[0] if len(words) > 0 else "", "".join(body.split()) )
+
+
+def read_fasta(blocks, titles=False):
+	"""records start at any line beginning with '>'; anything before the first one is skipped"""
+
+	leftover, preamble = None, ""
+	for block in blocks:
+		if leftover is None:
+			block = preamble + block
+			if block.startswith(">"):
+				block = block[ 1 : ]
+			else:
+				start = block.find("\n>")
+				if start < 0:
+					preamble = block[-1:]
+					continue
+				block = block[ start + 2 : ]
+			leftover = ""
+
+		records = (leftover + block).split("\n>")
+		leftover = records.pop()
+		for record in records:
+			yield _fasta_record(record, titles)
+
+	if leftover:
+		yield _fasta_record(leftover, titles)
+
+
+def read_fastq(blocks, titles=False):
+	"""same parsing as Bio.SeqIO.QualityIO.FastqGeneralIterator, including multi-line records"""
+
+	lines = _lines(blocks)
+	line  = next(lines, None)
+	while line is not None:
+		if line[:1] != "@":
+			raise ValueError("Records in Fastq files should start with '@' character")
+		words  = line[1:].split(None, 1)
+		seq_id = words[0] if len(words) > 0 else ""
+		title  = line[1:].strip() if titles else seq_id
+
+		seq  = next(lines, "").rstrip()
+		line = next(lines, None)
+		while line is None or line[:1] != "+":
+			if line is None:
+				raise ValueError("End of file without quality information.")
+			seq += line.rstrip()
+			line = next(lines, None)
+		if " " in seq or "\t" in seq:
+			raise ValueError("Whitespace is not allowed in the sequence.")
+
+		#a line starting with '@' can be quality data until there is as much quality as sequence
+		qual_len = len(next(lines, "").rstrip())
+		line = next(lines, None)
+		while line is not None and not (line[:1] == "@" and qual_len >= len(seq)):
+			qual_len += len(line.rstrip())
+			line = next(lines, None)
+		if qual_len != len(seq):
+			raise ValueError("Lengths of sequence and quality values differs for %s (%i and %i)." % (seq_id, len(seq), qual_len))
+
+		yield title, seq
+
+
+def read_sequences(path, background=False, titles=False):
+	"""generate (id, sequence) for every read in a FASTA or FASTQ file (or (title, sequence) with titles=True)"""
+
+	blocks = open_blocks(path, background)
+	if is_fastq(path):
+		return read_fastq(blocks, titles)
+	else:
+		return read_fasta(blocks, titles)
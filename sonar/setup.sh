@@ -44,6 +44,7 @@ while [ "$verified" != "Y" ] && [ "$verified" != "y" ]; do
     dnaml="dnaml"
     beast="beast"
     clusterExists="False"
+    clusterBackend="sge"
 
 #Ask user for input
     echo ""
@@ -90,7 +91,11 @@ if [ "$cluster" == "Y" ] || [ "$cluster" == "y" ]; then
 
     while [ "$checked" != "Y" ] && [ "$checked" != "y" ]; do
 	#defaults
+	read -e -p "Does the cluster use SGE or Slurm (default sge) [sge/slurm]? " var; clusterBackend=${var:-sge}
 	qsub="qsub"
+	if [ "$clusterBackend" == "slurm" ]; then
+	    qsub="sbatch"
+	fi
 	clustMuscle="muscle"
 	clustBlast="blastn"
 
@@ -98,18 +103,19 @@ if [ "$cluster" == "Y" ] || [ "$cluster" == "y" ]; then
 	echo ""
 	if [[ ${BASH_VERSION[0]} < 4 ]]
 	then
-	    read -e -p "Please enter the path to qsub (default $qsub): " var; qsub=${var:-$qsub}
+	    read -e -p "Please enter the path to $qsub (default $qsub): " var; qsub=${var:-$qsub}
 	    read -e -p "Please enter the path to Muscle on the cluster (default $clustMuscle): "  var; clustMuscle=${var:-$clustMuscle}
 	    read -e -p "Please enter the path to blastn on the cluster (default $clustBlast): " var; clustBlast=${var:-$clustBlast}
 	else
-	    read -e -p "Please enter the path to qsub: " -i $qsub qsub
+	    read -e -p "Please enter the path to $qsub: " -i $qsub qsub
 	    read -e -p "Please enter the path to Muscle on the cluster: " -i $clustMuscle clustMuscle
 	    read -e -p "Please enter the path to blastn on the cluster: " -i $clustBlast clustBlast
 	fi
 
 	#and check
 	echo -e "\n\nYou have entered the following values:
-\tPath to qsub:  $qsub
+\tCluster scheduler: $clusterBackend
+\tPath to qsub/sbatch:  $qsub
 \tPath to Muscle on the cluster: $clustMuscle
 \tPath to blastn on the cluster: $clustBlast\n"
 
@@ -138,6 +144,10 @@ fi
 
 #Now create output:
 
+#record the version now, so scripts don't have to ask git every time they run
+#    (run setup.sh again after updating SONAR)
+version=$(git -C $pipeDir describe --always --dirty --tags 2>/dev/null)
+
 #create a file for the Python portion of the pipeline
 echo "
 
@@ -148,10 +158,13 @@ usearch        = \"$usearch\"
 dnaml          = \"$dnaml\"
 
 clusterExists  = $clusterExists
+cluster_backend = \"$clusterBackend\"
 qsub           = \"$qsub\"
 cluster_muscle = \"$clustMuscle\"
 cluster_blast  = \"$clustBlast\"
 
+SONAR_VERSION  = \"$version\"
+
 " > paths.py
 
 
@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+
+"""
+translation.py
+
+Batch translation of nucleotide sequences with NumPy. The sequences of a batch
+      are joined into a single byte array, each base is encoded as a number
+      (A/C/G/T/N, in either case) and every codon is translated at once by
+      indexing a lookup table of all 125 such codons.
+
+The lookup table is filled in by Biopython itself, so results are the same as
+      with Seq.translate() (standard table, X for codons with an N that could
+      mean more than one amino acid). Sequences that the table can't handle
+      (other IUPAC ambiguity codes, gaps, or a length that is not a multiple
+      of 3) are passed on to Seq.translate(), so they also get exactly the
+      same result (or the same error or warning).
+
+    translate(seq)                  one sequence (a string or a Seq), as a string
+    translate_batch(seqs)           a list of sequences, as a list of strings
+    translate_fasta(infile, out)    translate a whole FASTA file, a batch at a time
+
+Copyright (c) 2011-2017 Columbia University and Vaccine Research Center, National
+                         Institutes of Health, USA. All rights reserved.
+
+"""
+
+import itertools
+import numpy
+from Bio.Seq import Seq
+from Bio.SeqIO.FastaIO import SimpleFastaParser
+
+
+BASES      = "ACGTN"
+NO_CODE    = 255
+BATCH_SIZE = 10000
+FASTA_WRAP = 60		# line length used by SeqIO.write
+
+
+#base -> number, for both upper and lower case
+_CODE = numpy.empty(256, dtype=numpy.uint8)
+_CODE.fill(NO_CODE)
+for i, base in enumerate(BASES):
+	_CODE[ord(base)] = i
+	_CODE[ord(base.lower())] = i
+
+#codon number -> amino acid
+_TABLE = numpy.array( [ ord(str(Seq("".join(codon)).translate())) for codon in itertools.product(BASES, repeat=3) ], dtype=numpy.uint8 )
+
+
+def translate_batch(seqs):
+	"""translate a list of nucleotide sequences (strings or Seq objects); returns a list of strings"""
+
+	seqs   = [ str(s) for s in seqs ]
+	result = [ None ] * len(seqs)
+
+	fast = [ i for i, s in enumerate(seqs) if len(s) % 3 == 0 ]
+	if len(fast) > 0:
+		codes  = _CODE[ numpy.frombuffer("".join(seqs[i] for i in fast), dtype=numpy.uint8) ].reshape(-1, 3).astype(numpy.int32)
+		bad    = (codes == NO_CODE).any(axis=1)
+		codons = numpy.where( bad, 0, codes[:, 0] * 25 + codes[:, 1] * 5 + codes[:, 2] )
+		aa     = _TABLE[codons].tostring()
+
+		#codon boundaries of each sequence, and whether it had any codon the table can't translate
+		ends      = numpy.cumsum([ len(seqs[i]) // 3 for i in fast ]).tolist()
+		starts    = [0] + ends[:-1]
+		badBefore = [0] + numpy.cumsum(bad).tolist()
+		for i, start, end in zip(fast, starts, ends):
+			if badBefore[end] == badBefore[start]:
+				result[i] = aa[start:end]
+
+	for i, s in enumerate(seqs):
+		if result[i] is None:
+			result[i] = str(Seq(s).translate())
+
+	return result
+
+
+def translate(seq):
+	"""translate a single nucleotide sequence (a string or a Seq); returns a string"""
+	return translate_batch([seq])[0]
+
+
+def translate_fasta(infile, outfile, batchSize=BATCH_SIZE):
+	"""
+	translate every sequence in a FASTA file, writing the result in the same
+	   format as SeqIO.write; infile and outfile can be file names or handles.
+	   Returns the number of sequences.
+	"""
+
+	inHandle  = open(infile, "rU") if isinstance(infile, basestring) else infile
+	outHandle = open(outfile, "w") if isinstance(outfile, basestring) else outfile
+
+	count   = 0
+	records = SimpleFastaParser(inHandle)
+	batch   = list(itertools.islice(records, batchSize))
+	while len(batch) > 0:
+		for (title, seq), aa in zip(batch, translate_batch([ seq for title, seq in batch ])):
+			outHandle.write(">%s\n" % title)
+			for start in range(0, len(aa), FASTA_WRAP):
+				outHandle.write(aa[start:start+FASTA_WRAP] + "\n")
+		count += len(batch)
+		batch = list(itertools.islice(records, batchSize))
+
+	if isinstance(infile, basestring):
+		inHandle.close()
+	if isinstance(outfile, basestring):
+		outHandle.close()
+
+	return count
@@ -0,0 +1,156 @@
+#!/usr/bin/env python
+
+"""
+benchmarkMemory.py
+
+This script measures the peak memory (maximum resident set size, from
+      resource.getrusage) of holding four top-hit dicts at once, for V, J, C
+      and D, as 1.3-finalize_assignments.py does for each chunk, built:
+         baseline   by get_top_hits as it was before the columnar reader,
+                       with MyAlignment as it was before __slots__ (both
+                       pasted as they were, the first in benchmarkTopHits.py)
+         slots      by the same get_top_hits, with the current MyAlignment
+                       (the __slots__ change on its own)
+         current    by the current get_top_hits
+      Each is built in a fresh process, since the peak of a process never
+      goes down. Besides the peak, the resident size once all four dicts are
+      built (ie what is left after parsing) is shown, on Linux.
+
+Usage: benchmarkMemory.py [ -hits blast_table.txt -n 50000 -seed 1 ]
+
+    All options are optional, see below for defaults.
+    Invoke with -h or --help to print this documentation.
+
+    hits        BLAST output (tabular, as written by 1.1/1.2) to use for all
+                   four dicts. If omitted, four tables with random hits are
+		   written to temporary files.
+    n           Number of reads in each random table. Default = 50000 (the
+                   size of a 1.1 split file on a cluster).
+    seed        Seed for the first random table (the others use the next
+                   seeds). Default = 1.
+
+Copyright (c) 2011-2017 Columbia University and Vaccine Research Center, National
+                         Institutes of Health, USA. All rights reserved.
+
+"""
+
+import sys, os, gc, resource, tempfile, subprocess
+
+try:
+	from sonar.annotate import *
+except ImportError:
+	find_SONAR = sys.argv[0].split("sonar/utilities")
+	sys.path.append(find_SONAR[0])
+	from sonar.annotate import *
+
+import benchmarkTopHits
+from benchmarkTopHits import baseline_get_top_hits, random_table
+
+
+#MyAlignment as it was before __slots__
+class BaselineMyAlignment:
+	def __init__(self, row):
+		self.qid	= row[0].strip()		# query id
+		self.sid	= row[1].strip()		# subject id
+		self.identity 	= float(row[2])			# % identity
+		self.alignment 	= int(row[3])			# alignment length
+		self.mismatches = int(row[4]) 			# mismatches
+		self.gaps	= int(row[5])			# gap openings
+		self.qstart 	= int(row[6])			# query start
+		self.qend	= int(row[7])			# query end
+		self.sstart 	= int(row[8])			# subject start
+		self.send	= int(row[9]) 			# subject end
+		self.evalue 	= float(row[10])		# e-value
+		self.score	= float(row[11])		# bit score
+		self.strand	= str(row[12])			# strand
+
+		self.qlen	= 0
+		self.slen	= 0
+
+		self.real_id	= 0.0				# recaluclated identity
+		self.divergence	= 0.0				# recalculated diversity
+
+	def set_strand(self, s):
+		self.strand = s					# setting strand
+
+	def set_real_identity(self, identity):
+		self.real_id = identity
+
+	def set_diversity(self, divergence):
+		self.divergence = divergence
+
+
+VARIANTS = [ "baseline", "slots", "current" ]
+
+
+def max_rss():
+	"""peak resident set size of this process so far, in MB (ru_maxrss is in kB on Linux)"""
+	return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def rss():
+	"""current resident set size, in MB (Linux only; None elsewhere)"""
+	try:
+		with open("/proc/self/statm") as handle:
+			return int(handle.read().split()[1]) * resource.getpagesize() / 1048576.0
+	except IOError:
+		return None
+
+
+def build(variant, tables):
+	"""build and hold the four dicts in this process; prints the peak RSS before and after"""
+
+	if variant == "baseline":
+		benchmarkTopHits.MyAlignment = BaselineMyAlignment
+	function = get_top_hits if variant == "current" else baseline_get_top_hits
+
+	#anything loaded on first use is loaded before the starting point
+	load_top_hits(os.devnull)
+	start = max_rss()
+
+	held = [ function(table, dict_germ_count=dict()) for table in tables ]
+	gc.collect()
+	after = rss()
+	print "%.1f\t%.1f\t%s\t%d" % ( start, max_rss(), "%.1f" % after if after is not None else "NA", sum(len(h[0]) for h in held) )
+
+
+def main():
+
+	if hitTable != "":
+		tables = [ hitTable ] * 4
+	else:
+		tables = []
+		for k in range(4):
+			tables.append( tempfile.mkstemp(suffix=".txt")[1] )
+			random_table(tables[-1], numReads, seed + k)
+
+	print "%-9s %12s %12s %12s" % ("variant", "start (MB)", "peak (MB)", "after (MB)")
+	for variant in VARIANTS:
+		out = subprocess.check_output( [ sys.executable, os.path.abspath(__file__), "-variant", variant ] + tables )
+		start, peak, after, reads = out.strip().split("\n")[-1].split("\t")
+		print "%-9s %12s %12s %12s" % ( variant, start, peak, after )
+	print "(%s top hits in the four dicts; 'after' is the resident size once they are built)" % reads
+
+	if hitTable == "":
+		for table in tables:
+			os.remove(table)
+
+
+if __name__ == '__main__':
+
+	#check if I should print documentation
+	q = lambda x: x in sys.argv
+	if any([q(x) for x in ["h", "-h", "--h", "help", "-help", "--help"]]):
+		print __doc__
+		sys.exit(0)
+
+	#internal: build the dicts of one variant from the tables given
+	if q("-variant"):
+		build( sys.argv[2], sys.argv[3:] )
+		sys.exit(0)
+
+	# get parameters from input
+	dict_args = processParas(sys.argv, hits="hitTable", n="numReads", seed="seed")
+	hitTable, numReads, seed = getParasWithDefaults(dict_args, dict(hitTable="", numReads=50000, seed=1), "hitTable", "numReads", "seed")
+
+	main()
@@ -0,0 +1,192 @@
+#!/usr/bin/env python
+
+"""
+benchmarkReader.py
+
+This script times the read splitting loop of 1.1-blast_V.py (read, length
+      filter, collapsing of identical reads and writing of the id table and
+      split FASTA files, here to memory) with the streaming reader in
+      sonar/seqReader.py, which 1.1 now uses, against Bio.SeqIO plus MySeq,
+      as 1.1 read its input before, and checks that both give exactly the
+      same IDs and sequences.
+
+Usage: benchmarkReader.py [ -in reads.fq.gz -n 200000 -len 400 -minl 300 -maxl 600
+                            -fastq -gz -threads 1 -r 3 -seed 1 ]
+
+    All options are optional, see below for defaults.
+    Invoke with -h or --help to print this documentation.
+
+    in          Input reads (FASTA or FASTQ, by extension as in 1.1, plain or
+                   gzip/bgzip compressed). If omitted, random reads are
+		   written to a temporary file.
+    n           Number of reads to use: the first n reads of the input file
+                   (0 = all of them), or the number of random reads to
+		   write. Default = 200000, or all reads of an input file.
+    len         Length of the random reads. Default = 400.
+    minl, maxl  Length filter, as in 1.1. Default = 300 and 600.
+    fastq       Flag to write the random reads as FASTQ instead of FASTA.
+    gz          Flag to gzip the random reads.
+    threads     As in 1.1: if more than 1, compressed input is decompressed
+                   in a background thread. Default = 1.
+    r           Number of times to run each version (the best time is
+                   reported). Default = 3.
+    seed        Seed for the random reads. Default = 1.
+
+Bio.SeqIO cannot read compressed files by itself, so for gzipped input it is
+      given a gzip.open() handle; before seqReader.py, 1.1 only took
+      uncompressed input.
+
+Copyright (c) 2011-2017 Columbia University and Vaccine Research Center, National
+                         Institutes of Health, USA. All rights reserved.
+
+"""
+
+import sys, os, re, csv, gzip, time, random, hashlib, tempfile, itertools
+
+try:
+	from sonar import *
+except ImportError:
+	find_SONAR = sys.argv[0].split("sonar/utilities")
+	sys.path.append(find_SONAR[0])
+	from sonar import *
+
+from sonar.seqReader import is_gzip
+
+
+class BaselineMySeq:
+	"""MySeq as it was before it got __slots__"""
+	def __init__(self, seq_id, seq):
+		self.seq_id 	= seq_id					# sequence ID
+		try:
+			self.seq 	= str(seq)			# sequence in string format
+		except:
+			self.seq	= seq
+		self.seq_len 	= len(self.seq)				# sequence length
+
+
+def baseline_reads(fastas):
+	"""generate_read_fasta_folder as it was before seqReader.py (plus gzip, see above)"""
+
+	for fasta_file in fastas:
+
+		filetype = "fasta"
+		if re.search("\.(fq|fastq)(\.gz)?$", fasta_file) is not None:
+			filetype = "fastq"
+
+		handle = gzip.open(fasta_file, "rb") if is_gzip(fasta_file) else open(fasta_file, "rU")
+		for entry in SeqIO.parse(handle, filetype):
+
+			myseq = BaselineMySeq(entry.id, entry.seq)
+			yield myseq.seq_id, myseq.seq, fasta_file
+
+
+class NullFile:
+	def write(self, text):
+		pass
+
+
+def split_reads(reads):
+	"""the loop of split_reads in 1.1-blast_V.py, writing to nowhere; returns a digest of the reads it saw"""
+
+	id_map, fasta = csv.writer(NullFile(), delimiter=sep), NullFile()
+	digest, seen  = hashlib.md5(), dict()
+	total, total_good, total_unique = 0, 0, 0
+
+	for seq_id, seq, file_name in reads:
+
+		digest.update("%s\t%s\n" % (seq_id, seq))
+		total += 1
+		seq_len = len(seq)
+
+		if not min_len <= seq_len <= max_len:
+			id_map.writerow([ "%08d"%total, file_name, seq_id, seq_len, "NA"])
+			continue
+
+		total_good += 1
+		rep = seen.setdefault( hashlib.md5(seq).digest(), "%08d" % total )
+		id_map.writerow([ "%08d"%total, file_name, seq_id, seq_len, rep])
+
+		if rep == "%08d" % total:
+			total_unique += 1
+			fasta.write(">%08d\n%s\n" % (total, seq))
+
+	return digest.hexdigest(), total, total_good, total_unique
+
+
+def random_reads(path, nreads, length, fastq, gz, seed):
+	"""random reads, 1 in 10 an exact copy of an earlier one and 1 in 20 too short"""
+
+	rnd    = random.Random(seed)
+	handle = gzip.open(path, "wb") if gz else open(path, "w")
+	reads  = []
+	for r in range(nreads):
+		if len(reads) > 0 and rnd.random() < 0.1:
+			seq = rnd.choice(reads)
+		else:
+			seq = "".join( rnd.choice("ACGT") for i in range(length if rnd.random() > 0.05 else length // 4) )
+			if len(reads) < 1000:
+				reads.append(seq)
+		if fastq:
+			handle.write( "@read%d some description\n%s\n+\n%s\n" % (r, seq, "I" * len(seq)) )
+		else:
+			handle.write( ">read%d some description\n%s\n%s\n" % (r, seq[:len(seq)//2], seq[len(seq)//2:]) )
+	handle.close()
+
+
+def main():
+
+	inFile = inputFile
+	if inFile == "":
+		suffix = (".fq" if fastq else ".fa") + (".gz" if gz else "")
+		inFile = tempfile.mkstemp(suffix=suffix)[1]
+		print "Writing %d random reads to %s..." % (numReads, inFile)
+		random_reads(inFile, numReads, readLength, fastq, gz, seed)
+	limit = numReads if (inputFile == "" or "numReads" in dict_args) and numReads > 0 else None
+
+	#SeqIO is only imported on first use, which should not be timed
+	SeqIO.parse
+
+	best, results = dict(), dict()
+	for name, reads in [ ("SeqIO + MySeq", lambda: baseline_reads([inFile])),
+			     ("seqReader", lambda: generate_reads_folder([inFile], background=numThreads>1)) ]:
+		for rep in range(repeats):
+			start = time.time()
+			results[name] = split_reads( itertools.islice(reads(), limit) )
+			elapsed = time.time() - start
+			best[name] = min( best.get(name, elapsed), elapsed )
+		print "%-14s %.3f s" % (name + ":", best[name])
+
+	if inputFile == "":
+		os.remove(inFile)
+
+	print "Speedup: %.1fx" % ( best["SeqIO + MySeq"] / max(best["seqReader"], 1e-9) )
+	if results["SeqIO + MySeq"] != results["seqReader"]:
+		sys.exit("The two versions read different IDs or sequences!")
+	print "Both versions read the same %d reads (%d of the right length, %d unique)." % results["seqReader"][1:]
+
+
+if __name__ == '__main__':
+
+	#check if I should print documentation
+	q = lambda x: x in sys.argv
+	if any([q(x) for x in ["h", "-h", "--h", "help", "-help", "--help"]]):
+		print __doc__
+		sys.exit(0)
+
+	fastq = False
+	if q("-fastq"):
+		sys.argv.remove("-fastq")
+		fastq = True
+
+	gz = False
+	if q("-gz"):
+		sys.argv.remove("-gz")
+		gz = True
+
+	# get parameters from input
+	dict_args = processParas(sys.argv, n="numReads", len="readLength", minl="min_len", maxl="max_len", threads="numThreads", r="repeats", seed="seed", **{"in":"inputFile"})
+	inputFile, numReads, readLength, min_len, max_len, numThreads, repeats, seed = \
+		getParasWithDefaults(dict_args, dict(inputFile="", numReads=200000, readLength=400, min_len=300, max_len=600, numThreads=1, repeats=3, seed=1),
+				     "inputFile", "numReads", "readLength", "min_len", "max_len", "numThreads", "repeats", "seed")
+
+	main()
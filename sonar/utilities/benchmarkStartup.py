@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+
+"""
+benchmarkStartup.py
+
+This script times how long every SONAR Python script takes to start, by
+      running 'script -h' (which prints the documentation and exits, so
+      that the time is nearly all imports and setup) in a fresh interpreter
+      several times. With -rev, the same scripts from an earlier git
+      revision (eg the commit before the lazy imports in sonar/lazyImport.py)
+      are timed alongside, so that a change that slows down startup again
+      shows up as a regression.
+
+Usage: benchmarkStartup.py [ -r 5 -rev HEAD~1 -match utilities -python python ]
+
+    All options are optional, see below for defaults.
+    Invoke with -h or --help to print this documentation.
+
+    r           Number of times to start each script (the median time is
+                   reported). Default = 5.
+    rev         A git revision to compare against. Its sonar folder is
+                   exported with 'git archive' to a temporary folder (with
+                   the paths.py of this installation) and timed the same way.
+                   Default: only time this installation.
+    match       Regular expression to time only the scripts whose path
+                   (eg annotate/1.1-blast_V.py) matches it. Default: all.
+    python      Python interpreter to start the scripts with.
+                   Default = the one running this script.
+
+Scripts are every executable .py file in the subfolders of sonar/ (except
+      the __init__.py files). A script that does not exit cleanly with -h,
+      eg because one of its dependencies is not installed, is reported as
+      failed, with the last line it printed to stderr, instead of a time.
+      The time it takes the interpreter just to start is shown first, as
+      the floor that no script can go below.
+
+Copyright (c) 2011-2017 Columbia University and Vaccine Research Center, National
+                         Institutes of Health, USA. All rights reserved.
+
+"""
+
+import sys, os, re, time, glob, shutil, tempfile, subprocess
+
+try:
+	from sonar import *
+except ImportError:
+	find_SONAR = sys.argv[0].split("sonar/utilities")
+	sys.path.append(find_SONAR[0])
+	from sonar import *
+
+
+FOLDERS = [ "annotate", "lineage", "phylogeny", "plotting", "mGSSP", "utilities" ]
+
+
+def entry_points(sonar_folder):
+	"""paths (relative to sonar_folder) of every script that can be run directly"""
+	scripts = []
+	for folder in FOLDERS:
+		for path in sorted(glob.glob("%s/%s/*.py" % (sonar_folder, folder))):
+			if os.path.basename(path) != "__init__.py" and os.access(path, os.X_OK):
+				scripts.append( os.path.relpath(path, sonar_folder) )
+	return scripts
+
+
+def time_command(command, top_folder):
+	"""median wall time of the command over all repeats, or None and the error if it fails"""
+	env = dict(os.environ, PYTHONPATH=top_folder)
+	times = []
+	for rep in range(repeats):
+		start = time.time()
+		p = subprocess.Popen(command, cwd=tempfile.gettempdir(), env=env, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+		out, err = p.communicate()
+		times.append( time.time() - start )
+		if p.returncode != 0:
+			lines = err.strip().split("\n")
+			return None, lines[-1] if lines[0] != "" else "exit code %d" % p.returncode
+	return sorted(times)[ len(times) // 2 ], ""
+
+
+def export_revision(rev):
+	"""the sonar folder of a git revision, in a temporary folder; returns the top folder"""
+	top = tempfile.mkdtemp()
+	repo = os.path.dirname(SCRIPT_FOLDER)
+	archive = subprocess.Popen( [ "git", "-C", repo, "archive", rev, "sonar" ], stdout=subprocess.PIPE )
+	if subprocess.call( [ "tar", "-x", "-C", top ], stdin=archive.stdout ) != 0 or archive.wait() != 0:
+		shutil.rmtree(top)
+		sys.exit("Could not export revision %s from %s" % (rev, repo))
+	shutil.copy( "%s/paths.py" % SCRIPT_FOLDER, "%s/sonar/paths.py" % top )
+	return top
+
+
+def cell(result):
+	if result is None:
+		return "       -"
+	return "%8.3f" % result[0] if result[0] is not None else "  failed"
+
+
+def main():
+
+	trees = [ ("current", os.path.dirname(SCRIPT_FOLDER)) ]
+	if rev != "":
+		trees.append( (rev, export_revision(rev)) )
+
+	scripts = [ s for s in entry_points(SCRIPT_FOLDER) if re.search(match, s) ]
+	width   = max( [ len(s) for s in scripts ] + [ 20 ] )
+
+	print "%-*s  %s" % ( width, "script", "  ".join("%8s" % name[:8] for name, top in trees) )
+	floor = [ time_command([ python, "-c", "pass" ], top) for name, top in trees ]
+	print "%-*s  %s" % ( width, "(python -c pass)", "  ".join(cell(f) for f in floor) )
+
+	errors = []
+	for script in scripts:
+		results = []
+		for name, top in trees:
+			#scripts added since the revision are left blank
+			if not os.path.isfile("%s/sonar/%s" % (top, script)):
+				results.append(None)
+			else:
+				results.append( time_command([ python, "%s/sonar/%s" % (top, script), "-h" ], top) )
+		line = "%-*s  %s" % ( width, script, "  ".join(cell(r) for r in results) )
+		if len(trees) > 1 and None not in results and results[0][0] is not None and results[1][0] is not None:
+			line += "  %5.1fx" % ( results[1][0] / max(results[0][0], 1e-9) )
+		print line
+		errors += [ "%s (%s): %s" % (script, name, r[1]) for (name, top), r in zip(trees, results) if r is not None and r[0] is None ]
+
+	if len(errors) > 0:
+		print "\nFailed to start:\n   " + "\n   ".join(errors)
+
+	if rev != "":
+		shutil.rmtree(trees[1][1])
+
+
+if __name__ == '__main__':
+
+	#check if I should print documentation
+	q = lambda x: x in sys.argv
+	if any([q(x) for x in ["h", "-h", "--h", "help", "-help", "--help"]]):
+		print __doc__
+		sys.exit(0)
+
+	# get parameters from input
+	dict_args = processParas(sys.argv, r="repeats", rev="rev", match="match", python="python")
+	repeats, rev, match, python = getParasWithDefaults(dict_args, dict(repeats=5, rev="", match="", python=sys.executable),
+							  "repeats", "rev", "match", "python")
+
+	main()
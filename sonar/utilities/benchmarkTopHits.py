@@ -0,0 +1,243 @@
+#!/usr/bin/env python
+
+"""
+benchmarkTopHits.py
+
+This script times get_top_hits (in sonar/annotate/__init__.py), which now
+      reads a BLAST table into columns (see sonar/annotate/topHits.py),
+      against the row-by-row version it replaced (pasted below as it was),
+      and checks that both give exactly the same top hits, alternate genes,
+      gene counts and rows for the top hit table.
+
+The hit tables that 1.2 and 1.3 read are one per split file of 1.1, so their
+      size is set by -npf there: 10,000 reads by default when running
+      locally and 50,000 on a cluster. The columnar reader has fixed costs
+      (NumPy is imported the first time it is used in a process, and each
+      table is sorted with NumPy calls), so it pays off less on small tables,
+      and on a table of only a few reads it is slower; by default, random
+      tables of several sizes around the chunk sizes of 1.1 are timed.
+
+Usage: benchmarkTopHits.py [ -hits blast_table.txt -n 1000 -n 10000 -n 50000 -r 3 -seed 1 ]
+
+    All options are optional, see below for defaults.
+    Invoke with -h or --help to print this documentation.
+
+    hits        BLAST output (tabular, as written by 1.1/1.2) to use, eg
+                   work/annotate/vgene/<project>_001.txt. If omitted, a table
+                   with random hits is written to a temporary file.
+    n           Number of reads in the random table; may be given several
+                   times. Default = 1000, 10000 and 50000.
+    r           Number of times to run each version (the best time is
+                   reported). Default = 3.
+    seed        Seed for the random table. Default = 1.
+
+Copyright (c) 2011-2017 Columbia University and Vaccine Research Center, National
+                         Institutes of Health, USA. All rights reserved.
+
+"""
+
+import sys, time, random, tempfile
+from cStringIO import StringIO
+
+try:
+	from sonar.annotate import *
+except ImportError:
+	find_SONAR = sys.argv[0].split("sonar/utilities")
+	sys.path.append(find_SONAR[0])
+	from sonar.annotate import *
+
+
+#get_top_hits as it was before the columnar reader (only renamed)
+def baseline_get_top_hits(infile, topHitWriter=None, dict_germ_count=dict(), maxQEnd=dict(), minQStart=dict()):
+	"""retrieve top hits from all result files"""
+	
+	dict_germ_aln    =  dict()
+	dict_other_germs =  dict()
+	old_id           =  ""
+
+
+	reader = csv.reader(open(infile, "rU"), delimiter = sep)
+	for row in reader:
+
+		if len(row) != 13:
+			pass;
+
+		else:
+                        my_alignment = MyAlignment(row)
+
+                        if my_alignment.qid != old_id:
+                                if old_id != "":
+					aline = best_row
+                                        if len(others)>0:
+                                                aline.append(",".join(others))
+                                                dict_other_germs[best_alignment.qid] = others
+
+                                        if topHitWriter is not None:
+                                                topHitWriter.writerow(aline)
+                                                if len(second_match)>0:
+                                                        topHitWriter.writerow(second_match)
+
+                                        dict_germ_aln[best_alignment.qid] = best_alignment
+
+                                        if best_alignment.sid not in dict_germ_count:
+                                                dict_germ_count[best_alignment.sid] 	= 0
+                                        dict_germ_count[best_alignment.sid] 		+= 1
+
+						
+                                #skips D genes that matched 5' J
+                                if my_alignment.qend > maxQEnd.get(my_alignment.qid, 99999):
+                                        old_id=""
+                                        continue
+
+                                #skips C genes that matched 3' J (not sure if necessary)
+                                if my_alignment.qstart < minQStart.get(my_alignment.qid, -1):
+                                        old_id=""
+                                        continue
+
+				old_id = my_alignment.qid
+				best_alignment = my_alignment
+				best_row = row
+				others = []
+				second_match = []
+				
+			else:
+				#added 20150107 by CAS
+				'''
+				need three conditions:
+				1. hit is on same gene
+				2. hit is on same strand
+				3. hits are non-overlapping
+				'''
+				if my_alignment.sid == best_alignment.sid and my_alignment.strand == best_alignment.strand and (max(my_alignment.sstart, my_alignment.send)<min(best_alignment.sstart,best_alignment.send) or min(my_alignment.sstart, my_alignment.send)>max(best_alignment.sstart,best_alignment.send)):
+					second_match = row
+					#change boundaries of alignment on both query and hit (to get J properly)
+					if my_alignment.send < best_alignment.sstart:
+						best_alignment.sstart = my_alignment.sstart
+						if best_alignment.strand == "plus":
+							best_alignment.qstart = my_alignment.qstart
+						else:
+							best_alignment.qend = my_alignment.qend
+					else:
+						best_alignment.send = my_alignment.send
+						if best_alignment.strand == "plus":
+							best_alignment.qend = my_alignment.qend
+						else:
+							best_alignment.qstart = my_alignment.qstart
+
+						
+				elif my_alignment.score >= best_alignment.score - 3 and my_alignment.sid.split("*")[0] != best_alignment.sid.split("*")[0] and not any( my_alignment.sid.split("*")[0] == x.split("*")[0] for x in others ):
+					others.append(my_alignment.sid)
+
+        #last line, repeat of what's in the loop
+        if old_id != "":
+                aline = best_row
+                if len(others)>0:
+                        aline.append(",".join(others))
+                        dict_other_germs[best_alignment.qid] = others
+
+                if topHitWriter is not None:
+                        topHitWriter.writerow(aline)
+                        if len(second_match)>0:
+                                topHitWriter.writerow(second_match)
+
+                dict_germ_aln[best_alignment.qid] = best_alignment
+
+                if best_alignment.sid not in dict_germ_count:
+                        dict_germ_count[best_alignment.sid] 	= 0
+                dict_germ_count[best_alignment.sid] 		+= 1
+
+
+        #warns user if blast crashed for some reason
+	if len(dict_germ_aln) == 0:
+		print("%s appears to be empty..."%infile)
+
+
+	return dict_germ_aln, dict_other_germs, dict_germ_count
+
+
+def random_table(path, nreads, seed):
+	"""BLAST-like table with up to 10 hits per read, in decreasing order of score, some of them split hits to the same gene"""
+
+	rnd   = random.Random(seed)
+	genes = [ "IGHV%d-%d*0%d" % (a, b, c) for a in range(1, 8) for b in range(1, 6) for c in range(1, 3) ]
+	with open(path, "w") as handle:
+		for r in range(nreads):
+			score, previous, used = rnd.uniform(50, 500), None, set()
+			for h in range(rnd.randint(1, 10)):
+				if previous is not None and rnd.random() < 0.05:
+					sid, strand = previous
+				else:
+					sid    = rnd.choice([ g for g in genes if g not in used ])
+					strand = rnd.choice([ "plus", "minus" ])
+					used.add(sid)
+				previous = (sid, strand)
+				qs, ss   = rnd.randint(1, 100), rnd.randint(1, 200)
+				qe, se   = qs + rnd.randint(20, 300), ss + rnd.randint(-50, 100)
+				handle.write( "\t".join(map(str, [ "%08d" % r, sid, "%.3f" % rnd.uniform(80, 100), qe - qs, 1, 0,
+								  qs, qe, ss, se, "1e-10", "%.1f" % score, strand ])) + "\n" )
+				score -= rnd.choice([ 0, 0.5, 1, 2, 2.5, 3, 3.5, 5, 10 ])
+
+
+def run(function, hitFile):
+	"""time one call; returns the time and everything it produced"""
+	output = StringIO()
+	start  = time.time()
+	alignments, others, counts = function( hitFile, topHitWriter=csv.writer(output, delimiter=sep), dict_germ_count=dict() )
+	elapsed = time.time() - start
+	return elapsed, ( dict( (k, a.__getstate__()) for k, a in alignments.items() ), others, counts, output.getvalue() )
+
+
+def compare(hitFile):
+	"""best time of each version on one table; exits if they don't agree"""
+
+	best, results = dict(), dict()
+	for name, function in [ ("baseline", baseline_get_top_hits), ("columnar", get_top_hits) ]:
+		for rep in range(repeats):
+			elapsed, results[name] = run(function, hitFile)
+			best[name] = min( best.get(name, elapsed), elapsed )
+
+	if results["baseline"] != results["columnar"]:
+		sys.exit("The two versions gave different results for %s!" % hitFile)
+	return len(results["columnar"][0]), best["baseline"], best["columnar"]
+
+
+def main():
+
+	#NumPy is only imported on first use, once per process; that is reported on its own
+	start = time.time()
+	load_top_hits( os.devnull )
+	print "First use of the columnar reader (imports NumPy): %.3f s" % (time.time() - start)
+
+	print "%10s %12s %12s %8s" % ("reads", "baseline", "columnar", "speedup")
+
+	if hitTable != "":
+		tables = [ hitTable ]
+	else:
+		tables = []
+		for n in numReads if isinstance(numReads, list) else [numReads]:
+			tables.append( tempfile.mkstemp(suffix=".txt")[1] )
+			random_table(tables[-1], n, seed)
+
+	for hitFile in tables:
+		reads, baseline, columnar = compare(hitFile)
+		print "%10d %10.3f s %10.3f s %7.2fx" % ( reads, baseline, columnar, baseline / max(columnar, 1e-9) )
+		if hitTable == "":
+			os.remove(hitFile)
+
+	print "Both versions gave the same results for every table."
+
+
+if __name__ == '__main__':
+
+	#check if I should print documentation
+	q = lambda x: x in sys.argv
+	if any([q(x) for x in ["h", "-h", "--h", "help", "-help", "--help"]]):
+		print __doc__
+		sys.exit(0)
+
+	# get parameters from input
+	dict_args = processParas(sys.argv, hits="hitTable", n="numReads", r="repeats", seed="seed")
+	hitTable, numReads, repeats, seed = getParasWithDefaults(dict_args, dict(hitTable="", numReads=[1000, 10000, 50000], repeats=3, seed=1),
+								 "hitTable", "numReads", "repeats", "seed")
+
+	main()
@@ -12,6 +12,10 @@ This script monitors the SGE array jobs submitted by scripts 1.1 and 1.2 of the
 
 Intended for internal use within SONAR only...
 
+No longer used by 1.1 and 1.2, which now submit and watch their cluster jobs
+      through sonar/scheduler.py; kept for monitor jobs set up by older
+      versions.
+
 Usage: checkClusterBlast.py -gene <v|j|d|c> -big 100 -check check.sh
                             [ -after "next_step.py -args ..." -rehold otherJID]
 
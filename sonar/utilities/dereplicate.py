@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+
+"""
+dereplicate.py
+
+This script collapses identical sequences in one or more FASTA/FASTQ files
+      (plain or gzipped), in place of "usearch -derep_fulllength". Input is
+      spilled to disk in partitions, so there is no limit on its size, and
+      the partitions are dereplicated in parallel. See sonar/derep.py for
+      details of the output.
+
+Usage: dereplicate.py -f reads.fa -o unique.fa [ -f more.fa -uc clusters.uc
+                                                 -minsize 2 -t 4 -mem 2048
+                                                 -sizein -nosize ]
+
+    Invoke with -h or --help to print this documentation.
+
+    f           Sequence file to dereplicate. May be given more than once,
+                   in which case all files are dereplicated together.
+    o           Fasta file in which to save unique sequences, sorted by
+                   decreasing abundance.
+    uc          File in which to save the mapping of reads to unique
+                   sequences, in usearch's .uc format. Optional.
+    minsize     Only save unique sequences with at least this many copies.
+                   Default: 0 (save all).
+    t           Number of worker processes. Default: 1.
+    mem         Approximate memory budget in MB (for all workers together).
+                   Default: 2048.
+    sizein      Flag to take the number of copies of each read from
+                   ";size=N;" annotations in the input (eg to combine
+                   the output of several earlier runs).
+    nosize      Flag to leave ";size=N;" annotations off the output.
+
+Copyright (c) 2011-2017 Columbia University and Vaccine Research Center, National
+                         Institutes of Health, USA. All rights reserved.
+
+"""
+
+import sys, time
+try:
+	from sonar import *
+except ImportError:
+	find_SONAR = sys.argv[0].split("sonar/utilities")
+	sys.path.append(find_SONAR[0])
+	from sonar import *
+
+
+
+def main():
+
+	start = time.time()
+	reads, unique = dereplicate( inFiles, outFile, ucFile=ucFile, sizeIn=sizeIn, sizeOut=sizeOut, minSize=minSize, threads=threads, memMB=mem )
+	print "Collapsed %d reads into %d unique sequences in %.1f seconds." % (reads, unique, time.time() - start)
+
+
+if __name__ == '__main__':
+
+	#check if I should print documentation
+	q = lambda x: x in sys.argv
+	if any([q(x) for x in ["h", "-h", "--h", "help", "-help", "--help"]]):
+		print __doc__
+		sys.exit(0)
+
+	#log command line
+	logCmdLine(sys.argv)
+
+	sizeIn = False
+	if q("-sizein"):
+		sys.argv.remove("-sizein")
+		sizeIn = True
+
+	sizeOut = True
+	if q("-nosize"):
+		sys.argv.remove("-nosize")
+		sizeOut = False
+
+	# get parameters from input
+	dict_args = processParas(sys.argv, f="inFiles", o="outFile", uc="ucFile", minsize="minSize", t="threads", mem="mem")
+	inFiles, outFile, ucFile, minSize, threads, mem = getParasWithDefaults(dict_args, dict(ucFile=None, minSize=0, threads=1, mem=2048), "inFiles", "outFile", "ucFile", "minSize", "threads", "mem")
+
+	if not isinstance(inFiles, list):
+		inFiles = [ inFiles ]
+	for f in inFiles:
+		if not os.path.isfile(str(f)):
+			sys.exit("Cannot find input file %s" % f)
+	if outFile is None:
+		sys.exit("Please specify an output file with -o")
+
+	main()
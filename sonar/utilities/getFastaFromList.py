@@ -4,7 +4,9 @@
 getFastaFromList.py
 
 This is a simple utility script for efficiently extracting a subset of
-      sequences from a large fasta file.
+      sequences from a large fasta file. An offset index of the fasta file is
+      saved alongside it (in <file>.sfi/) so that repeated extractions from the
+      same file can skip straight to the requested sequences.
 
 Usage: getFastaFromList.py -f seqs.fa [ -o output.fa -l list.txt ]
 
@@ -35,16 +37,14 @@ except ImportError:
 
 def loadAndAnnotate(seqFile, saveDict):
 	good = 0
-	with open(seqFile, "rU") as seqs:
-		for s in SeqIO.parse(seqs, "fasta"):
-			if s.id not in saveDict:
-				continue
-			else:
-				good += 1
-				s.description = s.description + " " + saveDict.get(s.id, "")
-				yield s
-				if good % 100000 == 0:
-					print "Loaded %d so far..." % good
+	index = FastaIndex(seqFile)
+	for s in index.fetch_many(saveDict):
+		good += 1
+		s.description = s.description + " " + saveDict.get(s.id, "")
+		yield s
+		if good % 100000 == 0:
+			print "Loaded %d so far..." % good
+	index.close()
 
 def main():
 
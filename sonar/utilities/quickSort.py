@@ -19,7 +19,6 @@ Copyright (c) 2011-2017 Columbia University and Vaccine Research Center, Nationa
 '''
 
 import sys
-from Bio import SeqIO
 
 try:
 	from sonar import *
@@ -19,7 +19,6 @@ Copyright (c) 2011-2017 Columbia University and Vaccine Research Center, Nationa
 '''
 
 import sys
-from Bio import SeqIO
 
 try:
 	from sonar import *
@@ -30,16 +29,8 @@ except ImportError:
 
 
 
-def loadAndTranslate():
-    with open( sys.argv[1], "rU" ) as inFile:
-        for seq in SeqIO.parse(inFile, "fasta"):
-            seq.seq = seq.seq.translate()
-            yield seq
-
-
 def main():
-    with open( sys.argv[2], "w" ) as output:
-        SeqIO.write( loadAndTranslate(), output, "fasta" )
+    translate_fasta( sys.argv[1], sys.argv[2] )
 
         
 if __name__ == "__main__":
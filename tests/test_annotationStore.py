@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+
+"""
+test_annotationStore.py
+
+Checks that the columnar store written by 1.3-finalize_assignments.py (see
+      sonar/annotationStore.py) gives back the rows of _all_seq_stats.txt as
+      they were written, in particular the CDR3 lengths, which are NA for
+      reads without a CDR3 but can also be really negative when its borders
+      come out short (cdr3_nt_len is the length minus 6, cdr3_aa_len the
+      length in codons minus 2).
+
+Run from the top folder with: python -m unittest discover -s tests
+
+Copyright (c) 2011-2017 Columbia University and Vaccine Research Center, National
+                         Institutes of Health, USA. All rights reserved.
+
+"""
+
+import os, sys, shutil, tempfile, unittest
+
+sys.path.insert( 0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..") )
+
+from sonar.annotationStore import AnnotationStore, AnnotationStoreWriter, COLUMNS, INT_NA
+
+
+#id, source_file, source_id, raw_len, trim_len, V_genes, D_genes, J_genes, Ig_class, indels, stop_codons, status, blast_div, cdr3_nt_len, cdr3_aa_len, cdr3_aa_seq
+ROWS = [ [ "00000001", "reads.fa", "r1", 420, 380, "IGHV1-2*02", "IGHD3-3*01", "IGHJ4*02", "IgG", "F", "F", "good", "12.3%", 45, 15, "ARDGYCSSTSCYFDY" ],
+	 [ "00000002", "reads.fa", "r2", 410, 376, "IGHV1-2*02,IGHV1-3*01", "NA", "IGHJ6*02", "NA", "T", "F", "indel", "8.0%", -6, -2, "" ],
+	 [ "00000003", "reads.fa", "r3", 400, 370, "IGHV3-23*01", "NA", "IGHJ4*02", "IgM", "F", "T", "stop", "NA", -3, -1, "" ],
+	 [ "00000004", "reads.fa", "r4", 300, "NA", "IGHV3-23*01", "NA", "NA", "NA", "NA", "NA", "noJ", "NA", "NA", "NA", "NA" ],
+	 [ "00000005", "other.fa", "r5", 430, 385, "IGHV1-2*02", "IGHD2-2*01", "IGHJ4*02", "IgA", "F", "F", "good", "0.0%", 0, 0, "" ] ]
+
+
+def expected_value(value):
+	"""what the store should give back for a value written to _all_seq_stats.txt"""
+	if value == "NA":
+		return None
+	elif isinstance(value, str) and value.endswith("%"):
+		return float(value[:-1])
+	return value
+
+
+class TestAnnotationStore(unittest.TestCase):
+
+	def setUp(self):
+		self.folder = tempfile.mkdtemp()
+		writer = AnnotationStoreWriter("%s/test_annotations" % self.folder)
+		for row in ROWS:
+			writer.writerow(row)
+		writer.close()
+		self.store = AnnotationStore("%s/test_annotations" % self.folder)
+
+	def tearDown(self):
+		shutil.rmtree(self.folder)
+
+	def test_round_trip(self):
+		self.assertEqual(len(self.store), len(ROWS))
+		for i, row in enumerate(ROWS):
+			found = self.store.row(i)
+			for (name, kind), value in zip(COLUMNS, row):
+				if kind in ["int", "float"]:
+					self.assertEqual( found[name], expected_value(value), (i, name) )
+				else:
+					self.assertEqual( found[name], str(value), (i, name) )
+
+	def test_negative_lengths_are_not_na(self):
+		self.assertEqual( [ self.store.value("cdr3_aa_len", i) for i in range(len(ROWS)) ], [ 15, -2, -1, None, 0 ] )
+		self.assertEqual( [ self.store.value("cdr3_nt_len", i) for i in range(len(ROWS)) ], [ 45, -6, -3, None, 0 ] )
+		self.assertEqual( int(self.store.column("cdr3_aa_len")[3]), INT_NA )
+
+	def test_select_lengths(self):
+		self.assertEqual( list(self.store.select(cdr3_aa_len=(-5, -1))), [ 1, 2 ] )
+		self.assertEqual( list(self.store.select(cdr3_aa_len=-2)), [ 1 ] )
+		self.assertEqual( list(self.store.select(cdr3_aa_len=(-100, 100))), [ 0, 1, 2, 4 ] )
+		self.assertEqual( list(self.store.select(V="IGHV1-2", cdr3_aa_len=(0, 20))), [ 0, 4 ] )
+
+	def test_find(self):
+		self.assertEqual( self.store.find("00000003"), 2 )
+		self.assertEqual( self.store.find("00000009"), -1 )
+
+
+if __name__ == '__main__':
+	unittest.main()
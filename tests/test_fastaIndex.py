@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+
+"""
+test_fastaIndex.py
+
+Checks that sonar/fastaIndex.py gives the same records as SeqIO, both for
+      reads annotated by 1.3-finalize_assignments.py (with V_gene= tags in
+      their titles) and for a custom FASTA file without them, as can be given
+      to 2.3-intradonor_analysis.py with -i.
+
+Run from the top folder with: python -m unittest discover -s tests
+
+Copyright (c) 2011-2017 Columbia University and Vaccine Research Center, National
+                         Institutes of Health, USA. All rights reserved.
+
+"""
+
+import os, re, sys, shutil, tempfile, unittest
+
+sys.path.insert( 0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..") )
+
+import numpy
+from Bio import SeqIO
+
+from sonar import load_fastas_with_Vgene
+from sonar.fastaIndex import FastaIndex
+
+
+SONAR_READS = """>00000001 V_gene=IGHV5-51*01 J_gene=IGHJ4*02 status=good
+ACGTACGTACGT
+ACGT
+>00000002 V_gene=IGHV1-2*02,IGHV1-3*01 J_gene=IGHJ6*02 status=good
+TTTTGGGGCCCC
+>00000003 V_gene=IGHV5-51*03 status=noJ
+GGGGAAAA
+>00000004 V_gene=NA status=noV
+CCCC
+"""
+
+CUSTOM_READS = """>read1 IGHV5-51*01 from another pipeline
+ACGTACGT
+>read2 IGHV3-23*01
+GGGGTTTT
+>read3
+AAAACCCC
+>read4 | IGHV5-51*03 | IGHJ4*02
+ACACACAC
+"""
+
+
+class TestFastaIndex(unittest.TestCase):
+
+	def setUp(self):
+		self.folder = tempfile.mkdtemp()
+
+	def tearDown(self):
+		shutil.rmtree(self.folder)
+
+	def write(self, name, text):
+		path = os.path.join(self.folder, name)
+		with open(path, "w") as handle:
+			handle.write(text)
+		return path
+
+	def check_vgene(self, path, pattern):
+		"""with_vgene gives the same records as searching every title, as load_fastas_with_Vgene once did"""
+		expected = [ r for r in SeqIO.parse(open(path, "rU"), "fasta") if re.search(pattern, r.description) ]
+		for save in [ True, True, False ]:	#build and save, load the saved index, build in memory
+			index = FastaIndex(path, save=save)
+			found = index.with_vgene(pattern)
+			index.close()
+			self.assertEqual( [ (r.id, r.description, str(r.seq)) for r in found ],
+					  [ (r.id, r.description, str(r.seq)) for r in expected ], pattern )
+		return [ r.id for r in found ]
+
+	def test_tagged_titles(self):
+		path = self.write("reads.fa", SONAR_READS)
+		self.assertEqual( self.check_vgene(path, "IGHV5-51"), [ "00000001", "00000003" ] )
+		self.assertEqual( self.check_vgene(path, "IGHV1-3"), [ "00000002" ] )
+		self.assertEqual( self.check_vgene(path, "IGHV7"), [] )
+
+	def test_custom_titles(self):
+		path = self.write("custom.fa", CUSTOM_READS)
+		self.assertEqual( self.check_vgene(path, "IGHV5-51"), [ "read1", "read4" ] )
+		self.assertEqual( self.check_vgene(path, "IGHV3-23"), [ "read2" ] )
+		self.assertEqual( sorted(load_fastas_with_Vgene(path, "IGHV5-51")), [ "read1", "read4" ] )
+
+	def test_fetch(self):
+		path  = self.write("reads.fa", SONAR_READS)
+		index = FastaIndex(path)
+		self.assertEqual( [ r.id for r in index.fetch_many(["00000004", "00000002", "missing"]) ], [ "00000002", "00000004" ] )
+		self.assertEqual( str(index.fetch("00000001").seq), "ACGTACGTACGTACGT" )
+		self.assertFalse( "missing" in index )
+		index.close()
+
+	def test_saved_index(self):
+		path = self.write("reads.fa", SONAR_READS)
+		FastaIndex(path).close()
+		self.assertEqual( sorted( f for f in os.listdir(path + ".sfi") if f.endswith(".tmp") ), [] )
+		self.assertTrue( os.path.isfile(path + ".sfi/meta.json") )
+		index = FastaIndex(path, save=False)
+		self.assertTrue( isinstance(index.offsets, numpy.memmap) )
+		index.close()
+
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+
+"""
+test_idDiv.py
+
+Checks that 2.1-calculate_id-div.py (and the engine in sonar/lineage/idDiv.py)
+      gives the same results as 2.1-calculate_id-div.pl, using the fixtures
+      in tests/data/idDiv/:
+         reads.fa, germline.fa,    30 reads from two related germline V genes,
+         natives.fa                   some with X's or N's, one assigned to a
+                                      gene that isn't in germline.fa and one
+                                      with no V gene at all
+         reads_id-div.tab,         written by 2.1-calculate_id-div.pl -t 1
+         reads_coverage.tab           -ap muscle for those files (identical
+                                      with -ignoregap 0 and 1, as the DNA
+                                      alignments have no gaps inside them)
+         alignments.tab            gapped protein alignments, most with X's,
+                                      followed by the identity (-ignoregap 0,
+                                      then 1) and coverage that the identity
+                                      and coverage subroutines of the Perl
+                                      script give for them
+
+Run from the top folder with: python -m unittest discover -s tests
+
+Copyright (c) 2011-2017 Columbia University and Vaccine Research Center, National
+                         Institutes of Health, USA. All rights reserved.
+
+"""
+
+import os, sys, shutil, tempfile, subprocess, unittest
+
+sys.path.insert( 0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..") )
+
+from sonar.align import GlobalHit
+from sonar.lineage import idDiv
+
+
+DATA   = os.path.join( os.path.dirname(os.path.abspath(__file__)), "data", "idDiv" )
+SCRIPT = os.path.join( os.path.dirname(os.path.abspath(__file__)), "..", "sonar", "lineage", "2.1-calculate_id-div.py" )
+
+
+def read_table(path):
+	"""header and dict ID -> row of a tab-delimited table"""
+	with open(path) as handle:
+		header = handle.readline().rstrip("\n")
+		return header, dict( (line.split("\t", 1)[0], line.rstrip("\n")) for line in handle )
+
+
+def hit_from_alignment(a, b):
+	"""the GlobalHit for a pairwise alignment given as two gapped strings"""
+
+	both = [ i for i in range(len(a)) if a[i] != "-" and b[i] != "-" ]
+	blocks, gaps, s, q = [], 0, 0, 0
+	for i in range(len(a)):
+		if a[i] != "-" and b[i] != "-":
+			if len(blocks) > 0 and blocks[-1][0] + blocks[-1][2] == s and blocks[-1][1] + blocks[-1][2] == q:
+				blocks[-1][2] += 1
+			else:
+				blocks.append( [s, q, 1] )
+		elif both[0] < i < both[-1]:
+			gaps += 1
+		s += a[i] != "-"
+		q += b[i] != "-"
+
+	first, last = blocks[0], blocks[-1]
+	return GlobalHit( 0, first[1], last[1] + last[2] - 1, first[0], last[0] + last[2] - 1, [ tuple(x) for x in blocks ], gaps )
+
+
+class TestIdDivTables(unittest.TestCase):
+
+	def setUp(self):
+		self.folder = tempfile.mkdtemp()
+
+	def tearDown(self):
+		shutil.rmtree(self.folder)
+
+	def run_script(self, *options):
+		with open(os.devnull, "w") as null:
+			subprocess.check_call( [ sys.executable, SCRIPT, "-f", os.path.join(DATA, "reads.fa"), "-g", os.path.join(DATA, "germline.fa"),
+						 "-a", os.path.join(DATA, "natives.fa") ] + list(options), cwd=self.folder, stdout=null, stderr=null )
+
+	def check_tables(self):
+		for table in [ "reads_id-div.tab", "reads_coverage.tab" ]:
+			expected = read_table( os.path.join(DATA, table) )
+			found    = read_table( os.path.join(self.folder, table) )
+			self.assertEqual(found[0], expected[0])
+			self.assertEqual(sorted(found[1]), sorted(expected[1]))
+			for read_id in expected[1]:
+				self.assertEqual(found[1][read_id], expected[1][read_id])
+
+	def test_same_as_perl(self):
+		self.run_script("-t", "1")
+		self.check_tables()
+
+	def test_same_as_perl_in_batches(self):
+		self.run_script("-t", "2", "-npt", "7")
+		self.check_tables()
+
+	def test_same_as_perl_ignoring_gaps(self):
+		self.run_script("-t", "1", "-ignoregap", "1")
+		self.check_tables()
+
+
+class TestIdDivScores(unittest.TestCase):
+
+	def test_gapped_alignments(self):
+		with open( os.path.join(DATA, "alignments.tab") ) as handle:
+			for line in handle:
+				a, b, iden, idenNoGap, cov = line.rstrip("\n").split("\t")
+				ref, read = a.replace("-", ""), b.replace("-", "")
+				hit = hit_from_alignment(a, b)
+				self.assertEqual( str(idDiv.identity(ref, read, hit)), iden, line )
+				self.assertEqual( str(idDiv.identity(ref, read, hit, ignoreGap=True)), idenNoGap, line )
+				self.assertEqual( idDiv.coverage(ref, read, hit), cov, line )
+
+
+if __name__ == '__main__':
+	unittest.main()